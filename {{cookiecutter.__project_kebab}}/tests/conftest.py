@@ -10,7 +10,7 @@ from typing import AsyncGenerator
 import httpx
 import pytest_asyncio
 
-from {{cookiecutter.__project_slug}}.main import make_app
+from {{cookiecutter.__project_slug}}.main import make_app, make_resources
 
 
 # The 'raw' client of our application.
@@ -18,18 +18,22 @@ from {{cookiecutter.__project_slug}}.main import make_app
 # During tests we skip the whole main() ... function
 # and create the app directly.
 #
-# Usually we would connect to any databases, initialize 'ClientSession' to
-# access external services, etc.. in the main function.
-#
-# Since the main will not be called, we need to mock these connections
-# in this client explicitly
+# httpx.ASGITransport does not run the lifespan of the app,
+# so resources (clients of other services, databases)
+# are opened by the fixture explicitly.
+# Replace clients of other services with local fakes here, e.g.
+# resources.add_http_client(
+#     "backend", HttpClientSettings(), fake_http_transport(handler)
+# )
 #
 # Making the client could be a pretty expensive operation, so we specify here scope
 # to be module.
 @pytest_asyncio.fixture(scope="module")
 async def client() -> AsyncGenerator[httpx.AsyncClient, None]:
-    # Feel free to connect here to database, or create any global contest
-    async with httpx.AsyncClient(
-        transport=httpx.ASGITransport(make_app("")), base_url="http://test"
-    ) as aclient:
-        yield aclient
+    resources = make_resources()
+    async with resources:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(make_app("", resources=resources)),
+            base_url="http://test",
+        ) as aclient:
+            yield aclient
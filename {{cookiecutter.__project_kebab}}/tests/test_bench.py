@@ -0,0 +1,61 @@
+"""
+Benchmark suite of the full application stack
+
+Run `{{cookiecutter.__project_kebab}} bench` for longer runs,
+saving results and comparing them with previous runs
+"""
+
+import logging
+
+import pytest
+
+from {{cookiecutter.__project_slug}} import tracking
+from {{cookiecutter.__project_slug}}.bench import (
+    default_comparisons,
+    run_benchmark,
+    run_comparisons,
+)
+from {{cookiecutter.__project_slug}}.main import make_app
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture()
+def quiet_access_logs():
+    level = tracking.logger.level
+    tracking.logger.setLevel(logging.WARNING)
+    yield
+    tracking.logger.setLevel(level)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("transport", ["asgi", "socket"])
+@pytest.mark.usefixtures("quiet_access_logs")
+async def test_bench(transport: str) -> None:
+    result = await run_benchmark(
+        make_app(""), transport=transport, requests=200, concurrency=5, warmup=20
+    )
+    logger.info("Benchmark over %s\n%s", transport, result.format_table())
+
+    assert set(result.scenarios) == {
+        "health",
+        "echo",
+        "echo_error",
+        "validation_error",
+    }
+    for scenario in result.scenarios.values():
+        assert scenario.errors == 0
+        assert scenario.requests == 200
+        assert scenario.rps > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("quiet_access_logs")
+async def test_comparisons() -> None:
+    comparisons = default_comparisons()
+    results = await run_comparisons(comparisons, operations=20, rounds=1)
+
+    assert list(results) == [comparison.name for comparison in comparisons]
+    for result in results.values():
+        assert result.baseline_ops > 0
+        assert result.current_ops > 0
@@ -0,0 +1,197 @@
+"""
+Access log policy
+
+A full access log record for every request costs CPU in the formatter
+and gigabytes of logs at high request rates. AccessLog decides which
+requests TrackingMiddleware logs one by one:
+- failed (`error_status` and above) and slower than `slow_threshold` always
+- the rest with `sample_rate` probability: all of them by default,
+  none of them if summaries are enabled
+
+With `summary_interval` set, every request is also counted in a summary
+of its route, written every `summary_interval` seconds in place of
+per-request lines of successful requests: number of requests, statuses
+by class and latency quantiles. Summaries are written by a timer running
+with the lifespan of the app, by a request finishing after the interval
+has passed, and on shutdown. Requests that did not match any route
+are summarized together, raw paths would make too many summaries.
+
+Latency quantiles come from LatencySketch: counts in logarithmic buckets
+with bounded relative error (DDSketch), its size depends on the range of
+latencies only, not on the number of requests.
+"""
+
+import asyncio
+import logging
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+__all__ = ["AccessLogPolicy", "AccessLog", "LatencySketch"]
+
+logger = logging.getLogger(__name__)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+@dataclass(frozen=True)
+class AccessLogPolicy:
+    # Share of successful and fast requests logged one by one,
+    # all without summaries and none with summaries if None
+    sample_rate: float | None = None
+    # Requests slower than this are always logged, seconds
+    slow_threshold: float | None = None
+    # Requests with this status or higher are always logged
+    error_status: int = 400
+    # Seconds between per-route summaries, disabled if None
+    summary_interval: float | None = None
+    # Latency quantiles of summaries
+    quantiles: tuple[float, ...] = (0.5, 0.9, 0.99)
+
+
+class LatencySketch:
+    """
+    Quantiles of latencies with `relative_accuracy` relative error
+    """
+
+    __slots__ = ("count", "max", "_gamma", "_log_gamma", "_zeros", "_buckets")
+
+    # Values below are counted as zero, seconds
+    MIN_VALUE = 1e-6
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._zeros = 0
+        self._buckets: dict[int, int] = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value > self.max:
+            self.max = value
+        if value < self.MIN_VALUE:
+            self._zeros += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen > rank:
+                # Middle of the bucket (gamma^(i-1), gamma^i] by relative error
+                return min(2 * self._gamma**index / (self._gamma + 1), self.max)
+        return self.max
+
+
+class _RouteSummary:
+    __slots__ = ("statuses", "latency")
+
+    def __init__(self) -> None:
+        # Number of responses by status class: 1xx to 5xx
+        self.statuses = [0] * 5
+        self.latency = LatencySketch()
+
+
+class AccessLog:
+    def __init__(
+        self,
+        policy: AccessLogPolicy,
+        random: Callable[[], float] = random.random,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.policy = policy
+        self.random = random
+        self.clock = clock
+        self._summaries: dict[tuple[str, str], _RouteSummary] = {}
+        self._window_start = clock()
+        # Summaries replace per-request lines unless sampling is set explicitly
+        if policy.sample_rate is not None:
+            self._sample_rate = policy.sample_rate
+        else:
+            self._sample_rate = 0.0 if self.summaries else 1.0
+
+    @property
+    def summaries(self) -> bool:
+        return self.policy.summary_interval is not None
+
+    def should_log(self, status_code: int, latency: float) -> bool:
+        """
+        Whether the request is logged one by one
+        """
+        policy = self.policy
+        if status_code >= policy.error_status:
+            return True
+        if policy.slow_threshold is not None and latency >= policy.slow_threshold:
+            return True
+        sample_rate = self._sample_rate
+        return sample_rate >= 1 or (sample_rate > 0 and self.random() < sample_rate)
+
+    def record(
+        self, method: str, route_path: str | None, status_code: int, latency: float
+    ) -> None:
+        """
+        Count the request in the summary of its route,
+        write summaries if the interval has passed
+        """
+        key = (method, route_path or UNMATCHED_ROUTE)
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = self._summaries[key] = _RouteSummary()
+        summary.statuses[min(max(status_code // 100, 1), 5) - 1] += 1
+        summary.latency.add(latency)
+
+        interval = self.policy.summary_interval
+        if interval is not None and self.clock() - self._window_start >= interval:
+            self.flush()
+
+    async def write_summaries(self) -> None:
+        """
+        Write summaries every `summary_interval`, also of routes that have
+        no new requests to write them. Runs until cancelled
+        """
+        interval = self.policy.summary_interval
+        if interval is None:
+            return
+        while True:
+            await asyncio.sleep(max(0.0, self._window_start + interval - self.clock()))
+            # Written by a request in the meantime otherwise
+            if self.clock() - self._window_start >= interval:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Write summaries of the requests since the previous flush
+        """
+        now = self.clock()
+        interval = now - self._window_start
+        summaries, self._summaries = self._summaries, {}
+        self._window_start = now
+
+        for (method, route_path), summary in summaries.items():
+            latency = summary.latency
+            labels = {
+                "method": method,
+                "route": route_path,
+                "interval": f"{interval:.1f}s",
+                "requests": latency.count,
+            }
+            for status_class, count in enumerate(summary.statuses, start=1):
+                if count:
+                    labels[f"status_{status_class}xx"] = count
+            for q in self.policy.quantiles:
+                labels[f"latency_p{q * 100:g}"] = f"{latency.quantile(q):.6f}s"
+            labels["latency_max"] = f"{latency.max:.6f}s"
+            logger.info(
+                "%s %s: %d requests", method, route_path, latency.count, extra=labels
+            )
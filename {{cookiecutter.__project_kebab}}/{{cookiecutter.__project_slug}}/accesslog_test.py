@@ -0,0 +1,158 @@
+"""
+Tests for access log policy and summaries
+"""
+
+import asyncio
+import random
+
+import pytest
+from starlette.responses import Response
+from starlette.types import Message, Receive, Scope, Send
+
+from {{cookiecutter.__project_slug}}.conftest import JsonLogs
+
+from .accesslog import AccessLog, AccessLogPolicy, LatencySketch
+from .tracking import TrackingMiddleware
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_latency_sketch():
+    sketch = LatencySketch(relative_accuracy=0.01)
+    values = [random.lognormvariate(-4, 1.5) for _ in range(10000)] + [0.0] * 100
+    for value in values:
+        sketch.add(value)
+
+    values.sort()
+    assert sketch.count == len(values)
+    assert sketch.max == values[-1]
+    for q in (0.5, 0.9, 0.99, 0.999):
+        exact = values[int(q * (len(values) - 1))]
+        assert sketch.quantile(q) == pytest.approx(exact, rel=0.01)
+    assert sketch.quantile(0) == 0
+    assert LatencySketch().quantile(0.5) == 0
+
+
+def test_should_log():
+    draws = iter([0.05, 0.5])
+    access_log = AccessLog(
+        AccessLogPolicy(sample_rate=0.1, slow_threshold=1.0),
+        random=lambda: next(draws),
+    )
+    assert access_log.should_log(200, 0.01)
+    assert not access_log.should_log(200, 0.01)
+    # Errors and slow requests are not sampled
+    assert access_log.should_log(404, 0.01)
+    assert access_log.should_log(500, 0.01)
+    assert access_log.should_log(200, 1.5)
+
+
+def test_should_log_with_summaries():
+    # Summaries replace per-request lines of successful requests
+    access_log = AccessLog(AccessLogPolicy(summary_interval=60))
+    assert not access_log.should_log(200, 0.01)
+    assert access_log.should_log(500, 0.01)
+    assert AccessLog(AccessLogPolicy()).should_log(200, 0.01)
+    # Unless sampled explicitly
+    both = AccessLog(AccessLogPolicy(sample_rate=1, summary_interval=60))
+    assert both.should_log(200, 0.01)
+
+
+def _scope(path: str) -> Scope:
+    return {
+        "type": "http",
+        "method": "GET",
+        "http_version": "1.1",
+        "headers": [],
+        "path": path,
+        "query_string": b"",
+    }
+
+
+async def _receive() -> Message:
+    return {"type": "http.disconnect"}
+
+
+async def _send(message: Message) -> None:
+    pass
+
+
+@pytest.mark.asyncio
+async def test_summaries(structured_logs_capture: JsonLogs):
+    clock = FakeClock()
+    access_log = AccessLog(AccessLogPolicy(summary_interval=60), clock=clock)
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            while (await receive())["type"] != "lifespan.shutdown":
+                pass
+            return
+        status = 500 if scope["path"] == "/error" else 200
+        await Response(status_code=status)(scope, receive, send)
+
+    tracking = TrackingMiddleware(app, access_log=access_log)
+    for path in ["/ok"] * 9 + ["/error"]:
+        await tracking(_scope(path), _receive, _send)
+
+    # Only the error is logged one by one
+    [error] = structured_logs_capture.parse()
+    assert error["httpRequest"]["status"] == 500
+
+    # The request after the interval writes the summary
+    clock.now += 60
+    await tracking(_scope("/ok"), _receive, _send)
+    [summary] = structured_logs_capture.parse()[1:]
+    assert summary["message"] == "GET <unmatched>: 11 requests"
+    labels = summary["logging.googleapis.com/labels"]
+    assert labels["requests"] == "11"
+    assert labels["status_2xx"] == "10"
+    assert labels["status_5xx"] == "1"
+    assert labels["interval"] == "60.0s"
+    assert {"latency_p50", "latency_p90", "latency_p99", "latency_max"} <= set(labels)
+
+    # The rest is written on shutdown
+    await tracking(_scope("/ok"), _receive, _send)
+    messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+
+    async def lifespan_receive() -> Message:
+        return next(messages)
+
+    await tracking({"type": "lifespan"}, lifespan_receive, _send)
+    assert structured_logs_capture.parse()[-1]["message"] == (
+        "GET <unmatched>: 1 requests"
+    )
+
+
+@pytest.mark.asyncio
+async def test_summaries_timer(structured_logs_capture: JsonLogs):
+    access_log = AccessLog(AccessLogPolicy(summary_interval=0.05))
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            while (await receive())["type"] != "lifespan.shutdown":
+                pass
+            return
+        await Response()(scope, receive, send)
+
+    tracking = TrackingMiddleware(app, access_log=access_log)
+    lifespan_messages: asyncio.Queue[Message] = asyncio.Queue()
+    lifespan_messages.put_nowait({"type": "lifespan.startup"})
+    lifespan = asyncio.create_task(
+        tracking({"type": "lifespan"}, lifespan_messages.get, _send)
+    )
+    await tracking(_scope("/ok"), _receive, _send)
+
+    # Written without waiting for the next request
+    await asyncio.sleep(0.2)
+    assert [log["message"] for log in structured_logs_capture.parse()] == [
+        "GET <unmatched>: 1 requests"
+    ]
+
+    lifespan_messages.put_nowait({"type": "lifespan.shutdown"})
+    await lifespan
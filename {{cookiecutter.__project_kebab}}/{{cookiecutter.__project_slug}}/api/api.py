@@ -6,7 +6,10 @@ import logging
 
 from fastapi import APIRouter
 
+from {{cookiecutter.__project_slug}}.resources import Resources
+
 from . import spec
+from .batch import BatchSettings
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +19,16 @@ class DefaultApi(spec.Api):
     Implementation of the service API
     """
 
+    def __init__(self, resources: Resources) -> None:
+        # Clients of other services, e.g. self.resources.http("backend").
+        # Not available in methods offloaded to processes
+        self.resources = resources
+
     async def echo(self, request: str) -> spec.EchoResponse:
         if request == "error":
             raise spec.EchoError()
         return spec.EchoResponse(text=f"{request}")
 
 
-def api_router() -> APIRouter:
-    return spec.make_router(DefaultApi())
+def api_router(resources: Resources, batch: BatchSettings | None = None) -> APIRouter:
+    return spec.make_router(DefaultApi(resources), batch)
@@ -0,0 +1,175 @@
+"""
+Batch of API calls in one request
+
+Clients making dozens of small calls pay a round trip through the ingress,
+middleware and routing for each of them. POST /batch takes a list
+of operations, endpoints registered in spec.make_router named
+"METHOD /path", with their parameters:
+
+{"operations": [{"operation": "GET /echo", "params": {"request": "hi"}}]}
+
+Operations run concurrently, at most `concurrency` at a time, and their
+results are returned in order, each with the status code and body
+the endpoint would respond with on its own: its response model or UserError.
+
+Operations run in the context of the batch request: they share its request id
+in logs and its deadline, and each one is logged with its position,
+status and latency. Endpoints streaming their responses or returning raw
+responses are not batched: they are not listed in the request model,
+batches with them are rejected with 422.
+
+A batch multiplies the work one request can trigger, so the route is served
+only if enabled with BatchSettings (BATCH=true).
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Literal
+
+import fastapi
+from pydantic import BaseModel, Field, create_model
+
+__all__ = ["BatchSettings", "BatchResult", "BatchResponse", "Batch"]
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BatchSettings:
+    # Operations accepted in one request, more are rejected with 422
+    max_operations: int = 50
+    # Operations of one request running at the same time
+    concurrency: int = 8
+    # Time limit of the whole batch, seconds
+    timeout: float | None = None
+
+
+class BatchResult(BaseModel):
+    status: int
+    # Response model of the operation or UserError,
+    # a string for other media types, null if empty
+    body: Any
+
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+
+
+# Call of one operation with its parameters, responds as the endpoint would
+BatchCall = Callable[[dict[str, Any]], Awaitable[fastapi.Response]]
+
+
+def _is_json(content_type: str | None) -> bool:
+    if not content_type:
+        return False
+    media_type = content_type.partition(";")[0].strip().lower()
+    return media_type == "application/json" or media_type.endswith("+json")
+
+
+def result_body(response: fastapi.Response) -> bytes:
+    """
+    Body of the response as a JSON value:
+    JSON as is, text of other media types as a string, null if empty
+    """
+    body = bytes(response.body)
+    if not body:
+        return b"null"
+    if _is_json(response.headers.get("content-type")):
+        return body
+    return json.dumps(body.decode(response.charset, errors="replace")).encode()
+
+
+class Batch:
+    """
+    Registry of operations available in batches
+    """
+
+    def __init__(self, settings: BatchSettings):
+        self.settings = settings
+        self._calls: dict[str, BatchCall] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._calls)
+
+    def add(self, operation: str, call: BatchCall) -> None:
+        self._calls[operation] = call
+
+    async def run(self, operations: list[tuple[str, dict[str, Any]]]) -> bytes:
+        """
+        JSON of BatchResponse with results of the operations
+        """
+        semaphore = asyncio.Semaphore(self.settings.concurrency)
+
+        async def run_one(index: int, operation: str, params: dict[str, Any]):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await self._calls[operation](params)
+                logger.info(
+                    "Batch operation %s: %d",
+                    operation,
+                    response.status_code,
+                    extra={
+                        "batch_index": index,
+                        "operation": operation,
+                        "status": response.status_code,
+                        "latency": f"{time.perf_counter() - start:.6f}s",
+                    },
+                )
+            return response
+
+        # Operations respond with UserError instead of raising,
+        # one failed operation does not cancel the others
+        async with asyncio.TaskGroup() as group:
+            tasks = [
+                group.create_task(run_one(index, operation, params))
+                for index, (operation, params) in enumerate(operations)
+            ]
+
+        results = []
+        for task in tasks:
+            response = task.result()
+            results.append(
+                b'{"status":%d,"body":%s}'
+                % (response.status_code, result_body(response))
+            )
+        return b'{"results":[' + b",".join(results) + b"]}"
+
+    def endpoint(self) -> Callable:
+        """
+        Endpoint of POST /batch, its request model lists the registered operations
+        """
+        operation_model = create_model(
+            "BatchOperation",
+            operation=(Literal[tuple(self._calls)], ...),  # type: ignore
+            params=(dict[str, Any], Field(default_factory=dict)),
+        )
+        request_model = create_model(
+            "BatchRequest",
+            operations=(
+                list[operation_model],  # type: ignore
+                Field(min_length=1, max_length=self.settings.max_operations),
+            ),
+        )
+
+        # Encoded right away, BatchResponse is the documented response model
+        async def batch(request: Any) -> fastapi.Response:
+            """Run many operations in one request"""
+            body = await self.run(
+                [
+                    (operation.operation, operation.params)
+                    for operation in request.operations
+                ]
+            )
+            return fastapi.Response(body, media_type="application/json")
+
+        signature = inspect.signature(batch)
+        batch.__signature__ = signature.replace(  # type: ignore
+            parameters=[
+                signature.parameters["request"].replace(annotation=request_model)
+            ]
+        )
+        return batch
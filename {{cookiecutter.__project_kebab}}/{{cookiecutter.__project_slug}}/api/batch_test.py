@@ -0,0 +1,184 @@
+"""
+Tests for batches of API calls
+"""
+
+import asyncio
+from typing import AsyncIterator
+
+import fastapi
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+
+from {{cookiecutter.__project_slug}}.conftest import JsonLogs
+from {{cookiecutter.__project_slug}}.slog import logging_context
+
+from ..main import make_app
+from .batch import Batch, BatchResponse, BatchSettings
+from .spec import (
+    Api,
+    ApiSection,
+    EchoError,
+    EchoResponse,
+    make_router,
+    register_default_exception_handler,
+)
+
+
+class SlowApi(Api):
+    def __init__(self) -> None:
+        self.running = 0
+        self.max_running = 0
+
+    async def echo(self, request: str) -> EchoResponse:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.running -= 1
+        if request == "error":
+            raise EchoError("echo failed")
+        return EchoResponse(text=request)
+
+
+def _app(api: Api, settings: BatchSettings) -> FastAPI:
+    app = FastAPI()
+    app.include_router(make_router(api, settings))
+    register_default_exception_handler(app)
+    return app
+
+
+def _operations(*requests: str | None) -> dict:
+    return {
+        "operations": [
+            {"operation": "GET /echo", "params": {} if r is None else {"request": r}}
+            for r in requests
+        ]
+    }
+
+
+@pytest.mark.asyncio
+async def test_batch(structured_logs_capture: JsonLogs):
+    api = SlowApi()
+    transport = httpx.ASGITransport(_app(api, BatchSettings(concurrency=2)))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        with logging_context(request_id="batch-1"):
+            response = await client.post(
+                "/batch", json=_operations("a", "error", None, "b", "c")
+            )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0] == {"status": 200, "body": {"text": "a"}}
+    assert results[1] == {
+        "status": 400,
+        "body": {"error": "EchoError", "detail": "echo failed"},
+    }
+    assert results[2]["status"] == 422
+    assert results[2]["body"]["error"] == "RequestValidationError"
+    assert [result["body"]["text"] for result in results[3:]] == ["b", "c"]
+    # Bounded fan-out
+    assert api.max_running == 2
+
+    labels = [
+        log["logging.googleapis.com/labels"]
+        for log in structured_logs_capture.parse()
+        if log["message"].startswith("Batch operation")
+    ]
+    assert {label["request_id"] for label in labels} == {"batch-1"}
+    assert sorted(int(label["batch_index"]) for label in labels) == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_batch_limits():
+    transport = httpx.ASGITransport(_app(SlowApi(), BatchSettings(max_operations=2)))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        too_many = await client.post("/batch", json=_operations("a", "b", "c"))
+        empty = await client.post("/batch", json=_operations())
+        unknown = await client.post(
+            "/batch", json={"operations": [{"operation": "GET /unknown"}]}
+        )
+
+    for response in (too_many, empty, unknown):
+        assert response.status_code == 422
+        assert response.json()["error"] == "RequestValidationError"
+
+
+def test_batch_documented():
+    schema = _app(SlowApi(), BatchSettings()).openapi()
+    assert "/batch" in schema["paths"]
+    operation = schema["components"]["schemas"]["BatchOperation"]
+    # Enum of registered operations, const if there is one
+    names = operation["properties"]["operation"]
+    assert names.get("enum", [names.get("const")]) == ["GET /echo"]
+
+
+def test_batch_disabled():
+    app = FastAPI()
+    app.include_router(make_router(SlowApi()))
+    assert "/batch" not in app.openapi()["paths"]
+    # Opt-in
+    assert "/batch" not in make_app("").openapi()["paths"]
+    assert "/batch" in make_app("", batch=BatchSettings()).openapi()["paths"]
+
+
+class MixedApi:
+    async def reply(self, request: str) -> EchoResponse:
+        if request == "empty":
+            return fastapi.Response(status_code=204)  # type: ignore
+        if request == "text":
+            return fastapi.responses.PlainTextResponse('plain "text"')  # type: ignore
+        return EchoResponse(text=request)
+
+    async def raw(self) -> fastapi.Response:
+        return fastapi.Response("raw")
+
+    async def export(self) -> AsyncIterator[EchoResponse]:
+        yield EchoResponse(text="item")
+
+
+def _mixed_app() -> FastAPI:
+    api = MixedApi()
+    router = APIRouter()
+    batch = Batch(BatchSettings())
+    section = ApiSection(router, "/mixed", "mixed", batch)
+    section.register("GET", "reply", api.reply)
+    section.register("GET", "raw", api.raw)
+    section.register("GET", "export", api.export)
+    ApiSection(router, "/batch", "batch").register(
+        "POST", "", batch.endpoint(), response_model=BatchResponse
+    )
+    app = FastAPI()
+    app.include_router(router)
+    register_default_exception_handler(app)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_batch_media_types():
+    transport = httpx.ASGITransport(_mixed_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post(
+            "/batch",
+            json={
+                "operations": [
+                    {"operation": "GET /mixed/reply", "params": {"request": r}}
+                    for r in ("json", "empty", "text")
+                ]
+            },
+        )
+        unsupported = [
+            await client.post(
+                "/batch", json={"operations": [{"operation": f"GET /mixed/{path}"}]}
+            )
+            for path in ("raw", "export")
+        ]
+
+    assert response.json()["results"] == [
+        {"status": 200, "body": {"text": "json"}},
+        {"status": 204, "body": None},
+        {"status": 200, "body": 'plain "text"'},
+    ]
+    for rejected in unsupported:
+        assert rejected.status_code == 422
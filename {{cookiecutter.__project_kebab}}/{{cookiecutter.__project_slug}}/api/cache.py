@@ -0,0 +1,151 @@
+"""
+In-process response cache for API endpoints
+
+Use `cache=CachePolicy(...)` when registering an endpoint in spec.make_router.
+Responses are cached as serialized JSON together with their ETag.
+Concurrent requests with the same parameters wait for a single
+call of the endpoint instead of calling it once per request.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Hashable
+
+from prometheus_client import Counter
+
+from .singleflight import SingleFlight
+
+__all__ = ["CachePolicy", "CacheEntry", "ResponseCache", "etag_matches"]
+
+CACHE_REQUESTS = Counter(
+    "api_cache_requests",
+    "Number of requests to cached endpoints by result: hit, miss or coalesced",
+    ["route", "result"],
+)
+
+CACHE_EVICTIONS = Counter(
+    "api_cache_evictions",
+    "Number of evicted cache entries by reason: expired or size",
+    ["route", "reason"],
+)
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """
+    Caching settings of an endpoint
+    """
+
+    # Time to live of cached response, seconds
+    ttl: float
+    # Maximum number of cached responses, least recently used are evicted first
+    max_entries: int = 1024
+    # Cache-Control: public allows shared caches (proxies) to store the response
+    public: bool = False
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    body: bytes
+    etag: str
+    expires_at: float
+
+    @classmethod
+    def create(cls, body: bytes, expires_at: float) -> "CacheEntry":
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        return cls(body, etag, expires_at)
+
+
+class ResponseCache:
+    """
+    LRU cache with TTL and coalescing of concurrent misses
+    """
+
+    def __init__(
+        self,
+        route: str,
+        policy: CachePolicy,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.route = route
+        self.policy = policy
+        self.clock = clock
+
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._in_flight = SingleFlight[CacheEntry]()
+
+        # Resolve labels once, not on every request
+        self._hits = CACHE_REQUESTS.labels(route, "hit")
+        self._misses = CACHE_REQUESTS.labels(route, "miss")
+        self._coalesced = CACHE_REQUESTS.labels(route, "coalesced")
+        self._expired = CACHE_EVICTIONS.labels(route, "expired")
+        self._evicted = CACHE_EVICTIONS.labels(route, "size")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def cache_control(self, entry: CacheEntry) -> str:
+        max_age = max(0, round(entry.expires_at - self.clock()))
+        visibility = "public" if self.policy.public else "private"
+        return f"{visibility}, max-age={max_age}"
+
+    def get(self, key: Hashable) -> CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry.expires_at <= self.clock():
+            del self._entries[key]
+            self._expired.inc()
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, body: bytes) -> CacheEntry:
+        entry = CacheEntry.create(body, self.clock() + self.policy.ttl)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.policy.max_entries:
+            self._entries.popitem(last=False)
+            self._evicted.inc()
+
+        return entry
+
+    async def get_or_compute(
+        self, key: Hashable, compute: Callable[[], Awaitable[bytes]]
+    ) -> CacheEntry:
+        """
+        Return cached entry or compute the response body.
+        Only one computation per key runs at a time,
+        exceptions are propagated to every waiting caller and are not cached
+        """
+        if (entry := self.get(key)) is not None:
+            self._hits.inc()
+            return entry
+
+        if key in self._in_flight:
+            self._coalesced.inc()
+        else:
+            self._misses.inc()
+
+        return await self._in_flight.do(key, lambda: self._compute(key, compute))
+
+    async def _compute(
+        self, key: Hashable, compute: Callable[[], Awaitable[bytes]]
+    ) -> CacheEntry:
+        return self.put(key, await compute())
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Check If-None-Match header against the ETag of the cached response
+    """
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
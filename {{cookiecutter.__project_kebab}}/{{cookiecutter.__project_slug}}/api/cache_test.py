@@ -0,0 +1,147 @@
+"""
+Tests for response caching of API endpoints
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+from prometheus_client import REGISTRY
+
+from .cache import CachePolicy, ResponseCache, etag_matches
+from .spec import ApiSection, EchoError, EchoResponse
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingApi:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def echo(self, request: str) -> EchoResponse:
+        """Echo with a slow backend"""
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if request == "error":
+            raise EchoError()
+        return EchoResponse(text=request)
+
+
+def make_client(api: CountingApi, policy: CachePolicy) -> httpx.AsyncClient:
+    router = APIRouter()
+    ApiSection(router, "/echo", "echo").register(
+        "GET", "", api.echo, EchoError, cache=policy
+    )
+    app = FastAPI()
+    app.include_router(router)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://test")
+
+
+def _metric(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_cached_endpoint():
+    api = CountingApi()
+    hits_before = _metric("api_cache_requests_total", route="GET /echo", result="hit")
+
+    async with make_client(api, CachePolicy(ttl=60)) as client:
+        first = await client.get("/echo", params={"request": "hello"})
+        second = await client.get("/echo", params={"request": "hello"})
+        other = await client.get("/echo", params={"request": "other"})
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json() == {"text": "hello"}
+    assert other.json() == {"text": "other"}
+    assert api.calls == 2
+
+    assert first.headers["ETag"] == second.headers["ETag"] != other.headers["ETag"]
+    assert first.headers["Cache-Control"] == "private, max-age=60"
+
+    hits = _metric("api_cache_requests_total", route="GET /echo", result="hit")
+    assert hits - hits_before == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_endpoint_not_modified():
+    async with make_client(CountingApi(), CachePolicy(ttl=60, public=True)) as client:
+        response = await client.get("/echo", params={"request": "hello"})
+        etag = response.headers["ETag"]
+
+        not_modified = await client.get(
+            "/echo", params={"request": "hello"}, headers={"If-None-Match": etag}
+        )
+
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["ETag"] == etag
+    assert not_modified.headers["Cache-Control"] == "public, max-age=60"
+
+
+@pytest.mark.asyncio
+async def test_cached_endpoint_coalesces_requests():
+    api = CountingApi()
+
+    async with make_client(api, CachePolicy(ttl=60)) as client:
+        responses = await asyncio.gather(
+            *[client.get("/echo", params={"request": "hello"}) for _ in range(10)]
+        )
+
+    assert {response.json()["text"] for response in responses} == {"hello"}
+    assert api.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_endpoint_errors_are_not_cached():
+    api = CountingApi()
+
+    async with make_client(api, CachePolicy(ttl=60)) as client:
+        responses = await asyncio.gather(
+            *[client.get("/echo", params={"request": "error"}) for _ in range(3)]
+        )
+        again = await client.get("/echo", params={"request": "error"})
+
+    # Concurrent requests share the error, the next request calls the API again
+    assert [response.status_code for response in responses] == [400, 400, 400]
+    assert responses[0].json() == {"error": "EchoError", "detail": ""}
+    assert again.status_code == 400
+    assert api.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_response_cache_ttl_and_size():
+    clock = FakeClock()
+    cache = ResponseCache("test", CachePolicy(ttl=10, max_entries=2), clock=clock)
+
+    async def compute() -> bytes:
+        return b"body"
+
+    entry = await cache.get_or_compute("a", compute)
+    assert cache.cache_control(entry) == "private, max-age=10"
+    await cache.get_or_compute("b", compute)
+
+    # "a" is used recently, "b" is evicted
+    assert cache.get("a") is not None
+    await cache.get_or_compute("c", compute)
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+    clock.now += 10
+    assert cache.get("a") is None
+    assert cache.get("c") is None
+    assert len(cache) == 0
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"x"', '"abc"')
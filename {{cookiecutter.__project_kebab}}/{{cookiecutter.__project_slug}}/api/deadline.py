@@ -0,0 +1,60 @@
+"""
+Request deadlines
+
+Time budget of a request is the smallest of the route timeout
+(`timeout=` in ApiSection.register) and the timeout sent by the client
+in X-Request-Timeout-Ms header, milliseconds.
+When the budget runs out the endpoint is cancelled and the client gets 504.
+
+Endpoints read the remaining budget with `remaining()`, e.g. to pass it
+as timeout of calls to other services, so they do not keep working
+for a client that is gone.
+"""
+
+import contextvars
+import math
+import time
+
+__all__ = [
+    "DEADLINE_HEADER",
+    "DEADLINE",
+    "DeadlineExceeded",
+    "parse_timeout_ms",
+    "remaining",
+]
+
+DEADLINE_HEADER = "x-request-timeout-ms"
+
+# time.monotonic() of the deadline of the current request, None if unlimited
+DEADLINE = contextvars.ContextVar[float | None]("_request_deadline_", default=None)
+
+
+class DeadlineExceeded(Exception):
+    status_code = 504
+
+
+def remaining() -> float | None:
+    """
+    Seconds left until the deadline of the current request, None if unlimited
+    """
+    deadline = DEADLINE.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def parse_timeout_ms(value: str | None) -> float | None:
+    """
+    Timeout in seconds from the header value, None if missing or malformed.
+    float() accepts "nan" and "inf", they are malformed as well as timeouts
+    that are not positive
+    """
+    if not value:
+        return None
+    try:
+        timeout_ms = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(timeout_ms) or timeout_ms <= 0:
+        return None
+    return timeout_ms / 1000
@@ -0,0 +1,127 @@
+"""
+Tests for request deadlines of API endpoints
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+
+from . import deadline
+from .spec import ApiSection, EchoError, EchoResponse
+
+
+class SlowApi:
+    def __init__(self) -> None:
+        self.remaining: list[float | None] = []
+        self.cancelled = 0
+
+    async def echo(self, request: str) -> EchoResponse:
+        """Echo after `request` seconds"""
+        self.remaining.append(deadline.remaining())
+        if request == "timeout":
+            raise TimeoutError("downstream timed out")
+        try:
+            await asyncio.sleep(float(request))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return EchoResponse(text=request)
+
+
+def make_client(api: SlowApi, timeout: float | None) -> httpx.AsyncClient:
+    router = APIRouter()
+    ApiSection(router, "/echo", "echo").register(
+        "GET", "", api.echo, EchoError, timeout=timeout
+    )
+    app = FastAPI()
+    app.include_router(router)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://test")
+
+
+@pytest.mark.asyncio
+async def test_route_timeout():
+    api = SlowApi()
+    async with make_client(api, timeout=0.05) as client:
+        fast = await client.get("/echo", params={"request": "0"})
+        slow = await client.get("/echo", params={"request": "1"})
+
+    assert fast.status_code == 200
+    assert slow.status_code == 504
+    assert slow.json() == {
+        "error": "DeadlineExceeded",
+        "detail": "Request did not complete in 0.050 seconds",
+    }
+    assert api.cancelled == 1
+    for budget in api.remaining:
+        assert budget is not None
+        assert 0 < budget <= 0.05
+
+
+@pytest.mark.asyncio
+async def test_client_timeout():
+    api = SlowApi()
+    async with make_client(api, timeout=None) as client:
+        unlimited = await client.get("/echo", params={"request": "0.05"})
+        # Client timeout is shorter than the route timeout
+        slow = await client.get(
+            "/echo",
+            params={"request": "1"},
+            headers={deadline.DEADLINE_HEADER: "20"},
+        )
+        malformed = [
+            await client.get(
+                "/echo",
+                params={"request": "0"},
+                headers={deadline.DEADLINE_HEADER: value},
+            )
+            for value in ("x", "0", "-5", "nan", "inf")
+        ]
+        # Deadline of the calling request, e.g. a batch, has passed
+        token = deadline.DEADLINE.set(time.monotonic())
+        try:
+            expired = await client.get("/echo", params={"request": "0"})
+        finally:
+            deadline.DEADLINE.reset(token)
+
+    assert unlimited.status_code == 200
+    assert slow.status_code == 504
+    assert expired.status_code == 504
+    assert expired.json()["detail"] == "Request deadline has already passed"
+    assert [response.status_code for response in malformed] == [200] * 5
+    # Expired request does not reach the endpoint
+    assert api.remaining[0] is None
+    assert api.remaining[1] is not None
+    assert 0 < api.remaining[1] <= 0.02
+    assert api.remaining[2:] == [None] * 5
+
+
+@pytest.mark.asyncio
+async def test_endpoint_timeout_is_internal_error():
+    async with make_client(SlowApi(), timeout=10) as client:
+        response = await client.get("/echo", params={"request": "timeout"})
+    assert response.status_code == 500
+
+
+def test_deadline_documented():
+    router = APIRouter()
+    ApiSection(router, "/echo", "echo").register(
+        "GET", "", SlowApi().echo, EchoError, timeout=1
+    )
+    app = FastAPI()
+    app.include_router(router)
+
+    operation = app.openapi()["paths"]["/echo"]["get"]
+    assert "504" in operation["responses"]
+    # The header is not part of the API schema
+    assert [parameter["name"] for parameter in operation["parameters"]] == ["request"]
+
+
+def test_parse_timeout_ms():
+    assert deadline.parse_timeout_ms("1500") == 1.5
+    assert deadline.parse_timeout_ms(None) is None
+    assert deadline.parse_timeout_ms("soon") is None
+    for value in ("0", "-1", "nan", "inf", "-inf"):
+        assert deadline.parse_timeout_ms(value) is None
@@ -0,0 +1,253 @@
+"""
+Executors for blocking and CPU-bound work of API endpoints
+
+Api methods are coroutines running on the event loop, one blocking call
+stalls every request of the process. Such methods are written as plain
+functions and marked with `offload`:
+
+class DefaultApi(spec.Api):
+    @offload("thread")
+    def report(self, name: str) -> Report:  # blocking IO
+        ...
+
+    @offload("process")
+    def render(self, data: str) -> Image:  # CPU-bound Python code
+        ...
+
+Threads suit blocking IO and libraries that release the GIL.
+Processes run Python code in parallel: arguments, results and the Api
+instance itself are pickled. Clients of other services are not passed
+to processes, Resources of the Api raise RuntimeError there.
+The process pool is created only if some method is offloaded to processes,
+its workers are started and import the modules of offloaded methods
+before the server accepts connections.
+
+Each pool accepts `queue_size` calls over its number of workers,
+the next calls fail with ExecutorBusy (503) instead of waiting
+longer than any client would. A cancelled call (e.g. by the request
+deadline) is removed from the queue, a running one runs to completion.
+"""
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import wraps
+from typing import Any, Callable, Literal
+
+from prometheus_client import Gauge, Histogram
+
+__all__ = [
+    "ExecutorSettings",
+    "ExecutorBusy",
+    "Executors",
+    "current",
+    "offload",
+]
+
+PoolName = Literal["thread", "process"]
+
+QUEUE_DEPTH = Gauge(
+    "executor_queue_depth",
+    "Number of offloaded calls waiting for a free worker",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+WAIT_TIME = Histogram(
+    "executor_wait_seconds",
+    "Time offloaded calls waited for a free worker, in seconds",
+    ["pool"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+# Modules of functions offloaded to processes, imported by the process workers
+_PRELOAD: set[str] = set()
+
+
+@dataclass(frozen=True)
+class ExecutorSettings:
+    # Worker threads for blocking calls
+    threads: int = 8
+    # Worker processes for CPU-bound calls, 0 disables the process pool.
+    # Not started if no method is offloaded to processes
+    processes: int = 1
+    # Calls accepted by a pool over its number of workers
+    queue_size: int = 100
+
+
+class ExecutorBusy(Exception):
+    status_code = 503
+
+
+def _timed(func: Callable[..., Any], *args: Any, **kwargs: Any) -> tuple[float, Any]:
+    # time.monotonic() is system-wide, so it is comparable across processes
+    return time.monotonic(), func(*args, **kwargs)
+
+
+def _preload(modules: tuple[str, ...]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+
+class _OffloadedMethod:
+    """
+    Picklable reference to an offloaded function.
+    The function itself cannot be pickled by name: the name refers to
+    its `offload` wrapper, so the worker process takes the wrapped function
+    """
+
+    __slots__ = ("module", "qualname")
+
+    def __init__(self, module: str, qualname: str) -> None:
+        if "<locals>" in qualname:
+            raise TypeError(f"Cannot offload local function {qualname} to processes")
+        self.module = module
+        self.qualname = qualname
+
+    def __getstate__(self) -> tuple[str, str]:
+        return self.module, self.qualname
+
+    def __setstate__(self, state: tuple[str, str]) -> None:
+        self.module, self.qualname = state
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        target: Any = importlib.import_module(self.module)
+        for name in self.qualname.split("."):
+            target = getattr(target, name)
+        return target.__wrapped__(*args, **kwargs)
+
+
+class _Pool:
+    def __init__(
+        self, name: PoolName, executor: Executor, workers: int, queue_size: int
+    ):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.limit = workers + queue_size
+        # Submitted and not finished calls
+        self.pending = 0
+        self._queue_depth = QUEUE_DEPTH.labels(name)
+        self._wait_time = WAIT_TIME.labels(name)
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if self.pending >= self.limit:
+            raise ExecutorBusy(f"Too many calls are waiting for the {self.name} pool")
+
+        self._set_pending(self.pending + 1)
+        submitted = time.monotonic()
+        try:
+            started, result = await asyncio.wrap_future(
+                self.executor.submit(_timed, func, *args, **kwargs)
+            )
+        finally:
+            self._set_pending(self.pending - 1)
+        self._wait_time.observe(started - submitted)
+        return result
+
+    def _set_pending(self, pending: int) -> None:
+        self.pending = pending
+        self._queue_depth.set(max(0, pending - self.workers))
+
+
+class Executors:
+    """
+    Thread and process pools of offloaded calls.
+    `start` warms up the process workers and makes the pools current,
+    `shutdown` waits for the running calls
+    """
+
+    def __init__(self, settings: ExecutorSettings):
+        self.settings = settings
+        self._pools: dict[PoolName, _Pool] = {
+            "thread": _Pool(
+                "thread",
+                ThreadPoolExecutor(settings.threads, thread_name_prefix="offload"),
+                settings.threads,
+                settings.queue_size,
+            )
+        }
+        # Methods are marked with `offload` when their modules are imported
+        if settings.processes > 0 and _PRELOAD:
+            # fork is not safe in a process running event loop and threads
+            method = "forkserver" if os.name == "posix" else "spawn"
+            self._pools["process"] = _Pool(
+                "process",
+                ProcessPoolExecutor(
+                    settings.processes,
+                    mp_context=multiprocessing.get_context(method),
+                    initializer=_preload,
+                    initargs=(tuple(sorted(_PRELOAD)),),
+                ),
+                settings.processes,
+                settings.queue_size,
+            )
+
+    async def start(self) -> None:
+        global _current
+
+        if pool := self._pools.get("process"):
+            # Processes are spawned on demand, start all of them now
+            await asyncio.gather(
+                *(pool.run(os.getpid) for _ in range(self.settings.processes))
+            )
+        _current = self
+
+    async def shutdown(self) -> None:
+        global _current
+
+        if _current is self:
+            _current = None
+        for pool in self._pools.values():
+            await asyncio.to_thread(pool.executor.shutdown, wait=True)
+
+    async def run(
+        self, pool: PoolName, func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        try:
+            executor = self._pools[pool]
+        except KeyError:
+            raise RuntimeError(
+                f"The {pool} pool is disabled or no method is offloaded to it"
+            ) from None
+        return await executor.run(func, *args, **kwargs)
+
+
+_current: Executors | None = None
+
+
+def current() -> Executors:
+    """
+    Executors started by the server, or default ones created on first use
+    when the app runs without the server, e.g. in tests
+    """
+    global _current
+
+    if _current is None:
+        _current = Executors(ExecutorSettings())
+    return _current
+
+
+def offload(pool: PoolName):
+    """
+    Run the function in the thread or process pool of `current()` executors.
+    The decorated function is a coroutine function
+    """
+
+    def decorator(func: Callable[..., Any]):
+        target: Callable[..., Any] = func
+        if pool == "process":
+            target = _OffloadedMethod(func.__module__, func.__qualname__)
+            _PRELOAD.add(func.__module__)
+
+        @wraps(func)
+        async def _offloaded(*args: Any, **kwargs: Any):
+            return await current().run(pool, target, *args, **kwargs)
+
+        _offloaded.offload = pool  # type: ignore
+        return _offloaded
+
+    return decorator
@@ -0,0 +1,126 @@
+"""
+Tests for executors of offloaded API methods
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import AsyncGenerator
+
+import httpx
+import pytest
+import pytest_asyncio
+from fastapi import APIRouter, FastAPI
+from prometheus_client import REGISTRY
+
+from .executors import ExecutorBusy, Executors, ExecutorSettings, offload
+from .spec import ApiSection, EchoResponse
+
+
+class OffloadingApi:
+    def __init__(self) -> None:
+        self.release = threading.Event()
+
+    def __getstate__(self) -> dict:
+        # Events cannot be pickled, processes do not need it
+        return {}
+
+    @offload("thread")
+    def blocking(self, seconds: float) -> EchoResponse:
+        """Blocks the calling thread"""
+        time.sleep(seconds)
+        return EchoResponse(text=threading.current_thread().name)
+
+    @offload("thread")
+    def wait(self) -> EchoResponse:
+        self.release.wait(10)
+        return EchoResponse(text="released")
+
+    @offload("process")
+    def cpu_bound(self, n: int) -> EchoResponse:
+        """Runs in another process"""
+        total = sum(i * i for i in range(n))
+        return EchoResponse(text=f"{os.getpid()}:{total}")
+
+
+@pytest_asyncio.fixture()
+async def executors() -> AsyncGenerator[Executors, None]:
+    executors = Executors(ExecutorSettings(threads=1, processes=1, queue_size=1))
+    await executors.start()
+    try:
+        yield executors
+    finally:
+        await executors.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_thread_offload_does_not_block_loop(executors: Executors):
+    ticks = 0
+
+    async def ticker() -> None:
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    task = asyncio.ensure_future(ticker())
+    response = await OffloadingApi().blocking(0.2)
+    task.cancel()
+
+    assert response.text.startswith("offload")
+    # The loop kept running while the call was blocked
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_process_offload(executors: Executors):
+    waits_before = REGISTRY.get_sample_value(
+        "executor_wait_seconds_count", {"pool": "process"}
+    )
+
+    response = await OffloadingApi().cpu_bound(1000)
+
+    pid, total = response.text.split(":")
+    assert int(pid) != os.getpid()
+    assert int(total) == sum(i * i for i in range(1000))
+    waits = REGISTRY.get_sample_value(
+        "executor_wait_seconds_count", {"pool": "process"}
+    )
+    assert waits == (waits_before or 0) + 1
+
+
+def test_process_pool_started_if_used(monkeypatch: pytest.MonkeyPatch):
+    settings = ExecutorSettings(processes=1)
+    assert "process" in Executors(settings)._pools
+
+    # Nothing is offloaded to processes
+    monkeypatch.setattr("{{cookiecutter.__project_slug}}.api.executors._PRELOAD", set())
+    assert "process" not in Executors(settings)._pools
+
+
+@pytest.mark.asyncio
+async def test_busy_pool(executors: Executors):
+    router = APIRouter()
+    api = OffloadingApi()
+    ApiSection(router, "/wait", "wait").register("GET", "", api.wait)
+    app = FastAPI()
+    app.include_router(router)
+
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        # One running and one queued call
+        running = asyncio.ensure_future(client.get("/wait"))
+        queued = asyncio.ensure_future(client.get("/wait"))
+        await asyncio.sleep(0.05)
+        depth = REGISTRY.get_sample_value("executor_queue_depth", {"pool": "thread"})
+        assert depth == 1
+
+        busy = await client.get("/wait")
+        assert busy.status_code == 503
+        assert busy.json()["error"] == ExecutorBusy.__name__
+
+        api.release.set()
+        assert (await running).status_code == (await queued).status_code == 200
+
+    assert "503" in app.openapi()["paths"]["/wait"]["get"]["responses"]
@@ -0,0 +1,53 @@
+"""
+Coalescing of concurrent identical calls (single-flight)
+
+While a call with some key is in flight, callers with the same key
+wait for its result instead of starting their own call.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+
+__all__ = ["SingleFlight", "make_key"]
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    def __init__(self) -> None:
+        self._in_flight: dict[Hashable, asyncio.Future[T]] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run the call or join the one already running with the same key.
+
+        The call runs in a separate task: cancellation of one waiting caller
+        does not affect the others. Result or exception of the call
+        is returned to every caller.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+
+def make_key(args: tuple[Any, ...], kwargs: dict[str, Any]) -> Hashable:
+    """
+    Key of the endpoint call arguments
+    """
+    key = (args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        # Lists, dicts and other unhashable parameters
+        return repr(key)
+    return key
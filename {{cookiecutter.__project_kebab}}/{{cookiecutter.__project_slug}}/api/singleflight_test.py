@@ -0,0 +1,121 @@
+"""
+Tests for coalescing of concurrent identical calls
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+
+from .singleflight import SingleFlight, make_key
+from .spec import ApiSection, EchoError, EchoResponse
+
+
+class SlowApi:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def echo(self, request: str) -> EchoResponse:
+        """Echo with a slow backend"""
+        self.calls += 1
+        await self.release.wait()
+        if request == "error":
+            raise EchoError("slow error")
+        if request == "crash":
+            raise ValueError("unexpected")
+        return EchoResponse(text=request)
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result():
+    flights = SingleFlight[int]()
+    calls = 0
+
+    async def call() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 42
+
+    results = await asyncio.gather(*[flights.do("key", call) for _ in range(5)])
+
+    assert results == [42] * 5
+    assert calls == 1
+    assert len(flights) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled_waiter():
+    flights = SingleFlight[int]()
+    release = asyncio.Event()
+
+    async def call() -> int:
+        await release.wait()
+        return 42
+
+    first = asyncio.create_task(flights.do("key", call))
+    second = asyncio.create_task(flights.do("key", call))
+    await asyncio.sleep(0)
+
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await second == 42
+    assert first.cancelled()
+
+
+def test_make_key():
+    assert make_key((), {"b": 1, "a": 2}) == make_key((), {"a": 2, "b": 1})
+    assert make_key((), {"a": [1]}) != make_key((), {"a": [2]})
+
+
+async def _concurrent_requests(api: SlowApi, request: str) -> list[httpx.Response]:
+    router = APIRouter()
+    ApiSection(router, "/echo", "echo").register(
+        "GET", "", api.echo, EchoError, single_flight=True
+    )
+    app = FastAPI()
+    app.include_router(router)
+
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        requests = [
+            asyncio.ensure_future(client.get("/echo", params={"request": request}))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0.05)
+        api.release.set()
+        return await asyncio.gather(*requests)
+
+
+@pytest.mark.asyncio
+async def test_coalesced_endpoint():
+    api = SlowApi()
+    responses = await _concurrent_requests(api, "hello")
+
+    assert [response.json() for response in responses] == [{"text": "hello"}] * 5
+    assert api.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_coalesced_endpoint_errors():
+    api = SlowApi()
+    responses = await _concurrent_requests(api, "error")
+
+    assert {response.status_code for response in responses} == {400}
+    assert [response.json() for response in responses] == [
+        {"error": "EchoError", "detail": "slow error"}
+    ] * 5
+    assert api.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_coalesced_endpoint_unhandled_errors():
+    api = SlowApi()
+    responses = await _concurrent_requests(api, "crash")
+
+    assert {response.status_code for response in responses} == {500}
+    assert api.calls == 1
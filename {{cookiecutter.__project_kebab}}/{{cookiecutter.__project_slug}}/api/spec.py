@@ -2,33 +2,54 @@
 Full API specification
 
 Fully describes API of the application,
-must not depend on any other modules
+must not depend on any other modules outside of the api package
 """
 
 import abc
+import asyncio
+import collections.abc
 import enum
 import inspect
 import logging
+import time
 from abc import abstractmethod
 from contextlib import contextmanager
 from functools import wraps
+from json.encoder import encode_basestring
 from typing import (
     Any,
+    AsyncIterator,
     Callable,
     Generator,
     Generic,
     List,
+    Literal,
     Tuple,
     Type,
     TypeVar,
+    get_args,
+    get_origin,
     get_type_hints,
 )
 from uuid import uuid4
 
 import fastapi
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, ValidationError, create_model
+
+from .batch import Batch, BatchResponse, BatchSettings
+from .cache import CachePolicy, ResponseCache, etag_matches
+from .deadline import (
+    DEADLINE,
+    DEADLINE_HEADER,
+    DeadlineExceeded,
+    parse_timeout_ms,
+    remaining,
+)
+from .executors import ExecutorBusy
+from .singleflight import SingleFlight, make_key
 
 logger = logging.getLogger(__name__)
 
@@ -48,17 +69,59 @@ class UserError(BaseModel, Generic[ErrorVariants]):
     detail: str
 
 
+# Pre-encoded header of JSON responses
+_CONTENT_TYPE_JSON = (b"content-type", b"application/json")
+
+
+class JsonBytesResponse(fastapi.Response):
+    """
+    Response with already encoded JSON body.
+    Skips header processing of fastapi.Response,
+    the headers are the same as of
+    fastapi.Response(body, headers={"Content-Type": "application/json"})
+    """
+
+    def __init__(self, body: bytes, status_code: int = 200) -> None:
+        self.status_code = status_code
+        self.body = body
+        self.background = None
+        self.raw_headers = [
+            _CONTENT_TYPE_JSON,
+            (b"content-length", str(len(body)).encode()),
+        ]
+
+
+class _ErrorWriter:
+    """
+    Writes UserError of one error variant.
+    Output is the same as of UserError(...).model_dump_json(),
+    but the pydantic model is not created for every error
+    """
+
+    __slots__ = ("_prefix",)
+
+    def __init__(self, error: str) -> None:
+        self._prefix = b'{"error":' + encode_basestring(error).encode() + b',"detail":'
+
+    def response(self, detail: str, status_code: int) -> JsonBytesResponse:
+        body = self._prefix + encode_basestring(detail).encode() + b"}"
+        return JsonBytesResponse(body, status_code)
+
+
+_VALIDATION_ERROR = _ErrorWriter(RequestValidationError.__name__)
+_INTERNAL_ERROR = _ErrorWriter("Internal server error")
+
+
 async def default_validation_exception_handler(
     _: fastapi.Request, exc: RequestValidationError
 ):
     """
     Handler for FastAPI errors
     """
-    return fastapi.Response(
-        UserError(error=exc.__class__.__name__, detail=str(exc)).model_dump_json(),
-        headers={"Content-Type": "application/json"},
-        status_code=422,
-    )
+    writer = _VALIDATION_ERROR
+    if exc.__class__ is not RequestValidationError:
+        writer = _ErrorWriter(exc.__class__.__name__)
+    return writer.response(str(exc), 422)
 
 
 def _create_error_enum(name: str, errors: List[Type[Exception]]):
@@ -75,35 +138,44 @@ def expect_exceptions(func: Callable, exceptions: Tuple[Type[Exception], ...]):
     Only those exceptions will be handled
     """
 
-    @wraps(func)
-    async def _handle_exceptions(*args: Any, **kwargs: Any):
-        try:
-            return await func(*args, **kwargs)
-        except exceptions as exc:
-            return fastapi.Response(
-                UserError(
-                    error=exc.__class__.__name__, detail=str(exc)
-                ).model_dump_json(),
-                headers={"Content-Type": "application/json"},
-                status_code=getattr(exc, "status_code"),
-            )
+    # Writers of expected errors by type, filled in at registration
+    error_writers: dict[type, _ErrorWriter] = {}
+
+    def error_response(exc: Exception) -> JsonBytesResponse:
+        """
+        Response to the exception being handled
+        """
+        if isinstance(exc, exceptions):
+            writer = error_writers.get(exc.__class__)
+            if writer is None:
+                # Subclass of one of the expected exceptions
+                writer = error_writers[exc.__class__] = _ErrorWriter(
+                    exc.__class__.__name__
+                )
+            return writer.response(str(exc), getattr(exc, "status_code"))
+
         # Manually handle here internal server errors
         # Handling the error this way gives more concise stack trace
         # and also allows middleware such as CORS to correctly add headers
         # to the response
-        except Exception:
-            error_uuid = str(uuid4())
-
-            logger.exception("Unhandled exception occurred. Id %s", error_uuid)
-
-            return fastapi.Response(
-                UserError(
-                    error="Internal server error",
-                    detail=f"Find details in logs by this id: {error_uuid}",
-                ).model_dump_json(),
-                headers={"Content-Type": "application/json"},
-                status_code=500,
-            )
+        error_uuid = str(uuid4())
+
+        logger.exception("Unhandled exception occurred. Id %s", error_uuid)
+
+        return _INTERNAL_ERROR.response(
+            f"Find details in logs by this id: {error_uuid}", 500
+        )
+
+    @wraps(func)
+    async def _handle_exceptions(*args: Any, **kwargs: Any):
+        try:
+            response = await func(*args, **kwargs)
+        except Exception as exc:
+            return error_response(exc)
+        if isinstance(response, StreamedItems):
+            # Errors raised after the response has started
+            response.on_error = error_response
+        return response
 
     errors_by_status_code = dict()
 
@@ -115,13 +187,12 @@ def expect_exceptions(func: Callable, exceptions: Tuple[Type[Exception], ...]):
 
     additional_responses = dict()
     for status_code, errors in errors_by_status_code.items():
+        error_enum = _create_error_enum(f"{func.__name__}{status_code}", errors)
         additional_responses[status_code] = {
-            "model": UserError[
-                _create_error_enum(  # type: ignore
-                    f"{func.__name__}{status_code}", errors
-                )
-            ]
+            "model": UserError[error_enum]  # type: ignore
         }
+        for error in errors:
+            error_writers[error] = _ErrorWriter(error.__name__)
 
     additional_responses[422] = {
         "model": UserError[
@@ -136,6 +207,291 @@ def expect_exceptions(func: Callable, exceptions: Tuple[Type[Exception], ...]):
     return _handle_exceptions
 
 
+def _add_header_parameter(endpoint: Callable, name: str, header: str) -> None:
+    """
+    Make FastAPI pass value of the request header to the endpoint
+    as keyword argument `name` without documenting it in the schema
+    """
+    signature = inspect.signature(endpoint)
+    parameter = inspect.Parameter(
+        name,
+        inspect.Parameter.KEYWORD_ONLY,
+        default=fastapi.Header(None, alias=header, include_in_schema=False),
+        annotation=str | None,
+    )
+    endpoint.__signature__ = signature.replace(  # type: ignore
+        parameters=[*signature.parameters.values(), parameter]
+    )
+
+
+# Keyword argument that receives If-None-Match header in cached endpoints
+_IF_NONE_MATCH = "_if_none_match"
+
+
+def cache_responses(func: Callable, response_model: Any, cache: ResponseCache):
+    """
+    Serve responses of the function from the cache.
+    Adds ETag and Cache-Control headers
+    and responds with 304 Not Modified if client already has the response
+    """
+    adapter = TypeAdapter(response_model)
+
+    @wraps(func)
+    async def _cached(*args: Any, **kwargs: Any):
+        if_none_match = kwargs.pop(_IF_NONE_MATCH, None)
+
+        async def compute() -> bytes:
+            return adapter.dump_json(await func(*args, **kwargs), by_alias=True)
+
+        entry = await cache.get_or_compute(make_key(args, kwargs), compute)
+
+        headers = {"ETag": entry.etag, "Cache-Control": cache.cache_control(entry)}
+        if if_none_match and etag_matches(if_none_match, entry.etag):
+            return fastapi.Response(status_code=304, headers=headers)
+
+        return fastapi.Response(
+            entry.body, media_type="application/json", headers=headers
+        )
+
+    _add_header_parameter(_cached, _IF_NONE_MATCH, "if-none-match")
+
+    return _cached
+
+
+def coalesce_calls(func: Callable):
+    """
+    Concurrent calls with the same arguments share one call of the function.
+    Each caller handles the shared result or exception on its own,
+    so errors are mapped to the same UserError for every caller
+    """
+    flights = SingleFlight()
+
+    @wraps(func)
+    async def _coalesced(*args: Any, **kwargs: Any):
+        return await flights.do(make_key(args, kwargs), lambda: func(*args, **kwargs))
+
+    return _coalesced
+
+
+def serialize_json(func: Callable, response_model: Any):
+    """
+    Encode the returned model to JSON bytes right away.
+    Otherwise FastAPI validates the model against response_model again,
+    converts it to jsonable data and encodes that with json module.
+    The schema of response_model is documented the same way
+    """
+    adapter = TypeAdapter(response_model)
+
+    @wraps(func)
+    async def _serialized(*args: Any, **kwargs: Any):
+        result = await func(*args, **kwargs)
+        if isinstance(result, fastapi.Response):
+            return result
+        return JsonBytesResponse(adapter.dump_json(result, by_alias=True))
+
+    return _serialized
+
+
+StreamFormat = Literal["ndjson", "sse"]
+
+_STREAM_TYPES = (
+    collections.abc.AsyncIterator,
+    collections.abc.AsyncIterable,
+    collections.abc.AsyncGenerator,
+)
+
+
+def stream_item_type(return_type: Any) -> Any | None:
+    """
+    Type of items of AsyncIterator[...] return type, None for other types
+    """
+    if get_origin(return_type) in _STREAM_TYPES:
+        return get_args(return_type)[0]
+    return None
+
+
+class StreamedItems(StreamingResponse, abc.ABC):
+    """
+    Items of a streaming endpoint, one JSON document per NDJSON line or SSE event.
+    Subclasses define the media type and `_frame` of every item.
+
+    Every item is sent as soon as it is produced, and the next one is not
+    requested until the server has accepted the previous one (the server
+    waits while the client does not read), so the whole result is never
+    in memory. An error raised after the response has started is sent
+    as the last line (or `error` event) with UserError body,
+    its status code cannot be sent anymore
+    """
+
+    def __init__(
+        self,
+        first: Any,
+        items: AsyncIterator[Any],
+        adapter: TypeAdapter,
+        status_code: int = 200,
+    ) -> None:
+        self.on_error: Callable[[Exception], JsonBytesResponse] | None = None
+        self._adapter = adapter
+        super().__init__(self._encode(first, items), status_code)
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        # Fail when the class is defined, not when its first response is sent
+        if getattr(cls._frame, "__isabstractmethod__", False):
+            raise TypeError(f"{cls.__name__} must define _frame")
+
+    @staticmethod
+    @abstractmethod
+    def _frame(body: bytes, event: bytes | None = None) -> bytes:
+        """
+        Frame of one item, `event` is the SSE event name
+        """
+
+    async def _encode(self, first: Any, items: AsyncIterator[Any]):
+        dump_json = self._adapter.dump_json
+        try:
+            yield self._frame(dump_json(first, by_alias=True))
+            async for item in items:
+                yield self._frame(dump_json(item, by_alias=True))
+        except Exception as exc:
+            if self.on_error is None:
+                raise
+            yield self._frame(self.on_error(exc).body, b"error")
+        finally:
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+class NdjsonItems(StreamedItems):
+    media_type = "application/x-ndjson"
+
+    @staticmethod
+    def _frame(body: bytes, event: bytes | None = None) -> bytes:
+        return body + b"\n"
+
+
+class EventStreamItems(StreamedItems):
+    media_type = "text/event-stream"
+
+    @staticmethod
+    def _frame(body: bytes, event: bytes | None = None) -> bytes:
+        if event is None:
+            return b"data: " + body + b"\n\n"
+        return b"event: " + event + b"\ndata: " + body + b"\n\n"
+
+
+_STREAM_RESPONSES: dict[str, type[StreamedItems]] = {
+    "ndjson": NdjsonItems,
+    "sse": EventStreamItems,
+}
+
+
+def stream_items(func: Callable, item_type: Any, response_class: type[StreamedItems]):
+    """
+    Stream items of the async generator function.
+    The first item is awaited before the response starts: errors raised
+    until then are responded with their status code
+    """
+    adapter = TypeAdapter(item_type)
+
+    async def _streamed(*args: Any, **kwargs: Any):
+        items = aiter(func(*args, **kwargs))
+        try:
+            first = await anext(items)
+        except StopAsyncIteration:
+            return fastapi.Response(media_type=response_class.media_type)
+        return response_class(first, items, adapter)
+
+    # Not functools.wraps: FastAPI would find the generator function
+    # by __wrapped__ and stream it on its own
+    _streamed.__name__ = func.__name__
+    _streamed.__doc__ = func.__doc__
+    _streamed.__signature__ = inspect.signature(func).replace(  # type: ignore
+        return_annotation=inspect.Signature.empty
+    )
+    return _streamed
+
+
+def batch_call(endpoint: Callable, signature: inspect.Signature, response_model: Any):
+    """
+    Call of the registered endpoint with parameters of a batch operation.
+    Parameters are validated against the signature of the API method,
+    the call responds as the endpoint would, errors included
+    """
+    fields: dict[str, Any] = {}
+    for name, parameter in signature.parameters.items():
+        annotation = parameter.annotation
+        default = parameter.default
+        fields[name] = (
+            Any if annotation is parameter.empty else annotation,
+            ... if default is parameter.empty else default,
+        )
+    params_model = create_model(f"{endpoint.__name__}_params", **fields)
+    adapter = TypeAdapter(response_model)
+
+    async def _call(params: dict[str, Any]) -> fastapi.Response:
+        try:
+            kwargs = dict(params_model.model_validate(params))
+        except ValidationError as exc:
+            return _VALIDATION_ERROR.response(str(exc), 422)
+        result = await endpoint(**kwargs)
+        if isinstance(result, fastapi.Response):
+            return result
+        # Validated response models are encoded by FastAPI for HTTP requests
+        return JsonBytesResponse(adapter.dump_json(result, by_alias=True))
+
+    return _call
+
+
+# Keyword argument that receives the client timeout header
+_REQUEST_TIMEOUT = "_request_timeout"
+
+
+def enforce_deadline(func: Callable, timeout: float | None):
+    """
+    Cancel the call when the request deadline passes and raise DeadlineExceeded.
+    The deadline is the smallest of the route timeout and the client timeout,
+    it is available to the function through deadline.remaining()
+    """
+
+    @wraps(func)
+    async def _with_deadline(*args: Any, **kwargs: Any):
+        budgets = [
+            budget
+            for budget in (
+                timeout,
+                parse_timeout_ms(kwargs.pop(_REQUEST_TIMEOUT, None)),
+                remaining(),
+            )
+            if budget is not None
+        ]
+        if not budgets:
+            return await func(*args, **kwargs)
+
+        budget = min(budgets)
+        if budget <= 0:
+            raise DeadlineExceeded("Request deadline has already passed")
+
+        token = DEADLINE.set(time.monotonic() + budget)
+        try:
+            async with asyncio.timeout(budget) as scope:
+                return await func(*args, **kwargs)
+        except TimeoutError:
+            # Timeouts of the function itself are not ours to handle
+            if not scope.expired():
+                raise
+            raise DeadlineExceeded(
+                f"Request did not complete in {budget:.3f} seconds"
+            ) from None
+        finally:
+            DEADLINE.reset(token)
+
+    _add_header_parameter(_with_deadline, _REQUEST_TIMEOUT, DEADLINE_HEADER)
+
+    return _with_deadline
+
+
 class EchoResponse(BaseModel):
     text: str
 
@@ -164,10 +520,14 @@ class ApiSection:
     Registers methods in given router with specified prefix and tag
     """
 
-    def __init__(self, router: APIRouter, prefix: str, tag: str):
+    def __init__(
+        self, router: APIRouter, prefix: str, tag: str, batch: Batch | None = None
+    ):
         self.router = router
         self.prefix = prefix
         self.tag = tag
+        # Operations available in POST /batch, if enabled
+        self.batch = batch
 
     def register(
         self,
@@ -176,18 +536,96 @@ class ApiSection:
         endpoint: Any,
         *exceptions: Type[Exception],
         deprecated: bool = False,
+        cache: CachePolicy | None = None,
+        single_flight: bool = False,
+        timeout: float | None = None,
+        validate_response: bool = False,
+        stream_format: StreamFormat = "ndjson",
+        response_model: Any = None,
     ):
-        endpoint = expect_exceptions(endpoint, exceptions)
-        response_model = get_type_hints(endpoint)["return"]
+        """
+        Register endpoint, mapping the exceptions to UserError responses.
+
+        timeout limits time of the endpoint in seconds,
+        clients can set a shorter one with X-Request-Timeout-Ms header.
+
+        Returned models are trusted and encoded to JSON as is,
+        validate_response makes FastAPI validate and encode them instead.
+
+        Async generator methods returning AsyncIterator[Model] stream their
+        items as NDJSON lines or server-sent events, see StreamedItems.
+        Their timeout limits the time to the first item
+
+        Endpoints with response models are also available as operations
+        of POST /batch, see batch.py. Streamed and raw responses are not,
+        batches with them are rejected with 422.
+
+        response_model documents endpoints returning already encoded
+        fastapi.Response, by default it is the return type of the endpoint
+        """
+        if response_model is None:
+            response_model = get_type_hints(endpoint)["return"]
+        signature = inspect.signature(endpoint)
 
         if isinstance(response_model, type) and issubclass(
             response_model, fastapi.Response
         ):
             response_model = None
 
-        additional_responses = getattr(endpoint, "additional_responses", None)
-
         path_with_prefix = f"{self.prefix.rstrip('/')}{'/' if path else ''}{path}"
+
+        item_type = stream_item_type(response_model)
+        stream_responses: dict[int | str, dict[str, Any]] = {}
+        route_options: dict[str, Any] = {}
+        if item_type is not None:
+            if cache is not None or single_flight:
+                raise ValueError(
+                    f"Cannot cache or coalesce streamed responses of {path_with_prefix}"
+                )
+            response_class = _STREAM_RESPONSES[stream_format]
+            endpoint = stream_items(endpoint, item_type, response_class)
+            response_model = None
+            route_options["response_class"] = response_class
+            # Schema of one item, documented under the media type of the stream
+            stream_responses[200] = {
+                "model": item_type,
+                "description": f"Stream of items, one per {stream_format} record",
+            }
+
+        if cache is not None:
+            if response_model is None:
+                raise ValueError(f"Cannot cache raw responses of {path_with_prefix}")
+            endpoint = cache_responses(
+                endpoint,
+                response_model,
+                ResponseCache(f"{method} {path_with_prefix}", cache),
+            )
+        elif single_flight:
+            # Cached endpoints already coalesce concurrent calls
+            endpoint = coalesce_calls(endpoint)
+
+        exceptions = (*exceptions, DeadlineExceeded)
+        if getattr(endpoint, "offload", None):
+            # Methods marked with executors.offload
+            exceptions = (*exceptions, ExecutorBusy)
+
+        endpoint = enforce_deadline(endpoint, timeout)
+        if response_model is not None and cache is None and not validate_response:
+            # Cached endpoints already return encoded responses
+            endpoint = serialize_json(endpoint, response_model)
+        endpoint = expect_exceptions(endpoint, exceptions)
+
+        if self.batch is not None and response_model is not None:
+            self.batch.add(
+                f"{method} {path_with_prefix}",
+                batch_call(endpoint, signature, response_model),
+            )
+
+        additional_responses = {
+            **getattr(endpoint, "additional_responses", {}),
+            **stream_responses,
+        }
+
         self.router.add_api_route(
             path_with_prefix,
             endpoint,
@@ -198,20 +636,54 @@ class ApiSection:
             description=None,
             responses=additional_responses,
             deprecated=deprecated,
+            **route_options,
         )
 
 
-def make_router(api: Api) -> APIRouter:
+def make_router(api: Api, batch_settings: BatchSettings | None = None) -> APIRouter:
     router = APIRouter()
+    batch = Batch(batch_settings) if batch_settings is not None else None
 
     @contextmanager
     def section(prefix: str, tag: str) -> Generator[ApiSection, None, None]:
-        yield ApiSection(router, prefix, tag)
+        yield ApiSection(router, prefix, tag, batch)
 
     # Add new API routes here
+    #
+    # Idempotent endpoints can be cached, e.g.
+    # sec.register("GET", "", api.echo, EchoError, cache=CachePolicy(ttl=60))
+    # or only share concurrent calls with the same arguments
+    # sec.register("GET", "", api.echo, EchoError, single_flight=True)
+    #
+    # Slow endpoints should declare their timeout, seconds:
+    # sec.register("GET", "", api.echo, EchoError, timeout=5)
+    #
+    # Blocking and CPU-bound methods are offloaded from the event loop
+    # with @executors.offload("thread") or @executors.offload("process")
+    #
+    # Returned models are encoded without validation, models built from
+    # data of other services can be validated by FastAPI:
+    # sec.register("GET", "", api.echo, EchoError, validate_response=True)
+    #
+    # Large results are streamed by async generator methods
+    # returning AsyncIterator[Model], as NDJSON or server-sent events:
+    # sec.register("GET", "/export", api.export, EchoError, stream_format="sse")
+    #
+    # Endpoints returning models are also available in POST /batch,
+    # if it is enabled (BATCH=true)
     with section("/echo", "echo") as sec:
         sec.register("GET", "", api.echo, EchoError)
 
+    if batch:
+        # Added last: its request model lists the operations registered above
+        ApiSection(router, "/batch", "batch").register(
+            "POST",
+            "",
+            batch.endpoint(),
+            timeout=batch.settings.timeout,
+            response_model=BatchResponse,
+        )
+
     return router
 
 
@@ -0,0 +1,288 @@
+"""
+Tests for API specification helpers
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator
+
+import fastapi
+import httpx
+import pytest
+from fastapi import APIRouter, FastAPI
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field
+from starlette.types import Message
+
+from .spec import (
+    ApiSection,
+    EchoError,
+    EchoResponse,
+    StreamedItems,
+    UserError,
+    default_validation_exception_handler,
+    expect_exceptions,
+)
+
+logger = logging.getLogger(__name__)
+
+DETAILS = [
+    "",
+    "plain detail",
+    'quotes " \\ slashes / unicode é 😀 controls \x00\x1f\x7f\b\f\n\r\t',
+]
+
+
+def _legacy_error_response(exc: Exception, status_code: int) -> fastapi.Response:
+    return fastapi.Response(
+        UserError(error=exc.__class__.__name__, detail=str(exc)).model_dump_json(),
+        headers={"Content-Type": "application/json"},
+        status_code=status_code,
+    )
+
+
+def _wire(response: fastapi.Response) -> tuple[int, list[tuple[bytes, bytes]], bytes]:
+    return response.status_code, response.headers.raw, bytes(response.body)
+
+
+class EchoSubclassError(EchoError):
+    status_code = 409
+
+
+async def _failing_echo(request: str) -> None:
+    raise {
+        "echo": EchoError(request),
+        "subclass": EchoSubclassError(request),
+    }[request.split(":")[0]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("detail", DETAILS)
+async def test_expected_error_response(detail: str):
+    endpoint = expect_exceptions(_failing_echo, (EchoError,))
+
+    response = await endpoint(f"echo:{detail}")
+    expected = _legacy_error_response(EchoError(f"echo:{detail}"), 400)
+    assert _wire(response) == _wire(expected)
+
+    response = await endpoint(f"subclass:{detail}")
+    expected = _legacy_error_response(EchoSubclassError(f"subclass:{detail}"), 409)
+    assert _wire(response) == _wire(expected)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("detail", DETAILS)
+async def test_validation_error_response(detail: str):
+    exc = RequestValidationError([{"msg": detail}])
+    response = await default_validation_exception_handler(None, exc)  # type: ignore
+    assert _wire(response) == _wire(_legacy_error_response(exc, 422))
+
+
+@pytest.mark.asyncio
+async def test_error_response_reused():
+    """
+    Writers of error responses are shared by requests, responses do not leak
+    into each other. Their throughput is tracked by the echo_error and
+    validation_error scenarios of `{{cookiecutter.__project_kebab}} bench`
+    """
+    endpoint = expect_exceptions(_failing_echo, (EchoError,))
+    for detail in DETAILS * 2:
+        response = await endpoint(f"echo:{detail}")
+        expected = _legacy_error_response(EchoError(f"echo:{detail}"), 400)
+        assert _wire(response) == _wire(expected)
+
+        exc = RequestValidationError([{"msg": detail}])
+        response = await default_validation_exception_handler(None, exc)  # type: ignore
+        assert _wire(response) == _wire(_legacy_error_response(exc, 422))
+
+
+class Item(BaseModel):
+    item_id: int = Field(alias="itemId")
+    created: datetime
+
+
+class ItemsResponse(BaseModel):
+    items: list[Item]
+    next_page: str | None = None
+
+
+class ModelsApi:
+    async def echo(self, request: str) -> EchoResponse:
+        return EchoResponse(text=request)
+
+    async def items(self, request: str) -> ItemsResponse:
+        """List items"""
+        if request == "error":
+            raise EchoError("no items")
+        created = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        return ItemsResponse(
+            items=[
+                Item(itemId=i, created=created)  # type: ignore
+                for i in range(int(request))
+            ]
+        )
+
+
+def _models_app(validate_response: bool) -> FastAPI:
+    api = ModelsApi()
+    router = APIRouter()
+    for path, endpoint in (("/echo", api.echo), ("/items", api.items)):
+        ApiSection(router, path, path.strip("/")).register(
+            "GET", "", endpoint, EchoError, validate_response=validate_response
+        )
+    app = FastAPI()
+    app.include_router(router)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_serialized_response():
+    responses = {}
+    for validate_response in (False, True):
+        transport = httpx.ASGITransport(_models_app(validate_response))
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            responses[validate_response] = [
+                await client.get("/items", params={"request": "3"}),
+                await client.get("/items", params={"request": "error"}),
+                await client.get("/items"),
+            ]
+
+    for response, validated in zip(responses[False], responses[True], strict=True):
+        assert response.status_code == validated.status_code
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == validated.json()
+
+    items = responses[False][0].json()["items"]
+    assert items[0] == {"itemId": 0, "created": "2024-01-02T03:04:05Z"}
+
+
+def test_serialized_response_documented():
+    assert _models_app(False).openapi() == _models_app(True).openapi()
+
+
+class StreamingApi:
+    def __init__(self) -> None:
+        self.produced = 0
+
+    async def export(self, request: str) -> AsyncIterator[Item]:
+        """Export items"""
+        if request == "early":
+            raise EchoError("nothing to export")
+        created = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        for i in range(3):
+            self.produced += 1
+            yield Item(itemId=i, created=created)  # type: ignore
+        if request == "late":
+            raise EchoError("export interrupted")
+        if request == "crash":
+            raise ValueError("unexpected")
+
+    async def empty(self) -> AsyncIterator[Item]:
+        return
+        yield
+
+
+def _streaming_app(api: StreamingApi, stream_format: Any = "ndjson") -> FastAPI:
+    router = APIRouter()
+    section = ApiSection(router, "/export", "export")
+    section.register("GET", "", api.export, EchoError, stream_format=stream_format)
+    section.register("GET", "empty", api.empty, stream_format=stream_format)
+    app = FastAPI()
+    app.include_router(router)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_streamed_items():
+    transport = httpx.ASGITransport(_streaming_app(StreamingApi()))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        complete = await client.get("/export", params={"request": "all"})
+        early = await client.get("/export", params={"request": "early"})
+        late = await client.get("/export", params={"request": "late"})
+        crash = await client.get("/export", params={"request": "crash"})
+        empty = await client.get("/export/empty")
+
+    assert complete.status_code == 200
+    assert complete.headers["content-type"] == "application/x-ndjson"
+    lines = complete.text.splitlines()
+    assert lines[0] == '{"itemId":0,"created":"2024-01-02T00:00:00Z"}'
+    assert len(lines) == 3
+
+    # Errors before the first item keep their status code
+    assert early.status_code == 400
+    assert early.json() == {"error": "EchoError", "detail": "nothing to export"}
+
+    # Errors after it end the stream with UserError
+    assert late.status_code == 200
+    lines = late.text.splitlines()
+    assert len(lines) == 4
+    assert lines[-1] == '{"error":"EchoError","detail":"export interrupted"}'
+    assert crash.text.splitlines()[-1].startswith('{"error":"Internal server error"')
+
+    assert empty.status_code == 200
+    assert empty.content == b""
+
+
+@pytest.mark.asyncio
+async def test_streamed_events():
+    transport = httpx.ASGITransport(_streaming_app(StreamingApi(), "sse"))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/export", params={"request": "late"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = response.text.split("\n\n")
+    assert events[0] == 'data: {"itemId":0,"created":"2024-01-02T00:00:00Z"}'
+    assert events[3] == (
+        'event: error\ndata: {"error":"EchoError","detail":"export interrupted"}'
+    )
+
+
+@pytest.mark.asyncio
+async def test_streamed_items_backpressure():
+    api = StreamingApi()
+    app = _streaming_app(api)
+    produced_at_send: list[int] = []
+
+    async def receive() -> Message:
+        await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        if message["type"] == "http.response.body":
+            produced_at_send.append(api.produced)
+            # Slow client
+            await asyncio.sleep(0.01)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/export",
+        "query_string": b"request=all",
+        "headers": [],
+    }
+    await app(scope, receive, send)
+
+    # Every item is sent before the next one is produced
+    assert produced_at_send == [1, 2, 3, 3]
+
+
+def test_streamed_items_documented():
+    schema = _streaming_app(StreamingApi()).openapi()
+    responses = schema["paths"]["/export"]["get"]["responses"]
+    content = responses["200"]["content"]
+    assert list(content) == ["application/x-ndjson"]
+    assert content["application/x-ndjson"]["schema"]["$ref"] == (
+        "#/components/schemas/Item"
+    )
+    assert "400" in responses
+    assert "Item" in schema["components"]["schemas"]
+
+
+def test_streamed_items_frame_required():
+    with pytest.raises(TypeError, match="_frame"):
+
+        class NoFrameItems(StreamedItems):
+            media_type = "application/x-ndjson"
@@ -0,0 +1,732 @@
+"""
+Load-testing of the application
+
+Drives the full application stack (middlewares, exception handling, API)
+with concurrent requests and reports latency percentiles and throughput.
+
+Two transports are available:
+- asgi: calls the ASGI application directly, measures the cost of the app itself
+- socket: starts uvicorn on a local port and sends real HTTP/1.1 requests
+  over keep-alive connections, adds the cost of the server and the network stack
+
+Client and server share one event loop, so the numbers are meant
+for comparing runs on the same machine, not as capacity estimates.
+
+Comparisons measure operations/sec of single components against their
+previous or alternative implementation, e.g. the tracking middleware
+against the BaseHTTPMiddleware it replaced.
+Use `{{cookiecutter.__project_kebab}} bench --help` to run it from the console.
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+import math
+import platform
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Protocol
+
+from {{cookiecutter.__project_slug}}.workers import bind_socket
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "Scenario",
+    "ScenarioResult",
+    "Comparison",
+    "ComparisonResult",
+    "BenchmarkResult",
+    "DEFAULT_SCENARIOS",
+    "default_comparisons",
+    "AsgiTransport",
+    "SocketTransport",
+    "run_scenario",
+    "run_benchmark",
+    "run_comparisons",
+    "compare",
+]
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    # Path with query string
+    path: str
+    expected_status: int
+    method: str = "GET"
+
+
+# Failed connections and malformed responses, counted as errors
+_REQUEST_ERRORS = (OSError, asyncio.IncompleteReadError, ValueError)
+
+DEFAULT_SCENARIOS = [
+    # Middleware and routing
+    Scenario("health", "/health", 200),
+    # Response models encoded by the endpoint
+    Scenario("echo", "/echo?request=hello", 200),
+    # Precompiled UserError responses
+    Scenario("echo_error", "/echo?request=error", 400),
+    Scenario("validation_error", "/echo", 422),
+]
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values, q in [0, 100]
+    """
+    if not sorted_values:
+        return 0.0
+    n = len(sorted_values)
+    rank = max(0, min(n - 1, math.ceil(q / 100 * n) - 1))
+    return sorted_values[rank]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int
+    # Requests with unexpected status or failed connection
+    errors: int
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+    @classmethod
+    def from_latencies(
+        cls, name: str, latencies: list[float], errors: int, duration: float
+    ) -> "ScenarioResult":
+        latencies = sorted(latencies)
+        return cls(
+            name=name,
+            requests=len(latencies),
+            errors=errors,
+            rps=len(latencies) / duration if duration > 0 else 0.0,
+            p50_ms=percentile(latencies, 50) * 1000,
+            p95_ms=percentile(latencies, 95) * 1000,
+            p99_ms=percentile(latencies, 99) * 1000,
+            max_ms=latencies[-1] * 1000 if latencies else 0.0,
+        )
+
+
+# One operation of a comparison, sync or async
+Operation = Callable[[], Awaitable[object] | object]
+
+
+@dataclass(frozen=True)
+class Comparison:
+    name: str
+    # Previous or alternative implementation
+    baseline_name: str
+    baseline: Operation
+    current_name: str
+    current: Operation
+    # Operations per round if they are too slow for the default number
+    operations: int | None = None
+
+
+@dataclass
+class ComparisonResult:
+    name: str
+    baseline_name: str
+    current_name: str
+    # Operations/sec, best of the rounds
+    baseline_ops: float
+    current_ops: float
+
+    @property
+    def speedup(self) -> float:
+        return self.current_ops / self.baseline_ops if self.baseline_ops else 0.0
+
+
+@dataclass
+class BenchmarkResult:
+    transport: str
+    concurrency: int
+    scenarios: dict[str, ScenarioResult]
+    comparisons: dict[str, ComparisonResult] = field(default_factory=dict)
+    python: str = field(default_factory=platform.python_version)
+    created_at: float = field(default_factory=time.time)
+
+    def to_json(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "BenchmarkResult":
+        scenarios = {
+            name: ScenarioResult(**scenario)
+            for name, scenario in data["scenarios"].items()
+        }
+        # Missing in results saved before comparisons were added
+        comparisons = {
+            name: ComparisonResult(**comparison)
+            for name, comparison in data.get("comparisons", {}).items()
+        }
+        return cls(**{**data, "scenarios": scenarios, "comparisons": comparisons})
+
+    def save(self, path: Path) -> None:
+        path.write_text(json.dumps(self.to_json(), indent=2))
+
+    @classmethod
+    def load(cls, path: Path) -> "BenchmarkResult":
+        return cls.from_json(json.loads(path.read_text()))
+
+    def format_table(self) -> str:
+        lines = [
+            f"{'scenario':<20}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}"
+            f"{'p99 ms':>10}{'errors':>8}"
+        ]
+        for result in self.scenarios.values():
+            lines.append(
+                f"{result.name:<20}{result.rps:>10.0f}{result.p50_ms:>10.2f}"
+                f"{result.p95_ms:>10.2f}{result.p99_ms:>10.2f}{result.errors:>8}"
+            )
+        if self.comparisons:
+            lines.append("")
+            lines.append(f"{'comparison':<20}{'ops/s':>10}{'baseline':>10}{'x':>8}")
+        for comparison in self.comparisons.values():
+            lines.append(
+                f"{comparison.name:<20}{comparison.current_ops:>10.0f}"
+                f"{comparison.baseline_ops:>10.0f}{comparison.speedup:>8.2f}"
+                f"  {comparison.current_name} vs {comparison.baseline_name}"
+            )
+        return "\n".join(lines)
+
+
+class Transport(Protocol):
+    async def request(self, method: str, path: str) -> int:
+        """Send request and return response status code"""
+        ...
+
+
+class AsgiTransport:
+    """
+    Calls ASGI application in-process, without a server
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[None]]):
+        self.app = app
+
+    async def request(self, method: str, path: str) -> int:
+        raw_path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": raw_path,
+            "raw_path": raw_path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        status = 0
+
+        async def receive() -> dict[str, Any]:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message: dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        await self.app(scope, receive, send)
+        return status
+
+
+class _Connection:
+    """
+    Minimal HTTP/1.1 keep-alive client connection
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def request(self, method: str, path: str, host: str) -> int:
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b"\r\n")
+        status = int(status_line.split(b" ", 2)[1])
+
+        content_length = 0
+        chunked = False
+        while (line := await self.reader.readuntil(b"\r\n")) != b"\r\n":
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                content_length = int(value)
+            elif name == b"transfer-encoding" and b"chunked" in value.lower():
+                chunked = True
+
+        if chunked:
+            while size := int(
+                (await self.reader.readuntil(b"\r\n")).split(b";")[0], 16
+            ):
+                await self.reader.readexactly(size + 2)
+            # Trailer section ends with an empty line
+            while await self.reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+        elif content_length:
+            await self.reader.readexactly(content_length)
+
+        return status
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class SocketTransport:
+    """
+    Sends requests over pooled keep-alive connections to a running server
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._idle: list[_Connection] = []
+
+    async def request(self, method: str, path: str) -> int:
+        if self._idle:
+            connection = self._idle.pop()
+        else:
+            connection = _Connection(
+                *await asyncio.open_connection(self.host, self.port)
+            )
+
+        try:
+            status = await connection.request(method, path, f"{self.host}:{self.port}")
+        except BaseException:
+            connection.close()
+            raise
+
+        self._idle.append(connection)
+        return status
+
+    def close(self) -> None:
+        for connection in self._idle:
+            connection.close()
+        self._idle.clear()
+
+
+async def run_scenario(
+    transport: Transport,
+    scenario: Scenario,
+    requests: int,
+    concurrency: int,
+    warmup: int = 0,
+) -> ScenarioResult:
+    """
+    Send `requests` requests from `concurrency` concurrent clients
+    """
+    latencies: list[float] = []
+    errors = 0
+
+    async def send(n_requests: int, measured: bool) -> None:
+        remaining = n_requests
+
+        async def client() -> None:
+            nonlocal errors, remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    status = await transport.request(scenario.method, scenario.path)
+                except _REQUEST_ERRORS:
+                    logger.exception("Request %s failed", scenario.name)
+                    status = 0
+                latency = time.perf_counter() - start
+                if not measured:
+                    continue
+                if status == scenario.expected_status:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+        await asyncio.gather(*[client() for _ in range(min(concurrency, n_requests))])
+
+    # Warm up caches and open connections before measuring
+    await send(warmup, measured=False)
+    start = time.perf_counter()
+    await send(requests, measured=True)
+    duration = time.perf_counter() - start
+
+    return ScenarioResult.from_latencies(scenario.name, latencies, errors, duration)
+
+
+async def _run_scenarios(
+    transport: Transport,
+    scenarios: list[Scenario],
+    requests: int,
+    concurrency: int,
+    warmup: int,
+) -> dict[str, ScenarioResult]:
+    results = {}
+    for scenario in scenarios:
+        results[scenario.name] = await run_scenario(
+            transport, scenario, requests, concurrency, warmup
+        )
+        logger.debug("Scenario %s done", scenario.name)
+    return results
+
+
+async def run_benchmark(
+    app: Callable[..., Awaitable[None]],
+    transport: str = "asgi",
+    scenarios: list[Scenario] | None = None,
+    requests: int = 2000,
+    concurrency: int = 10,
+    warmup: int = 100,
+) -> BenchmarkResult:
+    """
+    Benchmark the application with every scenario one after another
+    """
+    import uvicorn
+
+    scenarios = DEFAULT_SCENARIOS if scenarios is None else scenarios
+
+    if transport == "asgi":
+        results = await _run_scenarios(
+            AsgiTransport(app), scenarios, requests, concurrency, warmup
+        )
+        return BenchmarkResult(transport, concurrency, results)
+
+    if transport != "socket":
+        raise ValueError(f"Unknown transport {transport!r}, expected asgi or socket")
+
+    # Same listening socket as in multi-worker mode
+    sock = bind_socket("127.0.0.1", 0)
+    host, port = sock.getsockname()
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, log_config=None, access_log=False, lifespan="off")
+    )
+    serving = asyncio.ensure_future(server.serve(sockets=[sock]))
+    client = SocketTransport(host, port)
+    try:
+        while not server.started:
+            if serving.done():
+                # Propagate startup error
+                serving.result()
+            await asyncio.sleep(0.01)
+        results = await _run_scenarios(client, scenarios, requests, concurrency, warmup)
+    finally:
+        client.close()
+        server.should_exit = True
+        await serving
+        sock.close()
+
+    return BenchmarkResult(transport, concurrency, results)
+
+
+async def _operations_per_second(operation: Operation, operations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(operations):
+        result = operation()
+        if inspect.isawaitable(result):
+            await result
+    return operations / (time.perf_counter() - start)
+
+
+async def run_comparisons(
+    comparisons: list[Comparison], operations: int = 2000, rounds: int = 5
+) -> dict[str, ComparisonResult]:
+    """
+    Run both implementations of every comparison in alternating rounds,
+    the best round of each evens out noise of other processes
+    """
+    results = {}
+    for comparison in comparisons:
+        n_operations = min(operations, comparison.operations or operations)
+        baseline_ops = current_ops = 0.0
+        for _ in range(rounds):
+            baseline_ops = max(
+                baseline_ops,
+                await _operations_per_second(comparison.baseline, n_operations),
+            )
+            current_ops = max(
+                current_ops,
+                await _operations_per_second(comparison.current, n_operations),
+            )
+        results[comparison.name] = ComparisonResult(
+            comparison.name,
+            comparison.baseline_name,
+            comparison.current_name,
+            baseline_ops,
+            current_ops,
+        )
+        logger.debug("Comparison %s done", comparison.name)
+    return results
+
+
+def _tracking_middleware() -> Comparison:
+    from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+    from starlette.requests import Request
+    from starlette.responses import Response
+
+    from {{cookiecutter.__project_slug}}.slog import logging_context
+    from {{cookiecutter.__project_slug}}.tracking import (
+        RequestView,
+        TrackingMiddleware,
+    )
+
+    class BaseHTTPTrackingMiddleware(BaseHTTPMiddleware):
+        """
+        Previous implementation of the tracking middleware
+        """
+
+        async def dispatch(
+            self, request: Request, call_next: RequestResponseEndpoint
+        ) -> Response:
+            request_view = RequestView(request.scope)
+
+            with logging_context(request_id=request_view.request_id):
+                start_time = asyncio.get_running_loop().time()
+                response = await call_next(request)
+                end_time = asyncio.get_running_loop().time()
+
+                logging.getLogger(TrackingMiddleware.__module__).info(
+                    "%s %s %s",
+                    request_view.method,
+                    request_view.url_path,
+                    request_view.http_version,
+                    extra={
+                        "httpRequest": {
+                            "requestMethod": request_view.method,
+                            "requestUrl": request_view.url_path,
+                            "remoteIp": request_view.client_addr,
+                            "protocol": request_view.http_version,
+                            "userAgent": request_view.user_agent,
+                            "requestSize": request_view.content_length,
+                            "responseSize": response.headers.get("Content-Length"),
+                            "latency": f"{round(end_time - start_time, 6)}s",
+                            "status": response.status_code,
+                        }
+                    },
+                )
+
+            return response
+
+    response = Response("OK")
+    legacy = AsgiTransport(BaseHTTPTrackingMiddleware(response))
+    current = AsgiTransport(TrackingMiddleware(response))
+    return Comparison(
+        "tracking",
+        "BaseHTTPMiddleware",
+        lambda: legacy.request("GET", "/"),
+        "TrackingMiddleware",
+        lambda: current.request("GET", "/"),
+    )
+
+
+def _tracing() -> Comparison:
+    from starlette.responses import Response
+
+    from {{cookiecutter.__project_slug}}.tracing import RequestTracer, TracingPolicy
+    from {{cookiecutter.__project_slug}}.tracking import TrackingMiddleware
+
+    response = Response("OK")
+    policy = TracingPolicy(sample_rate=0.01, slow_threshold=1.0, keep_errors=True)
+    untraced = AsgiTransport(TrackingMiddleware(response))
+    # Never sampled: the cost every request pays with tracing enabled
+    not_sampled = AsgiTransport(
+        TrackingMiddleware(response, RequestTracer(policy, random=lambda: 1))
+    )
+    return Comparison(
+        "tracing",
+        "disabled",
+        lambda: untraced.request("GET", "/"),
+        "not_sampled",
+        lambda: not_sampled.request("GET", "/"),
+    )
+
+
+def _response_serialization() -> Comparison:
+    from fastapi import APIRouter, FastAPI
+
+    from {{cookiecutter.__project_slug}}.api.spec import (
+        ApiSection,
+        EchoError,
+        EchoResponse,
+    )
+
+    async def echo(request: str) -> EchoResponse:
+        return EchoResponse(text=request)
+
+    def echo_app(validate_response: bool) -> AsgiTransport:
+        router = APIRouter()
+        ApiSection(router, "/echo", "echo").register(
+            "GET", "", echo, EchoError, validate_response=validate_response
+        )
+        app = FastAPI()
+        app.include_router(router)
+        return AsgiTransport(app)
+
+    validated = echo_app(validate_response=True)
+    serialized = echo_app(validate_response=False)
+    return Comparison(
+        "echo_serialization",
+        "validated",
+        lambda: validated.request("GET", "/echo?request=hello"),
+        "model_dump_json",
+        lambda: serialized.request("GET", "/echo?request=hello"),
+    )
+
+
+def _startup() -> Comparison:
+    from {{cookiecutter.__project_slug}}.main import make_app
+
+    return Comparison(
+        "startup",
+        "eager_openapi",
+        lambda: make_app("").openapi(),
+        "lazy_openapi",
+        lambda: make_app(""),
+        operations=20,
+    )
+
+
+def _log_record() -> logging.LogRecord:
+    return logging.LogRecord(
+        "bench", logging.INFO, __file__, 1, "test %s", ("message",), None
+    )
+
+
+def _legacy_local_timestamp_to_utc(local_unix_timestamp: float) -> str:
+    from datetime import datetime, timezone
+
+    return (
+        datetime.fromtimestamp(local_unix_timestamp)
+        .astimezone()
+        .astimezone(timezone.utc)
+        .strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    )
+
+
+def _log_formatter() -> Comparison:
+    from {{cookiecutter.__project_slug}}.slog import GcpStructuredFormatter
+
+    formatter = GcpStructuredFormatter()
+    compact_formatter = GcpStructuredFormatter(compact_json=True)
+    record = _log_record()
+
+    def legacy() -> str:
+        # Timestamps change every microsecond as in real logs
+        record.created += 0.000001
+        return json.dumps(
+            {
+                "severity": record.levelname,
+                "message": record.getMessage(),
+                "time": _legacy_local_timestamp_to_utc(record.created),
+                "logging.googleapis.com/labels": formatter._format_labels(record),
+            }
+        )
+
+    def current() -> str:
+        record.created += 0.000001
+        return compact_formatter.format(record)
+
+    return Comparison("log_formatter", "datetime+json", legacy, "json_compact", current)
+
+
+def _log_timestamps() -> Comparison:
+    from {{cookiecutter.__project_slug}}.slog import _local_timestamp_to_utc
+
+    record = _log_record()
+
+    def legacy() -> str:
+        record.created += 0.000001
+        return _legacy_local_timestamp_to_utc(record.created)
+
+    def current() -> str:
+        record.created += 0.000001
+        return _local_timestamp_to_utc(record.created)
+
+    return Comparison("log_timestamps", "datetime", legacy, "cached", current)
+
+
+def default_comparisons() -> list[Comparison]:
+    """
+    Comparisons of components with their previous implementation
+    """
+    return [
+        _tracking_middleware(),
+        _tracing(),
+        _response_serialization(),
+        _startup(),
+        _log_formatter(),
+        _log_timestamps(),
+    ]
+
+
+@dataclass(frozen=True)
+class Regression:
+    scenario: str
+    metric: str
+    baseline: float
+    current: float
+
+    def __str__(self) -> str:
+        message = (
+            f"{self.scenario}: {self.metric} {self.baseline:.2f} -> {self.current:.2f}"
+        )
+        if self.baseline:
+            change = (self.current - self.baseline) / self.baseline * 100
+            message += f" ({change:+.1f}%)"
+        return message
+
+
+def compare(
+    baseline: BenchmarkResult, current: BenchmarkResult, threshold: float = 0.1
+) -> list[Regression]:
+    """
+    Find scenarios where throughput dropped or latency grew more than threshold,
+    and comparisons where the current implementation got slower.
+    Scenarios and comparisons missing in one of the runs are ignored
+    """
+    if (baseline.transport, baseline.concurrency) != (
+        current.transport,
+        current.concurrency,
+    ):
+        raise ValueError(
+            "Cannot compare runs with different transport or concurrency: "
+            f"{baseline.transport}/{baseline.concurrency} "
+            f"and {current.transport}/{current.concurrency}"
+        )
+
+    regressions = []
+    for name, before in baseline.scenarios.items():
+        after = current.scenarios.get(name)
+        if after is None:
+            continue
+
+        if before.rps > 0 and after.rps < before.rps * (1 - threshold):
+            regressions.append(Regression(name, "rps", before.rps, after.rps))
+
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            before_value = getattr(before, metric)
+            after_value = getattr(after, metric)
+            if before_value > 0 and after_value > before_value * (1 + threshold):
+                regressions.append(Regression(name, metric, before_value, after_value))
+
+        if after.errors > before.errors:
+            regressions.append(Regression(name, "errors", before.errors, after.errors))
+
+    for name, before_comparison in baseline.comparisons.items():
+        after_comparison = current.comparisons.get(name)
+        if after_comparison is None:
+            continue
+        before_ops = before_comparison.current_ops
+        after_ops = after_comparison.current_ops
+        if before_ops > 0 and after_ops < before_ops * (1 - threshold):
+            regressions.append(Regression(name, "ops", before_ops, after_ops))
+
+    return regressions
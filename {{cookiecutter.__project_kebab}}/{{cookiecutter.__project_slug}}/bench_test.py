@@ -0,0 +1,174 @@
+"""
+Tests for load-testing tools
+"""
+
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from .bench import (
+    BenchmarkResult,
+    Comparison,
+    ComparisonResult,
+    Scenario,
+    ScenarioResult,
+    SocketTransport,
+    compare,
+    percentile,
+    run_comparisons,
+    run_scenario,
+)
+
+
+def _result(
+    rps: float = 1000, p99_ms: float = 10, errors: int = 0, created_at: float = 0
+) -> BenchmarkResult:
+    return BenchmarkResult(
+        "asgi",
+        10,
+        {
+            "echo": ScenarioResult(
+                name="echo",
+                requests=1000,
+                errors=errors,
+                rps=rps,
+                p50_ms=1,
+                p95_ms=5,
+                p99_ms=p99_ms,
+                max_ms=20,
+            )
+        },
+        created_at=created_at,
+    )
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([], 50) == 0
+    # Smallest value with at least q% of the values at or below it
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 50) == 3
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 0) == 1
+    assert percentile([1.0, 2.0], 51) == 2
+
+
+def test_compare():
+    baseline = _result()
+    assert compare(baseline, _result(rps=950, p99_ms=10.5)) == []
+
+    regressions = compare(baseline, _result(rps=800, p99_ms=15, errors=1))
+    assert [(r.scenario, r.metric) for r in regressions] == [
+        ("echo", "rps"),
+        ("echo", "p99_ms"),
+        ("echo", "errors"),
+    ]
+    assert str(regressions[0]) == "echo: rps 1000.00 -> 800.00 (-20.0%)"
+
+    socket_result = _result()
+    socket_result.transport = "socket"
+    with pytest.raises(ValueError):
+        compare(baseline, socket_result)
+
+
+def _comparison(current_ops: float) -> ComparisonResult:
+    return ComparisonResult("tracking", "old", "new", 1000, current_ops)
+
+
+def test_compare_comparisons():
+    baseline = _result()
+    baseline.comparisons["tracking"] = _comparison(2000)
+    current = _result()
+    current.comparisons["tracking"] = _comparison(1500)
+
+    regressions = compare(baseline, current)
+    assert [(r.scenario, r.metric) for r in regressions] == [("tracking", "ops")]
+    # Missing in the baseline run
+    assert compare(_result(), current) == []
+
+
+def test_save_load(tmp_path: Path):
+    result = _result()
+    result.comparisons["tracking"] = _comparison(2000)
+    result.save(tmp_path / "bench.json")
+    assert BenchmarkResult.load(tmp_path / "bench.json") == result
+
+    # Saved before comparisons were added
+    data = _result().to_json()
+    del data["comparisons"]
+    assert BenchmarkResult.from_json(data) == _result(created_at=data["created_at"])
+    assert "tracking" in result.format_table()
+
+
+@pytest.mark.asyncio
+async def test_run_comparisons():
+    calls = {"sync": 0, "async": 0}
+
+    def sync_operation() -> None:
+        calls["sync"] += 1
+
+    async def async_operation() -> None:
+        calls["async"] += 1
+
+    comparison = Comparison("fake", "sync", sync_operation, "async", async_operation)
+    results = await run_comparisons([comparison], operations=10, rounds=3)
+
+    assert calls == {"sync": 30, "async": 30}
+    # Slow operations run fewer times
+    slow = Comparison("slow", "sync", sync_operation, "async", async_operation, 4)
+    await run_comparisons([slow], operations=10, rounds=1)
+    assert calls == {"sync": 34, "async": 34}
+    result = results["fake"]
+    assert (result.baseline_name, result.current_name) == ("sync", "async")
+    assert result.baseline_ops > 0
+    assert result.speedup == result.current_ops / result.baseline_ops
+
+
+class FakeTransport:
+    def __init__(self) -> None:
+        self.requests = 0
+
+    async def request(self, method: str, path: str) -> int:
+        self.requests += 1
+        n_request = self.requests
+        await asyncio.sleep(0)
+        return 500 if n_request % 10 == 0 else 200
+
+
+@pytest.mark.asyncio
+async def test_run_scenario():
+    transport = FakeTransport()
+    result = await run_scenario(
+        transport, Scenario("fake", "/", 200), requests=100, concurrency=7, warmup=20
+    )
+
+    assert transport.requests == 120
+    assert result.requests + result.errors == 100
+    assert result.errors == 10
+    assert result.p50_ms <= result.p95_ms <= result.p99_ms <= result.max_ms
+
+
+@pytest.mark.asyncio
+async def test_socket_transport_chunked_keep_alive():
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while await reader.readuntil(b"\r\n\r\n"):
+            writer.write(
+                b"HTTP/1.1 201 Created\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nhello\r\n0\r\n\r\n"
+                b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+            )
+            await reader.readuntil(b"\r\n\r\n")
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()
+    transport = SocketTransport(host, port)
+    try:
+        assert await transport.request("GET", "/") == 201
+        assert await transport.request("GET", "/") == 200
+        # Both responses used the same connection
+        assert len(transport._idle) == 1
+    finally:
+        transport.close()
+        server.close()
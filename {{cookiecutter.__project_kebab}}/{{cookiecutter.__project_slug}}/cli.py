@@ -8,6 +8,7 @@ The entry-point of the application and the way to pass arguments
 
 import logging
 import logging.config
+from pathlib import Path
 
 import typer
 
@@ -31,7 +32,38 @@ app = typer.Typer(
 )
 
 
-def _get_logging_config(level: int, formatter: str):
+def _get_handler_config(
+    handler: str, formatter: str, queue_size: int, queue_full: str
+) -> dict:
+    if handler == "sync":
+        return {
+            "class": "logging.StreamHandler",
+            "formatter": formatter,
+        }
+
+    if handler == "queue":
+        if queue_full not in ("drop", "block"):
+            raise ValueError(
+                f"Unknown log queue policy {queue_full!r}, expected 'drop' or 'block'"
+            )
+        # Writes logs from background thread, see logqueue.py
+        return {
+            "class": "{{cookiecutter.__project_slug}}.logqueue.QueueStreamHandler",
+            "formatter": formatter,
+            "max_size": queue_size,
+            "block": queue_full == "block",
+        }
+
+    raise ValueError(f"Unknown log handler {handler!r}, expected 'sync' or 'queue'")
+
+
+def _get_logging_config(
+    level: int,
+    formatter: str,
+    handler: str = "sync",
+    queue_size: int = 10000,
+    queue_full: str = "drop",
+):
     return {
         "version": 1,
         "disable_existing_loggers": False,
@@ -43,12 +75,13 @@ def _get_logging_config(level: int, formatter: str):
             "json": {
                 "()": "{{cookiecutter.__project_slug}}.slog.GcpStructuredFormatter",
             },
+            "json_compact": {
+                "()": "{{cookiecutter.__project_slug}}.slog.GcpStructuredFormatter",
+                "compact_json": True,
+            },
         },
         "handlers": {
-            "console": {
-                "class": "logging.StreamHandler",
-                "formatter": formatter,
-            },
+            "console": _get_handler_config(handler, formatter, queue_size, queue_full),
         },
         "loggers": {
             "uvicorn": {"level": "WARNING"},
@@ -63,10 +96,41 @@ def _get_logging_config(level: int, formatter: str):
 
 @app.callback()
 def global_vars(
+    ctx: typer.Context,
     verbose: bool = False,
     sentry_dsn: str | None = typer.Option(None, envvar="SENTRY_DSN"),
     sentry_environment: str | None = typer.Option(None, envvar="SENTRY_ENVIRONMENT"),
-    formatter: str = typer.Option("standard", envvar="LOG_FORMATTER"),
+    sentry_traces_sample_rate: float = typer.Option(
+        0.0,
+        envvar="SENTRY_TRACES_SAMPLE_RATE",
+        help="Share of requests traced with all their spans",
+    ),
+    sentry_traces_slow_ms: float | None = typer.Option(
+        None,
+        envvar="SENTRY_TRACES_SLOW_MS",
+        help="Always report requests slower than this",
+    ),
+    sentry_traces_errors: bool = typer.Option(
+        False,
+        envvar="SENTRY_TRACES_ERRORS",
+        help="Always report requests failed with 5xx status",
+    ),
+    formatter: str = typer.Option(
+        "standard",
+        envvar="LOG_FORMATTER",
+        help="'standard', 'json' or 'json_compact' encoded with orjson if installed",
+    ),
+    log_handler: str = typer.Option(
+        "sync",
+        envvar="LOG_HANDLER",
+        help="'sync' writes logs in place, 'queue' from a background thread",
+    ),
+    log_queue_size: int = typer.Option(10000, envvar="LOG_QUEUE_SIZE"),
+    log_queue_full: str = typer.Option(
+        "drop",
+        envvar="LOG_QUEUE_FULL",
+        help="What to do when log queue is full: 'drop' or 'block'",
+    ),
 ) -> None:
     """
     Hook that sets up
@@ -74,28 +138,175 @@ def global_vars(
 
     Will be executed before any other app command
     """
-    import sentry_sdk
-
     loglevel = logging.INFO
 
     if verbose:
         loglevel = logging.DEBUG
 
     # Configure logging
-    logging.config.dictConfig(_get_logging_config(loglevel, formatter))
+    logging.config.dictConfig(
+        _get_logging_config(
+            loglevel,
+            formatter,
+            handler=log_handler,
+            queue_size=log_queue_size,
+            queue_full=log_queue_full,
+        )
+    )
 
-    # Configure setnry
-    sentry_sdk.init(
-        dsn=sentry_dsn,
-        environment=sentry_environment,
+    from .tracing import TracingPolicy, traces_sampler
+
+    tracing = TracingPolicy(
+        sample_rate=sentry_traces_sample_rate,
+        slow_threshold=(
+            sentry_traces_slow_ms / 1000 if sentry_traces_slow_ms is not None else None
+        ),
+        keep_errors=sentry_traces_errors,
     )
 
+    # Configure setnry
+    if sentry_dsn:
+        # Sentry integrations take noticeable time to import and set up,
+        # skip them entirely when there is nowhere to send events
+        import sentry_sdk
+
+        sentry_sdk.init(
+            dsn=sentry_dsn,
+            environment=sentry_environment,
+            # Requests are sampled by TrackingMiddleware, see tracing.py
+            traces_sampler=traces_sampler if tracing.enabled else None,
+        )
+    else:
+        tracing = TracingPolicy()
+
+    # Passed to commands
+    ctx.obj = {"tracing": tracing}
+
 
 @app.command()
 def run(
+    ctx: typer.Context,
     host: str = "127.0.0.1",
     port: int = 8000,
     root_path: str = typer.Option("", envvar="API_ROOT_PATH"),
+    workers: str = typer.Option(
+        "1",
+        envvar="WEB_WORKERS",
+        help="Number of worker processes, 'auto' to use the container CPU quota",
+    ),
+    openapi_schema: Path | None = typer.Option(
+        None,
+        envvar="OPENAPI_SCHEMA_PATH",
+        help="Schema saved by `openapi` command, generated on first request if not set",
+    ),
+    metrics_buckets: str = typer.Option(
+        "",
+        envvar="METRICS_BUCKETS",
+        help="Request latency histogram buckets in seconds: 0.01,0.1,1",
+    ),
+    metrics_route_buckets: str = typer.Option(
+        "",
+        envvar="METRICS_ROUTE_BUCKETS",
+        help="Latency buckets of specific routes: /echo=0.001,0.01;/batch=1,10",
+    ),
+    metrics_exemplars: bool = typer.Option(
+        True,
+        envvar="METRICS_EXEMPLARS",
+        help="Attach request id to latency observations",
+    ),
+    metrics_cache_ttl: float = typer.Option(
+        1.0, envvar="METRICS_CACHE_TTL", help="Seconds to reuse /metrics output for"
+    ),
+    metrics_dir: Path | None = typer.Option(
+        None,
+        envvar="PROMETHEUS_MULTIPROC_DIR",
+        help="Directory for metrics of worker processes, temporary if not set",
+    ),
+    load_shedding: bool = typer.Option(
+        False,
+        envvar="LOAD_SHEDDING",
+        help="Limit requests in flight adaptively, reject the excess with 503",
+    ),
+    load_shedding_latency: float = typer.Option(
+        1.0,
+        envvar="LOAD_SHEDDING_LATENCY",
+        help="Requests slower than this decrease the limit, seconds",
+    ),
+    load_shedding_max_limit: int = typer.Option(
+        500, envvar="LOAD_SHEDDING_MAX_LIMIT", help="Upper bound of the limit"
+    ),
+    load_shedding_queue: int = typer.Option(
+        100, envvar="LOAD_SHEDDING_QUEUE", help="Requests waiting for a free slot"
+    ),
+    load_shedding_priorities: str = typer.Option(
+        "",
+        envvar="LOAD_SHEDDING_PRIORITIES",
+        help="Priorities by path prefix, higher is served first: /echo=1;/batch=-1",
+    ),
+    offload_threads: int = typer.Option(
+        8, envvar="OFFLOAD_THREADS", help="Threads for blocking API methods"
+    ),
+    offload_processes: int = typer.Option(
+        1,
+        envvar="OFFLOAD_PROCESSES",
+        help="Processes for CPU-bound API methods, per worker",
+    ),
+    compression: bool = typer.Option(
+        False,
+        envvar="COMPRESSION",
+        help="Compress responses with zstd, br or gzip, "
+        "if the ingress does not compress them",
+    ),
+    compression_min_size: int = typer.Option(
+        1024,
+        envvar="COMPRESSION_MIN_SIZE",
+        help="Smaller responses are sent uncompressed, bytes",
+    ),
+    access_log_sample_rate: float | None = typer.Option(
+        None,
+        envvar="ACCESS_LOG_SAMPLE_RATE",
+        help="Share of successful requests logged, errors are always logged. "
+        "All by default, none if summaries are enabled",
+    ),
+    access_log_slow_ms: float | None = typer.Option(
+        None,
+        envvar="ACCESS_LOG_SLOW_MS",
+        help="Always log requests slower than this",
+    ),
+    access_log_summary_interval: float | None = typer.Option(
+        None,
+        envvar="ACCESS_LOG_SUMMARY_INTERVAL",
+        help="Log per-route summaries of requests every N seconds",
+    ),
+    batch: bool = typer.Option(
+        False, envvar="BATCH", help="Serve POST /batch running many API calls at once"
+    ),
+    batch_max_operations: int = typer.Option(
+        50, envvar="BATCH_MAX_OPERATIONS", help="Operations accepted in one batch"
+    ),
+    batch_concurrency: int = typer.Option(
+        8,
+        envvar="BATCH_CONCURRENCY",
+        help="Operations of one batch running at the same time",
+    ),
+    batch_timeout: float | None = typer.Option(
+        None, envvar="BATCH_TIMEOUT", help="Time limit of a batch, seconds"
+    ),
+    drain_prestop_delay: float = typer.Option(
+        5.0,
+        envvar="DRAIN_PRESTOP_DELAY",
+        help="Seconds to serve with failing /ready after SIGTERM",
+    ),
+    drain_graceful_timeout: int = typer.Option(
+        20,
+        envvar="DRAIN_GRACEFUL_TIMEOUT",
+        help="Seconds requests in flight have to finish on shutdown",
+    ),
+    keep_alive_timeout: int = typer.Option(
+        75,
+        envvar="KEEP_ALIVE_TIMEOUT",
+        help="Seconds to keep idle connections, longer than the ingress does",
+    ),
     # Add here more arguments/environment variables if needed
 ) -> None:
     """
@@ -104,12 +315,218 @@ def run(
     and for every request and provide some responses
     """
 
+    from dataclasses import replace
+
+    from .workers import prepare_metrics_dir, resolve_workers
+
+    try:
+        n_workers = resolve_workers(workers)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="'--workers'") from None
+    if n_workers > 1 or metrics_dir is not None:
+        # Before main imports prometheus_client
+        prepare_metrics_dir(metrics_dir)
+
+    from .accesslog import AccessLogPolicy
+    from .api.batch import BatchSettings
+    from .api.executors import ExecutorSettings
+    from .compress import CompressionSettings
+    from .drain import DrainSettings
     from .main import AppSettings, main
+    from .metrics import MetricsSettings, parse_buckets, parse_route_buckets
+    from .shedding import LoadSheddingSettings, parse_priorities
+
+    metrics = MetricsSettings(exemplars=metrics_exemplars, cache_ttl=metrics_cache_ttl)
+    if metrics_buckets:
+        metrics = replace(metrics, buckets=parse_buckets(metrics_buckets))
+    if metrics_route_buckets:
+        metrics = replace(
+            metrics, route_buckets=parse_route_buckets(metrics_route_buckets)
+        )
+
+    shedding = None
+    if load_shedding:
+        shedding = LoadSheddingSettings(
+            latency_threshold=load_shedding_latency,
+            max_limit=load_shedding_max_limit,
+            queue_size=load_shedding_queue,
+            priorities=parse_priorities(load_shedding_priorities),
+        )
 
     main(
         AppSettings(
             host=host,
             port=port,
             root_path=root_path,
+            workers=n_workers,
+            openapi_path=openapi_schema,
+            tracing=ctx.obj["tracing"],
+            metrics=metrics,
+            shedding=shedding,
+            executors=ExecutorSettings(
+                threads=offload_threads, processes=offload_processes
+            ),
+            access_log=AccessLogPolicy(
+                sample_rate=access_log_sample_rate,
+                slow_threshold=(
+                    access_log_slow_ms / 1000
+                    if access_log_slow_ms is not None
+                    else None
+                ),
+                summary_interval=access_log_summary_interval,
+            ),
+            compression=(
+                CompressionSettings(minimum_size=compression_min_size)
+                if compression
+                else None
+            ),
+            batch=(
+                BatchSettings(
+                    max_operations=batch_max_operations,
+                    concurrency=batch_concurrency,
+                    timeout=batch_timeout,
+                )
+                if batch
+                else None
+            ),
+            drain=DrainSettings(
+                prestop_delay=drain_prestop_delay,
+                graceful_timeout=drain_graceful_timeout,
+                keep_alive_timeout=keep_alive_timeout,
+            ),
+        )
+    )
+
+
+@app.command()
+def openapi(
+    output: Path,
+    batch: bool = typer.Option(
+        False, envvar="BATCH", help="Serve POST /batch running many API calls at once"
+    ),
+    batch_max_operations: int = typer.Option(
+        50, envvar="BATCH_MAX_OPERATIONS", help="Operations accepted in one batch"
+    ),
+) -> None:
+    """
+    Save OpenAPI schema to a file.
+    Run at image build time and pass the file to `run --openapi-schema`
+    to skip schema generation in the running service.
+    The service generates the schema anyway if it runs with settings
+    the schema depends on (BATCH, BATCH_MAX_OPERATIONS) other than these
+    """
+    from .api.batch import BatchSettings
+    from .main import make_app
+
+    app = make_app(
+        "",
+        batch=BatchSettings(max_operations=batch_max_operations) if batch else None,
+    )
+    app.state.openapi.save(output)
+
+
+@app.command()
+def profile_startup(
+    min_ms: float = typer.Option(5.0, help="Hide imports faster than this"),
+    serve: bool = typer.Option(
+        True, help="Measure time until `run` responds to the first request"
+    ),
+) -> None:
+    """
+    Profile cold start.
+    Print import time tree of the application and time to first response of server
+    """
+    import sys
+
+    from .startup import (
+        format_import_tree,
+        free_port,
+        profile_imports,
+        time_to_first_response,
+    )
+
+    records = profile_imports("{{cookiecutter.__project_slug}}.main")
+    typer.echo(format_import_tree(records, min_ms))
+    imports_ms = sum(record.cumulative_us for record in records) / 1000
+    typer.echo(f"Total import time: {imports_ms:.0f}ms")
+
+    if serve:
+        port = free_port()
+        command = [
+            sys.executable,
+            "-c",
+            "from {{cookiecutter.__project_slug}}.cli import app; app()",
+            "run",
+            "--port",
+            str(port),
+        ]
+        seconds = time_to_first_response(command, "127.0.0.1", port)
+        typer.echo(f"Time to first response: {seconds * 1000:.0f}ms")
+
+
+@app.command()
+def bench(
+    transport: str = typer.Option(
+        "asgi",
+        help="'asgi' calls the app in-process, 'socket' sends requests through uvicorn",
+    ),
+    requests: int = typer.Option(2000, help="Number of requests per scenario"),
+    concurrency: int = typer.Option(10, help="Number of concurrent clients"),
+    output: Path | None = typer.Option(None, help="Save results to JSON file"),
+    baseline: Path | None = typer.Option(
+        None, help="Compare with results of a previous run, exit with 1 on regression"
+    ),
+    threshold: float = typer.Option(
+        0.1, help="Relative change of throughput or latency treated as regression"
+    ),
+    access_logs: bool = typer.Option(False, help="Log every benchmark request"),
+    comparisons: bool = typer.Option(
+        True, help="Compare components with their previous implementations"
+    ),
+) -> None:
+    """
+    Benchmark the application.
+    Report requests/sec and latency percentiles of /health, /echo and error responses,
+    and operations/sec of components compared with their previous implementations
+    """
+    import asyncio
+
+    import uvloop
+
+    from . import tracking
+    from .bench import (
+        BenchmarkResult,
+        compare,
+        default_comparisons,
+        run_benchmark,
+        run_comparisons,
+    )
+    from .main import make_app
+
+    if not access_logs:
+        tracking.logger.setLevel(logging.WARNING)
+
+    uvloop.install()
+    result = asyncio.run(
+        run_benchmark(
+            make_app(""),
+            transport=transport,
+            requests=requests,
+            concurrency=concurrency,
         )
     )
+    if comparisons:
+        result.comparisons = asyncio.run(
+            run_comparisons(default_comparisons(), operations=requests)
+        )
+    typer.echo(result.format_table())
+
+    if output is not None:
+        result.save(output)
+
+    if baseline is not None:
+        regressions = compare(BenchmarkResult.load(baseline), result, threshold)
+        for regression in regressions:
+            typer.echo(f"Regression {regression}")
+        if regressions:
+            raise typer.Exit(1)
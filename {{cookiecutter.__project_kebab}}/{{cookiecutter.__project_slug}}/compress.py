@@ -0,0 +1,337 @@
+"""
+Compression of responses, disabled by default (COMPRESSION=true):
+ingresses and CDNs often compress responses themselves
+
+CompressionMiddleware compresses responses with the best encoding accepted
+by the client: zstd (Python 3.14+), br (if `brotli` is installed) or gzip.
+It is raw ASGI and never buffers a whole body:
+- a response sent in one message is compressed at once, if it is at least
+  `minimum_size` bytes, and gets the exact Content-Length
+- a streamed response is compressed chunk by chunk, every chunk is flushed,
+  so clients receive data as soon as the app sends it
+
+Responses with Content-Encoding set by the app, and media types that do not
+compress well (images, archives) are sent as is.
+
+Payloads that never change, e.g. /openapi.json, are compressed once per
+encoding with the highest level by `Precompressed` and sent
+as is by the middleware.
+"""
+
+import functools
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Protocol
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+try:
+    from compression import zstd  # type: ignore
+except ImportError:
+    zstd = None
+
+__all__ = [
+    "CompressionSettings",
+    "CompressionMiddleware",
+    "Precompressed",
+    "negotiate",
+]
+
+_COMPRESSIBLE_TYPES = frozenset(
+    (
+        "application/json",
+        "application/javascript",
+        "application/x-ndjson",
+        "application/xml",
+        "image/svg+xml",
+    )
+)
+
+
+@dataclass(frozen=True)
+class CompressionSettings:
+    # Smaller responses are sent as is, compression would not pay off
+    minimum_size: int = 1024
+    # Encodings in order of preference, unavailable ones are skipped
+    encodings: tuple[str, ...] = ("zstd", "br", "gzip")
+    # Levels of per-request compression, trading ratio for CPU time
+    gzip_level: int = 6
+    brotli_quality: int = 4
+    zstd_level: int = 3
+
+
+class _Encoder(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    # Output everything received so far, the stream goes on
+    def flush(self) -> bytes: ...
+
+    # End of the stream
+    def finish(self) -> bytes: ...
+
+
+class _GzipEncoder:
+    __slots__ = ("_compressor",)
+
+    def __init__(self, level: int):
+        # wbits 31 is deflate with gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    __slots__ = ("_compressor",)
+
+    def __init__(self, quality: int):
+        # Registered in _ENCODERS only if brotli is installed
+        assert brotli is not None
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdEncoder:
+    __slots__ = ("_compressor",)
+
+    def __init__(self, level: int):
+        # Registered in _ENCODERS only if compression.zstd is available
+        assert zstd is not None
+        self._compressor = zstd.ZstdCompressor(level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(self._compressor.FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+# Encoder factories by encoding: (settings, precompress) -> encoder
+_ENCODERS: dict[str, Callable[[CompressionSettings, bool], _Encoder]] = {
+    "gzip": lambda settings, best: _GzipEncoder(9 if best else settings.gzip_level),
+}
+if brotli is not None:
+    _ENCODERS["br"] = lambda settings, best: _BrotliEncoder(
+        11 if best else settings.brotli_quality
+    )
+if zstd is not None:
+    _ENCODERS["zstd"] = lambda settings, best: _ZstdEncoder(
+        19 if best else settings.zstd_level
+    )
+
+
+def _available(settings: CompressionSettings) -> tuple[str, ...]:
+    return tuple(encoding for encoding in settings.encodings if encoding in _ENCODERS)
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding: str, available: tuple[str, ...]) -> str | None:
+    """
+    Encoding of `available`, in their order, with the highest quality
+    in Accept-Encoding header, None if the client accepts none of them.
+    Cached: clients send a handful of distinct headers
+    """
+    accepted: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compressible(content_type: str | None) -> bool:
+    if not content_type:
+        return False
+    media_type = content_type.partition(";")[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type in _COMPRESSIBLE_TYPES
+        or media_type.endswith(("+json", "+xml"))
+    )
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, settings: CompressionSettings) -> None:
+        self.app = app
+        self.settings = settings
+        self._available = _available(settings)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = (
+            negotiate(accept_encoding, self._available) if accept_encoding else None
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.settings))
+
+
+class _CompressingSend:
+    """
+    `send` of one response, compressing its body
+    """
+
+    __slots__ = ("_send", "_encoding", "_settings", "_start", "_encoder")
+
+    def __init__(self, send: Send, encoding: str, settings: CompressionSettings):
+        self._send = send
+        self._encoding = encoding
+        self._settings = settings
+        # Response start, held until the first body message decides on compression
+        self._start: Message | None = None
+        self._encoder: _Encoder | None = None
+
+    async def __call__(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            headers = MutableHeaders(raw=message["headers"])
+            status = message["status"]
+            content_length = headers.get("content-length")
+            if (
+                status < 200
+                or status in (204, 304)
+                or "content-encoding" in headers
+                or not _compressible(headers.get("content-type"))
+                or (
+                    content_length is not None
+                    and int(content_length) < self._settings.minimum_size
+                )
+            ):
+                await self._send(message)
+            else:
+                self._start = message
+            return
+
+        if message_type != "http.response.body":
+            await self._send_start()
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        encoder = self._encoder
+        if encoder is not None:
+            body = encoder.compress(body) + (
+                encoder.flush() if more_body else encoder.finish()
+            )
+            if body or not more_body:
+                await self._send(
+                    {"type": message_type, "body": body, "more_body": more_body}
+                )
+            return
+
+        if self._start is None:
+            # Not compressed
+            await self._send(message)
+            return
+
+        if not more_body and len(body) < self._settings.minimum_size:
+            await self._send_start()
+            await self._send(message)
+            return
+
+        encoder = _ENCODERS[self._encoding](self._settings, False)
+        headers = MutableHeaders(raw=self._start["headers"])
+        headers["content-encoding"] = self._encoding
+        headers.add_vary_header("Accept-Encoding")
+        if more_body:
+            del headers["content-length"]
+            self._encoder = encoder
+            body = encoder.compress(body) + encoder.flush()
+        else:
+            body = encoder.compress(body) + encoder.finish()
+            headers["content-length"] = str(len(body))
+        await self._send_start()
+        await self._send({"type": message_type, "body": body, "more_body": more_body})
+
+    async def _send_start(self) -> None:
+        if self._start is not None:
+            start, self._start = self._start, None
+            await self._send(start)
+
+
+class Precompressed:
+    """
+    Body that never changes, compressed once per encoding on first request
+    """
+
+    def __init__(
+        self,
+        body: bytes,
+        media_type: str,
+        settings: CompressionSettings | None = None,
+    ):
+        self.body = body
+        self.media_type = media_type
+        self.settings = settings or CompressionSettings()
+        self._available = _available(self.settings)
+        self._encoded: dict[str, bytes] = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        body = self._encoded.get(encoding)
+        if body is None:
+            encoder = _ENCODERS[encoding](self.settings, True)
+            body = encoder.compress(self.body) + encoder.finish()
+            self._encoded[encoding] = body
+        return body
+
+    def response(self, request: Request) -> Response:
+        accept_encoding = request.headers.get("accept-encoding")
+        encoding = (
+            negotiate(accept_encoding, self._available) if accept_encoding else None
+        )
+        if encoding is None or len(self.body) < self.settings.minimum_size:
+            return Response(self.body, media_type=self.media_type)
+        return Response(
+            self.encoded(encoding),
+            media_type=self.media_type,
+            headers={"content-encoding": encoding, "vary": "Accept-Encoding"},
+        )
@@ -0,0 +1,158 @@
+"""
+Tests for compression of responses
+"""
+
+import asyncio
+import gzip
+import zlib
+from typing import Any
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Message
+
+from .compress import (
+    CompressionMiddleware,
+    CompressionSettings,
+    Precompressed,
+    negotiate,
+)
+from .main import make_app
+
+BODY = b'{"items":[' + b",".join(b'{"id":%d}' % i for i in range(500)) + b"]}"
+
+
+def test_negotiate():
+    available = ("br", "gzip")
+    assert negotiate("gzip, deflate, br", available) == "br"
+    assert negotiate("gzip, br;q=0.5", available) == "gzip"
+    assert negotiate("br;q=0, gzip", available) == "gzip"
+    assert negotiate("*", available) == "br"
+    assert negotiate("*;q=0, gzip", available) == "gzip"
+    assert negotiate("identity", available) is None
+    assert negotiate("GZIP;q=0.1", available) == "gzip"
+    assert negotiate("gzip;q=x", available) is None
+
+
+def _app(settings: CompressionSettings) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, settings=settings)
+
+    async def large() -> Response:
+        return Response(BODY, media_type="application/json")
+
+    async def small() -> Response:
+        return Response(b'{"id":1}', media_type="application/json")
+
+    async def image() -> Response:
+        return Response(BODY, media_type="image/png")
+
+    async def encoded() -> Response:
+        body = gzip.compress(BODY)
+        return Response(
+            body, media_type="application/json", headers={"content-encoding": "gzip"}
+        )
+
+    for route in (large, small, image, encoded):
+        app.add_api_route(f"/{route.__name__}", route)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_compression_middleware():
+    app = _app(CompressionSettings(encodings=("gzip",)))
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        large = await client.get("/large")
+        small = await client.get("/small")
+        image = await client.get("/image")
+        encoded = await client.get("/encoded")
+        identity = await client.get("/large", headers={"accept-encoding": "identity"})
+
+    assert large.headers["content-encoding"] == "gzip"
+    assert large.headers["vary"] == "Accept-Encoding"
+    assert int(large.headers["content-length"]) < len(BODY) / 4
+    assert large.content == BODY
+
+    for response in (small, image, identity):
+        assert "content-encoding" not in response.headers
+    assert image.content == identity.content == BODY
+    # Not compressed twice
+    assert encoded.content == BODY
+
+
+async def _call(app: Any, accept_encoding: bytes) -> list[Message]:
+    messages: list[Message] = []
+
+    async def receive() -> Message:
+        # The client stays connected
+        await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(b"accept-encoding", accept_encoding)],
+    }
+    await app(scope, receive, send)
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_streamed_compression():
+    chunks = [b'{"id":%d}\n' % i * 200 for i in range(3)]
+
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    app = CompressionMiddleware(
+        StreamingResponse(stream(), media_type="application/x-ndjson"),
+        CompressionSettings(encodings=("gzip",)),
+    )
+    start, *bodies = await _call(app, b"gzip")
+
+    headers = dict(start["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    # Every chunk can be decompressed as soon as it is received
+    decompressor = zlib.decompressobj(31)
+    for chunk, message in zip(chunks, bodies[:-1], strict=True):
+        assert decompressor.decompress(message["body"]) == chunk
+    assert bodies[-1]["more_body"] is False
+    decompressor.decompress(bodies[-1]["body"])
+    assert decompressor.eof
+
+
+def test_precompressed():
+    payload = Precompressed(BODY, "application/json")
+    assert payload.encoded("gzip") is payload.encoded("gzip")
+    assert gzip.decompress(payload.encoded("gzip")) == BODY
+
+
+@pytest.mark.asyncio
+async def test_openapi_precompressed():
+    app = make_app("", compression=CompressionSettings(encodings=("gzip",)))
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/openapi.json")
+        again = await client.get("/openapi.json")
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["info"]["title"] == app.title
+    assert again.content == response.content
+
+
+@pytest.mark.asyncio
+async def test_compression_disabled():
+    transport = httpx.ASGITransport(make_app(""))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/openapi.json")
+
+    assert "content-encoding" not in response.headers
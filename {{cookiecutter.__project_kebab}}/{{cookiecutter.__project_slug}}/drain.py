@@ -0,0 +1,214 @@
+"""
+Connection draining on shutdown
+
+Kubernetes sends SIGTERM to a pod and removes it from Service endpoints
+at the same time, the ingress and kube-proxy learn about it a few seconds
+later. A server closing its socket right away drops the requests routed
+to it in between. On SIGTERM the server instead drains in phases:
+1. /ready fails and requests are served for `prestop_delay` seconds,
+   their responses carry `Connection: close`, so clients and the ingress
+   reopen connections to other pods instead of reusing this one
+2. the listening socket is closed, idle keep-alive connections too,
+   and requests in flight have `graceful_timeout` seconds to finish,
+   the rest is cancelled
+3. lifespan shutdown closes clients of other services
+
+Each phase is logged with its timing and the number of requests in flight.
+A second SIGTERM skips the pre-stop delay, SIGINT skips it too
+(Ctrl+C in development).
+
+terminationGracePeriodSeconds of the pod must be longer than
+`prestop_delay + graceful_timeout`, Kubernetes kills the process after it.
+"""
+
+import asyncio
+import logging
+import signal
+import socket
+import time
+from dataclasses import dataclass
+from types import FrameType
+from typing import TYPE_CHECKING, Callable
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:
+    import uvicorn
+
+__all__ = ["DrainSettings", "Drain", "DrainMiddleware", "make_server"]
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DrainSettings:
+    # Requests are served with failing readiness for this long after SIGTERM,
+    # while load balancers stop routing to the pod, seconds
+    prestop_delay: float = 5.0
+    # Requests in flight after that are cancelled after this long,
+    # whole seconds as uvicorn takes them
+    graceful_timeout: int = 20
+    # Idle keep-alive connections are closed after this long, seconds.
+    # Longer than the idle timeout of the ingress (60s in nginx),
+    # so it is the ingress that closes them and never reuses a closed one
+    keep_alive_timeout: int = 75
+
+    @property
+    def shutdown_timeout(self) -> float:
+        """
+        Longest time from SIGTERM to the end of draining, seconds
+        """
+        return self.prestop_delay + self.graceful_timeout
+
+
+class Drain:
+    """
+    State of draining shared by the server, DrainMiddleware and /ready
+    """
+
+    def __init__(
+        self,
+        settings: DrainSettings | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.settings = settings or DrainSettings()
+        self.clock = clock
+        self.draining = False
+        # Requests being served
+        self.in_flight = 0
+        # clock() of the phases
+        self._started_at = 0.0
+        self._stopped_at = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return not self.draining
+
+    def start(self) -> None:
+        """
+        Fail readiness, responses close their connections
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self._started_at = self.clock()
+        logger.info(
+            "Draining: readiness fails, %d requests in flight, "
+            "closing the socket in %.1fs",
+            self.in_flight,
+            self.settings.prestop_delay,
+        )
+
+    def stop_accepting(self) -> None:
+        """
+        The listening socket is being closed
+        """
+        self._stopped_at = self.clock()
+        if not self.draining:
+            # Stopped without the pre-stop delay
+            self.draining = True
+            self._started_at = self._stopped_at
+        logger.info(
+            "Stopped accepting connections %.3fs after draining started, "
+            "waiting up to %ds for %d requests in flight",
+            self._stopped_at - self._started_at,
+            self.settings.graceful_timeout,
+            self.in_flight,
+        )
+
+    def finish(self) -> None:
+        """
+        The server has stopped
+        """
+        now = self.clock()
+        logger.info(
+            "Drained in %.3fs, %.3fs after the socket was closed, "
+            "%d requests cancelled",
+            now - self._started_at,
+            now - self._stopped_at,
+            self.in_flight,
+        )
+
+
+class DrainMiddleware:
+    """
+    Counts requests in flight, closes connections of responses while draining.
+    Requests started before draining are handled by the server: it closes
+    their connections after the response once it stops accepting new ones
+    """
+
+    def __init__(self, app: ASGIApp, drain: Drain) -> None:
+        self.app = app
+        self.drain = drain
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        drain = self.drain
+        drain.in_flight += 1
+        try:
+            if drain.draining:
+                send = _CloseConnection(send)
+            await self.app(scope, receive, send)
+        finally:
+            drain.in_flight -= 1
+
+
+class _CloseConnection:
+    __slots__ = ("_send",)
+
+    def __init__(self, send: Send):
+        self._send = send
+
+    async def __call__(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = [*message.get("headers", ()), (b"connection", b"close")]
+            message = {**message, "headers": headers}
+        await self._send(message)
+
+
+def make_server(config: "uvicorn.Config", drain: Drain) -> "uvicorn.Server":
+    """
+    uvicorn server draining connections on SIGTERM, see the module docs.
+    uvicorn is imported here: building the app does not need it
+    """
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        _loop: asyncio.AbstractEventLoop | None = None
+        _drain_requested = False
+
+        async def serve(self, sockets: list[socket.socket] | None = None) -> None:
+            self._loop = asyncio.get_running_loop()
+            await super().serve(sockets)
+
+        def handle_exit(self, sig: int, frame: FrameType | None) -> None:
+            if (
+                sig != signal.SIGTERM
+                or self._drain_requested
+                or self._loop is None
+                or drain.settings.prestop_delay <= 0
+            ):
+                super().handle_exit(sig, frame)
+                return
+            # Signal handlers must not log: the interrupted code may hold
+            # the lock of a log handler. Draining starts on the event loop
+            self._drain_requested = True
+            self._loop.call_soon_threadsafe(self._start_draining)
+
+        def _start_draining(self) -> None:
+            drain.start()
+            self._loop.call_later(  # type: ignore
+                drain.settings.prestop_delay, setattr, self, "should_exit", True
+            )
+
+        async def shutdown(self, sockets: list[socket.socket] | None = None) -> None:
+            drain.stop_accepting()
+            try:
+                await super().shutdown(sockets)
+            finally:
+                drain.finish()
+
+    return DrainingServer(config)
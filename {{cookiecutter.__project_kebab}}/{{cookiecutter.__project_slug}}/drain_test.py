@@ -0,0 +1,107 @@
+"""
+Tests for connection draining on shutdown
+"""
+
+import asyncio
+import signal
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from {{cookiecutter.__project_slug}}.conftest import JsonLogs
+
+from .drain import Drain, DrainMiddleware, DrainSettings, make_server
+from .main import make_app
+from .workers import bind_socket
+
+
+def _app(drain: Drain) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(DrainMiddleware, drain=drain)
+
+    async def slow() -> str:
+        await asyncio.sleep(0.5)
+        return "done"
+
+    async def fast() -> str:
+        return "done"
+
+    app.add_api_route("/slow", slow)
+    app.add_api_route("/fast", fast)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_drain_middleware():
+    drain = Drain()
+    transport = httpx.ASGITransport(_app(drain))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        slow = asyncio.create_task(client.get("/slow"))
+        await asyncio.sleep(0.1)
+        assert drain.in_flight == 1
+
+        before = await client.get("/fast")
+        drain.start()
+        during = await client.get("/fast")
+        assert (await slow).status_code == 200
+
+    assert drain.in_flight == 0
+    assert "connection" not in before.headers
+    assert during.headers["connection"] == "close"
+
+
+@pytest.mark.asyncio
+async def test_readiness():
+    drain = Drain()
+    transport = httpx.ASGITransport(make_app("", drain=drain))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        ready = await client.get("/ready")
+        drain.start()
+        draining = await client.get("/ready")
+        health = await client.get("/health")
+
+    assert ready.status_code == 200
+    assert draining.status_code == 503
+    # Liveness is not affected
+    assert health.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_graceful_shutdown(structured_logs_capture: JsonLogs):
+    import uvicorn
+
+    drain = Drain(DrainSettings(prestop_delay=0.3, graceful_timeout=2))
+    sock = bind_socket("127.0.0.1", 0)
+    host, port = sock.getsockname()
+    server = make_server(
+        uvicorn.Config(_app(drain), log_config=None, lifespan="off"), drain
+    )
+    serving = asyncio.ensure_future(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    async with httpx.AsyncClient(base_url=f"http://{host}:{port}") as client:
+        slow = asyncio.create_task(client.get("/slow"))
+        await asyncio.sleep(0.1)
+
+        server.handle_exit(signal.SIGTERM, None)
+        await asyncio.sleep(0.1)
+        # Still serving during the pre-stop delay, clients are asked to reconnect
+        during = await client.get("/fast")
+        assert during.status_code == 200
+        assert during.headers["connection"] == "close"
+
+        # The request in flight finishes after the socket is closed
+        await serving
+        assert (await slow).text == '"done"'
+
+    messages = [
+        log["message"]
+        for log in structured_logs_capture.parse()
+        if log["logging.googleapis.com/labels"]["logger"] == "{{cookiecutter.__project_slug}}.drain"
+    ]
+    assert messages[0].startswith("Draining: readiness fails, 1 requests in flight")
+    assert messages[1].startswith("Stopped accepting connections")
+    assert "waiting up to 2s" in messages[1]
+    assert messages[2].endswith("0 requests cancelled")
@@ -0,0 +1,174 @@
+"""
+Non-blocking logging handler
+
+Records are formatted in the calling thread (so context labels from
+logging_context are preserved) and put into a bounded queue.
+A background thread takes formatted records from the queue in batches
+and writes every batch to the stream with a single `write()` call,
+so slow log collector does not block the event loop.
+
+Usage:
+
+handler = QueueStreamHandler(sys.stderr, max_size=10000, block=False)
+handler.setFormatter(GcpStructuredFormatter())
+
+Dropped records and the queue depth are exported to Prometheus
+by metrics.export_log_metrics. The handler is created when logging
+is configured, before prometheus_client may be imported
+(see workers.prepare_metrics_dir), so it receives the metrics later.
+"""
+
+import logging
+import os
+import queue
+import sys
+import threading
+import traceback
+import weakref
+from typing import TYPE_CHECKING, TextIO
+
+if TYPE_CHECKING:
+    from prometheus_client import Counter, Gauge
+
+__all__ = ["QueueStreamHandler"]
+
+# Put into the queue to stop the writer thread
+_STOP = object()
+
+
+class QueueStreamHandler(logging.Handler):
+    terminator = "\n"
+
+    def __init__(
+        self,
+        stream: TextIO | None = None,
+        max_size: int = 10000,
+        block: bool = False,
+        batch_size: int = 512,
+    ):
+        """
+        :param stream: where to write logs, sys.stderr by default
+        :param max_size: maximum number of records waiting to be written
+        :param block: when the queue is full, block the caller
+            until there is free space instead of dropping the record
+        :param batch_size: maximum number of records written at once
+        """
+        super().__init__()
+        self.stream = stream if stream is not None else sys.stderr
+        self.max_size = max_size
+        self.block = block
+        self.batch_size = batch_size
+
+        # Number of records dropped because the queue was full
+        self.dropped = 0
+        # Prometheus metrics, see export_metrics
+        self._dropped_metric: "Counter | None" = None
+        self._depth_metric: "Gauge | None" = None
+
+        self._closed = False
+        self._start_writer()
+
+        # Threads do not survive fork, start a new writer in the worker process
+        handler_ref = weakref.ref(self)
+
+        def _after_fork() -> None:
+            handler = handler_ref()
+            if handler is not None and not handler._closed:
+                # Records dropped before the fork are reported by the parent
+                handler.dropped = 0
+                handler._start_writer()
+
+        os.register_at_fork(after_in_child=_after_fork)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of records waiting to be written
+        """
+        return self._queue.qsize()
+
+    def export_metrics(self, dropped: "Counter", depth: "Gauge") -> None:
+        """
+        Count dropped records in `dropped`, the queue depth is set
+        to `depth` after every batch written
+        """
+        # Drops are counted under the lock held by emit
+        self.acquire()
+        try:
+            if self._dropped_metric is None:
+                dropped.inc(self.dropped)
+            self._dropped_metric = dropped
+            self._depth_metric = depth
+        finally:
+            self.release()
+        depth.set(self.queue_depth)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.format(record) + self.terminator
+        except Exception:
+            self.handleError(record)
+            return
+
+        if self.block:
+            self._queue.put(line)
+            return
+
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            # Handler.handle holds the lock during emit, so this is thread-safe
+            self.dropped += 1
+            if self._dropped_metric is not None:
+                self._dropped_metric.inc()
+
+    def flush(self) -> None:
+        """
+        Wait until all queued records are written
+        """
+        if self._writer.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        self._closed = True
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        super().close()
+
+    def _start_writer(self) -> None:
+        self._queue: queue.Queue = queue.Queue(self.max_size)
+        self._writer = threading.Thread(
+            target=self._write_loop,
+            name=f"{self.__class__.__name__}-writer",
+            daemon=True,
+        )
+        self._writer.start()
+
+    def _write_loop(self) -> None:
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                stop = True
+                batch = [line for line in batch if line is not _STOP]
+
+            try:
+                if batch:
+                    self.stream.write("".join(batch))
+                    self.stream.flush()
+                if self._depth_metric is not None:
+                    self._depth_metric.set(self._queue.qsize())
+            except Exception:
+                # Same as logging.Handler.handleError, there is no record here
+                if logging.raiseExceptions and sys.stderr:
+                    traceback.print_exc(file=sys.stderr)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self._queue.task_done()
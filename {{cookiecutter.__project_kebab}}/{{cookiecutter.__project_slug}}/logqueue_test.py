@@ -0,0 +1,136 @@
+"""
+tests for non-blocking logging handler (logqueue.py)
+"""
+
+import io
+import json
+import logging
+import threading
+from typing import Generator
+
+import pytest
+from prometheus_client import CollectorRegistry, Counter, Gauge
+
+from .logqueue import QueueStreamHandler
+from .slog import GcpStructuredFormatter, logging_context
+
+
+class SlowStream(io.StringIO):
+    """
+    Stream that blocks writes until released
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.entered = threading.Event()
+        self.released = threading.Event()
+        self.writes = 0
+
+    def write(self, s: str) -> int:
+        self.entered.set()
+        self.released.wait()
+        self.writes += 1
+        return super().write(s)
+
+
+@pytest.fixture()
+def queue_logger() -> Generator[logging.Logger, None, None]:
+    logger = logging.getLogger("test_queue_logger")
+    logger.propagate = False
+    try:
+        yield logger
+    finally:
+        for handler in logger.handlers:
+            handler.close()
+        logger.handlers.clear()
+        logger.propagate = True
+
+
+def test_queue_handler_writes_batches(queue_logger: logging.Logger):
+    stream = SlowStream()
+    handler = QueueStreamHandler(stream)
+    handler.setFormatter(GcpStructuredFormatter())
+    queue_logger.addHandler(handler)
+
+    with logging_context(request_id="abc"):
+        queue_logger.warning("message 0")
+        assert stream.entered.wait(5)
+        for i in range(1, 100):
+            queue_logger.warning("message %s", i)
+
+    stream.released.set()
+    handler.flush()
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["message"] for line in lines] == [f"message {i}" for i in range(100)]
+    # Context is captured in the calling thread
+    assert lines[0]["logging.googleapis.com/labels"]["request_id"] == "abc"
+    # The first record is written alone, the rest are batched together
+    assert stream.writes == 2
+    assert handler.queue_depth == 0
+
+
+def test_queue_handler_drops_when_full(queue_logger: logging.Logger):
+    stream = SlowStream()
+    handler = QueueStreamHandler(stream, max_size=10)
+    queue_logger.addHandler(handler)
+
+    # Wait until the writer thread is stuck writing the first record
+    queue_logger.warning("first message")
+    assert stream.entered.wait(5)
+
+    for i in range(100):
+        queue_logger.warning("message %s", i)
+
+    assert handler.queue_depth == 10
+    assert handler.dropped == 90
+
+    stream.released.set()
+    handler.close()
+
+    assert len(stream.getvalue().splitlines()) == 11
+
+
+def test_queue_handler_blocks_when_full(queue_logger: logging.Logger):
+    stream = SlowStream()
+    handler = QueueStreamHandler(stream, max_size=10, block=True)
+    queue_logger.addHandler(handler)
+
+    producer = threading.Thread(
+        target=lambda: [queue_logger.warning("message %s", i) for i in range(100)]
+    )
+    producer.start()
+    producer.join(0.2)
+    # Producer waits for the free space in the queue
+    assert producer.is_alive()
+
+    stream.released.set()
+    producer.join()
+    handler.close()
+
+    assert handler.dropped == 0
+    assert len(stream.getvalue().splitlines()) == 100
+
+
+def test_queue_handler_metrics(queue_logger: logging.Logger):
+    registry = CollectorRegistry()
+    dropped = Counter("dropped", "Dropped records", registry=registry)
+    depth = Gauge("depth", "Queue depth", registry=registry)
+
+    stream = SlowStream()
+    handler = QueueStreamHandler(stream, max_size=10)
+    queue_logger.addHandler(handler)
+    queue_logger.warning("first message")
+    assert stream.entered.wait(5)
+    for i in range(15):
+        queue_logger.warning("message %s", i)
+
+    # Drops before the export are counted too
+    handler.export_metrics(dropped, depth)
+    queue_logger.warning("dropped message")
+    assert registry.get_sample_value("dropped_total") == 6
+    assert registry.get_sample_value("depth") == 10
+
+    stream.released.set()
+    handler.flush()
+    assert registry.get_sample_value("depth") == 0
@@ -4,49 +4,108 @@ Server entry-point with FastAPI app defined
 
 import asyncio
 import logging
-from dataclasses import dataclass
+import os
+import socket
+from dataclasses import dataclass, field
+from pathlib import Path
 
 import fastapi
-import uvicorn
-import uvloop
 from fastapi import FastAPI, Request
-from fastapi.openapi.utils import get_openapi
 from fastapi.responses import RedirectResponse
-from starlette_exporter import handle_metrics
-from starlette_exporter.middleware import PrometheusMiddleware
 
+from {{cookiecutter.__project_slug}}.accesslog import AccessLog, AccessLogPolicy
 from {{cookiecutter.__project_slug}}.api import api_router
+from {{cookiecutter.__project_slug}}.api.batch import BatchSettings
+from {{cookiecutter.__project_slug}}.api.executors import Executors, ExecutorSettings
 from {{cookiecutter.__project_slug}}.api.spec import register_default_exception_handler
+from {{cookiecutter.__project_slug}}.compress import (
+    CompressionMiddleware,
+    CompressionSettings,
+)
+from {{cookiecutter.__project_slug}}.drain import (
+    Drain,
+    DrainMiddleware,
+    DrainSettings,
+    make_server,
+)
+from {{cookiecutter.__project_slug}}.metrics import (
+    MetricsHandler,
+    MetricsSettings,
+    RequestMetrics,
+    export_log_metrics,
+)
+from {{cookiecutter.__project_slug}}.openapi import LazyOpenApi
+from {{cookiecutter.__project_slug}}.resources import Resources
+from {{cookiecutter.__project_slug}}.shedding import (
+    LoadSheddingMiddleware,
+    LoadSheddingSettings,
+)
+from {{cookiecutter.__project_slug}}.tracing import RequestTracer, TracingPolicy
 from {{cookiecutter.__project_slug}}.tracking import TrackingMiddleware
 
 logger = logging.getLogger(__name__)
 
 
-def make_app(root_path: str) -> FastAPI:
+def make_app(
+    root_path: str,
+    openapi_path: Path | None = None,
+    tracing: TracingPolicy | None = None,
+    metrics: MetricsSettings | None = None,
+    shedding: LoadSheddingSettings | None = None,
+    resources: Resources | None = None,
+    compression: CompressionSettings | None = None,
+    access_log: AccessLogPolicy | None = None,
+    batch: BatchSettings | None = None,
+    drain: Drain | None = None,
+) -> FastAPI:
+    if resources is None:
+        resources = make_resources()
+    if drain is None:
+        drain = Drain()
+
+    app = FastAPI(
+        root_path=root_path,
+        title="{{cookiecutter.project_name}}",
+        version="0.1.0",
+        description="{{cookiecutter.description}}",
+        # Schema and docs routes are added by LazyOpenApi
+        openapi_url=None,
+        # Opens clients of other services on startup, closes on shutdown
+        lifespan=resources.lifespan,
+    )
 
-    app = FastAPI(root_path=root_path)
+    metrics = metrics or MetricsSettings()
 
+    if compression is not None:
+        # Added first to run after TrackingMiddleware:
+        # response size metrics and access logs show the bytes actually sent
+        app.add_middleware(CompressionMiddleware, settings=compression)
+    # Enable context based tracking, access logs, request metrics and tracing
     app.add_middleware(
-        PrometheusMiddleware,
-        filter_unhandled_paths=True,
-        group_paths=True,
-        app_name="{{cookiecutter.__project_kebab}}",
-        buckets=[0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5]
-        + [0.75, 1.0, 2.5, 5.0, 7.5, 10.0],
-        skip_paths=[
-            f"{root_path}{path}"
-            for path in ["/health", "/metrics", "/", "/docs", "/openapi.json"]
-        ],
+        TrackingMiddleware,
+        tracer=RequestTracer(tracing) if tracing and tracing.enabled else None,
+        metrics=RequestMetrics(metrics),
+        access_log=AccessLog(access_log) if access_log else None,
     )
-    # Enable context based tracking
-    app.add_middleware(TrackingMiddleware)
+    if shedding is not None:
+        # Added after TrackingMiddleware to run before it:
+        # rejected requests cost as little as possible
+        app.add_middleware(LoadSheddingMiddleware, settings=shedding)
+    # Added last to run first: counts every request in flight for draining
+    app.add_middleware(DrainMiddleware, drain=drain)
 
-    app.add_route("/metrics", handle_metrics)
+    app.add_route("/metrics", MetricsHandler(metrics.cache_ttl).handle)
 
     async def health() -> fastapi.Response:
         """Checks health of application, including database and all systems"""
         return fastapi.Response("OK")
 
+    async def ready() -> fastapi.Response:
+        """Fails once the server is draining connections before shutdown"""
+        if drain.ready:
+            return fastapi.Response("OK")
+        return fastapi.Response("Draining", status_code=503)
+
     async def index(request: Request) -> RedirectResponse:
         # the redirect must be absolute (start with /) because
         # it needs to handle both trailing slash and no trailing slash
@@ -55,44 +114,140 @@ def make_app(root_path: str) -> FastAPI:
         return RedirectResponse(f"{str(request.base_url).rstrip('/')}/docs")
 
     app.add_api_route("/health", health, methods=["get"], include_in_schema=False)
+    app.add_api_route("/ready", ready, methods=["get"], include_in_schema=False)
     app.add_api_route("/", index, methods=["get"], include_in_schema=False)
 
-    app.include_router(api_router())
+    app.include_router(api_router(resources, batch))
 
     register_default_exception_handler(app)
 
-    app.openapi_schema = get_openapi(
-        title="{{cookiecutter.project_name}}",
-        version="0.1.0",
-        description="{{cookiecutter.description}}",
-        routes=app.routes,
-    )
-    app.openapi_schema["servers"] = [{"url": app.root_path}]
+    # Generated on first request to /openapi.json or /docs,
+    # or loaded from openapi_path prepared by `{{cookiecutter.__project_kebab}} openapi`
+    # Settings the schema depends on, the prepared one is used only if they match.
+    # Limit of batch operations, None if /batch is not served
+    openapi_config = {
+        "batch_max_operations": batch.max_operations if batch is not None else None
+    }
+    LazyOpenApi(app, openapi_path, compression, openapi_config).install()
 
     return app
 
 
+def make_resources() -> Resources:
+    resources = Resources()
+    # Declare here clients of other services, e.g.
+    # resources.add_http_client("backend", HttpClientSettings("http://backend"))
+    return resources
+
+
 @dataclass
 class AppSettings:
     host: str
     port: int
     root_path: str
-
-
-async def _main_async(settings: AppSettings):
-    app = make_app(settings.root_path)
+    # Number of worker processes sharing the listening socket
+    workers: int = 1
+    # OpenAPI schema generated at build time, generated on first request if None
+    openapi_path: Path | None = None
+    # Sentry request tracing, disabled by default
+    tracing: TracingPolicy = field(default_factory=TracingPolicy)
+    # Prometheus metrics of requests
+    metrics: MetricsSettings = field(default_factory=MetricsSettings)
+    # Adaptive concurrency limit, disabled if None
+    shedding: LoadSheddingSettings | None = None
+    # Pools for blocking and CPU-bound API methods
+    executors: ExecutorSettings = field(default_factory=ExecutorSettings)
+    # Which requests are logged, and summaries of the rest
+    access_log: AccessLogPolicy = field(default_factory=AccessLogPolicy)
+    # Compression of responses, disabled if None
+    compression: CompressionSettings | None = None
+    # POST /batch running many API calls in one request, disabled if None
+    batch: BatchSettings | None = None
+    # Draining connections on SIGTERM and keep-alive of connections
+    drain: DrainSettings = field(default_factory=DrainSettings)
+
+
+async def _main_async(settings: AppSettings, sock: socket.socket | None = None):
+    import uvicorn
+
+    export_log_metrics()
+    drain = Drain(settings.drain)
+    app = make_app(
+        settings.root_path,
+        settings.openapi_path,
+        settings.tracing,
+        settings.metrics,
+        settings.shedding,
+        compression=settings.compression,
+        access_log=settings.access_log,
+        batch=settings.batch,
+        drain=drain,
+    )
     config = uvicorn.Config(
         app,
         settings.host,
         settings.port,
         log_config=None,
         access_log=False,
+        timeout_keep_alive=settings.drain.keep_alive_timeout,
+        timeout_graceful_shutdown=settings.drain.graceful_timeout,
     )
-    api_server = uvicorn.Server(config)
-    logging.info("Serving on http://%s:%s", settings.host, settings.port)
-    await api_server.serve()
+    api_server = make_server(config, drain)
 
+    executors = Executors(settings.executors)
+    await executors.start()
+    try:
+        if sock is None:
+            logging.info("Serving on http://%s:%s", settings.host, settings.port)
+            await api_server.serve()
+        else:
+            await api_server.serve(sockets=[sock])
+    finally:
+        # Wait for offloaded calls of the requests finished by the server
+        await executors.shutdown()
+
+
+def _serve(settings: AppSettings, sock: socket.socket | None = None):
+    # Server is not needed to build the app in tests, bench and openapi commands
+    import uvloop
 
-def main(settings: AppSettings):
     uvloop.install()
-    asyncio.run(_main_async(settings))
+    asyncio.run(_main_async(settings, sock))
+
+
+def main(settings: AppSettings):
+    if settings.workers == 1:
+        _serve(settings)
+        return
+
+    from {{cookiecutter.__project_slug}}.workers import Supervisor, bind_socket
+
+    sock = bind_socket(settings.host, settings.port)
+    logging.info(
+        "Serving on http://%s:%s with %s workers",
+        settings.host,
+        settings.port,
+        settings.workers,
+    )
+    on_worker_exit = None
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        # Removes in-progress gauges of the worker,
+        # counters and histograms are kept to stay monotonic
+        on_worker_exit = multiprocess.mark_process_dead
+    else:
+        logging.warning(
+            "PROMETHEUS_MULTIPROC_DIR is not set, /metrics shows one worker only"
+        )
+    Supervisor(
+        lambda s: _serve(settings, s),
+        sock,
+        settings.workers,
+        # Workers drain on SIGTERM, plus time for the lifespan shutdown
+        shutdown_timeout=settings.drain.shutdown_timeout + 5,
+        on_worker_exit=on_worker_exit,
+    ).run()
+    if on_worker_exit is not None:
+        # Gauges without labels are created on import in the supervisor too
+        on_worker_exit(os.getpid())
@@ -0,0 +1,363 @@
+"""
+HTTP metrics of the application
+
+Recorded by TrackingMiddleware from the values it already collects for access logs
+and exposed on /metrics. Names and labels of request count, duration and
+in-progress metrics are the same as of starlette_exporter used before,
+so existing dashboards keep working. On top of them:
+- latency buckets can be overridden per route
+- request and response body size histograms
+- exemplars with the request id on latency observations (OpenMetrics format only)
+
+Metric children are cached by (method, route, status): a request does not go
+through `labels()`, which converts label values and takes the metric lock.
+
+With several worker processes every worker writes its metrics to files in
+PROMETHEUS_MULTIPROC_DIR (see workers.prepare_metrics_dir), and the worker
+that receives a scrape merges the files of all workers. Exemplars are not
+supported by prometheus_client in this mode. Merging is not free, so the
+output is reused for `cache_ttl` seconds.
+
+Records dropped by the non-blocking log handler and its queue depth
+are exported as well, see `export_log_metrics`.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Mapping
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.openmetrics import exposition as openmetrics
+from prometheus_client.registry import Collector
+from starlette.requests import Request
+from starlette.responses import Response
+
+from {{cookiecutter.__project_slug}}.logqueue import QueueStreamHandler
+
+__all__ = [
+    "MetricsHandler",
+    "MetricsSettings",
+    "RequestMetrics",
+    "export_log_metrics",
+    "parse_buckets",
+    "parse_route_buckets",
+]
+
+DEFAULT_BUCKETS = (
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+SIZE_BUCKETS = (100.0, 1_000.0, 10_000.0, 100_000.0, 1_000_000.0, 10_000_000.0)
+# Routes not worth measuring, matched against route templates
+DEFAULT_SKIP_PATHS = (
+    "/health",
+    "/ready",
+    "/metrics",
+    "/",
+    "/docs",
+    "/openapi.json",
+)
+
+# OpenMetrics limits exemplar labels to 128 characters
+_MAX_EXEMPLAR_REQUEST_ID = 100
+
+REQUESTS = Counter(
+    "starlette_requests_total",
+    "Total HTTP requests",
+    ["method", "path", "status_code", "app_name"],
+)
+
+
+def _duration_histogram(buckets: tuple[float, ...]) -> Histogram:
+    # Collected by _DurationCollector
+    return Histogram(
+        "starlette_request_duration_seconds",
+        "HTTP request duration, in seconds",
+        ["method", "path", "status_code", "app_name"],
+        buckets=buckets,
+        registry=None,
+    )
+
+
+DURATION = _duration_histogram(DEFAULT_BUCKETS)
+# Latency histogram families by their buckets
+_DURATION_FAMILIES: dict[tuple[float, ...], Histogram] = {DEFAULT_BUCKETS: DURATION}
+
+
+class _DurationCollector(Collector):
+    """
+    Series of all latency histogram families under one metric.
+
+    prometheus_client creates every child with the buckets of its family,
+    while Prometheus only requires buckets to be the same within one series.
+    Families of other buckets are not registered, so the metric name
+    is registered once. In multiprocess mode every family writes
+    to the metric files on its own
+    """
+
+    def describe(self):
+        return DURATION.describe()
+
+    def collect(self):
+        [metric] = DURATION.collect()
+        for family in list(_DURATION_FAMILIES.values()):
+            if family is not DURATION:
+                for family_metric in family.collect():
+                    metric.samples.extend(family_metric.samples)
+        return [metric]
+
+
+REGISTRY.register(_DurationCollector())
+IN_PROGRESS = Gauge(
+    "starlette_requests_in_progress",
+    "Total HTTP requests currently in progress",
+    ["method", "app_name"],
+    multiprocess_mode="livesum",
+)
+REQUEST_SIZE = Histogram(
+    "starlette_request_size_bytes",
+    "HTTP request body size from Content-Length, in bytes",
+    ["method", "path", "app_name"],
+    buckets=SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "starlette_response_size_bytes",
+    "HTTP response body size, in bytes",
+    ["method", "path", "status_code", "app_name"],
+    buckets=SIZE_BUCKETS,
+)
+
+
+@dataclass(frozen=True)
+class MetricsSettings:
+    # Value of app_name label
+    app_name: str = "{{cookiecutter.__project_kebab}}"
+    # Latency buckets, seconds
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    # Latency buckets of specific routes, e.g. {"/echo": (0.001, 0.005, 0.01)}
+    route_buckets: Mapping[str, tuple[float, ...]] = field(default_factory=dict)
+    skip_paths: tuple[str, ...] = DEFAULT_SKIP_PATHS
+    # Attach request id to latency observations
+    exemplars: bool = True
+    # Seconds to reuse /metrics output for
+    cache_ttl: float = 1.0
+
+
+def parse_buckets(value: str) -> tuple[float, ...]:
+    """
+    Parse comma-separated bucket bounds: "0.01,0.1,1"
+    """
+    buckets = tuple(sorted(float(bound) for bound in value.split(",") if bound))
+    if not buckets:
+        raise ValueError(f"No buckets in {value!r}")
+    return buckets
+
+
+def parse_route_buckets(value: str) -> dict[str, tuple[float, ...]]:
+    """
+    Parse per-route buckets separated by semicolon: "/echo=0.001,0.01;/batch=1,10"
+    """
+    route_buckets = {}
+    for item in value.split(";"):
+        if not item.strip():
+            continue
+        route, sep, buckets = item.partition("=")
+        if not sep:
+            raise ValueError(f"Expected <route>=<buckets>, got {item!r}")
+        route_buckets[route.strip()] = parse_buckets(buckets)
+    return route_buckets
+
+
+def _duration_family(buckets: tuple[float, ...]) -> Histogram:
+    """
+    Latency histogram family with the given buckets
+    """
+    family = _DURATION_FAMILIES.get(buckets)
+    if family is None:
+        family = _DURATION_FAMILIES.setdefault(buckets, _duration_histogram(buckets))
+    return family
+
+
+class _RouteMetrics:
+    __slots__ = ("requests", "duration", "request_size", "response_size")
+
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        status_code: str,
+        settings: MetricsSettings,
+    ):
+        app_name = settings.app_name
+        labelvalues = (method, path, status_code, app_name)
+
+        self.requests = REQUESTS.labels(*labelvalues)
+        self.duration = _duration_family(
+            settings.route_buckets.get(path, settings.buckets)
+        ).labels(*labelvalues)
+        self.request_size = REQUEST_SIZE.labels(method, path, app_name)
+        self.response_size = RESPONSE_SIZE.labels(*labelvalues)
+
+
+class RequestMetrics:
+    """
+    Records metrics of finished requests
+    """
+
+    def __init__(self, settings: MetricsSettings):
+        self.settings = settings
+        self._skip_paths = frozenset(settings.skip_paths)
+        # Not stored by prometheus_client in multiprocess mode
+        self._exemplars = settings.exemplars and not _multiprocess()
+        self._in_progress: dict[str, Gauge] = {}
+        self._routes: dict[tuple[str, str, int], _RouteMetrics] = {}
+
+    def started(self, method: str) -> None:
+        gauge = self._in_progress.get(method)
+        if gauge is None:
+            gauge = IN_PROGRESS.labels(method, self.settings.app_name)
+            self._in_progress[method] = gauge
+        gauge.inc()
+
+    def finished(
+        self,
+        method: str,
+        route_path: str | None,
+        status_code: int,
+        latency: float,
+        request_size: int | None,
+        response_size: int | None,
+        request_id: str | None,
+    ) -> None:
+        """
+        Record finished request, route_path is the template of the matched route.
+        Requests that did not match any route are not recorded
+        """
+        self._in_progress[method].dec()
+
+        if route_path is None or route_path in self._skip_paths:
+            return
+
+        key = (method, route_path, status_code)
+        route = self._routes.get(key)
+        if route is None:
+            route = _RouteMetrics(method, route_path, str(status_code), self.settings)
+            self._routes[key] = route
+
+        route.requests.inc()
+        if (
+            self._exemplars
+            and request_id
+            and len(request_id) <= _MAX_EXEMPLAR_REQUEST_ID
+        ):
+            route.duration.observe(latency, {"request_id": request_id})
+        else:
+            route.duration.observe(latency)
+        if request_size is not None:
+            route.request_size.observe(request_size)
+        if response_size is not None:
+            route.response_size.observe(response_size)
+
+
+@functools.cache
+def _log_metrics() -> tuple[Counter, Gauge]:
+    # Metrics without labels write their multiprocess files once created,
+    # they are created in workers so the supervisor does not leave files behind
+    dropped = Counter(
+        "log_records_dropped",
+        "Log records dropped because the queue of the log handler was full",
+    )
+    depth = Gauge(
+        "log_queue_depth",
+        "Log records waiting in the queue of the log handler",
+        multiprocess_mode="livesum",
+    )
+    return dropped, depth
+
+
+def export_log_metrics(logger: logging.Logger | None = None) -> None:
+    """
+    Export dropped records and queue depth of the queue handlers of the logger,
+    the root logger by default. Called in every worker process
+    """
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        if isinstance(handler, QueueStreamHandler):
+            handler.export_metrics(*_log_metrics())
+
+
+def _multiprocess() -> bool:
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+class MetricsHandler:
+    """
+    /metrics endpoint: OpenMetrics format (with exemplars) when Prometheus asks
+    for it, Prometheus text format otherwise
+    """
+
+    def __init__(
+        self, cache_ttl: float = 0.0, clock: Callable[[], float] = time.monotonic
+    ):
+        self.cache_ttl = cache_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        # OpenMetrics format -> (expiration time, output)
+        self._cache: dict[bool, tuple[float, bytes]] = {}
+
+    def handle(self, request: Request) -> Response:
+        openmetrics_format = "application/openmetrics-text" in request.headers.get(
+            "accept", ""
+        )
+        content_type = (
+            openmetrics.CONTENT_TYPE_LATEST
+            if openmetrics_format
+            else CONTENT_TYPE_LATEST
+        )
+        return Response(
+            self._output(openmetrics_format), headers={"Content-Type": content_type}
+        )
+
+    def _output(self, openmetrics_format: bool) -> bytes:
+        # Concurrent scrapes wait for one to generate the output
+        with self._lock:
+            now = self.clock()
+            cached = self._cache.get(openmetrics_format)
+            if cached is not None and now < cached[0]:
+                return cached[1]
+
+            registry = REGISTRY
+            if _multiprocess():
+                registry = CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            generate = (
+                openmetrics.generate_latest if openmetrics_format else generate_latest
+            )
+            output = generate(registry)
+            if self.cache_ttl > 0:
+                self._cache[openmetrics_format] = (now + self.cache_ttl, output)
+            return output
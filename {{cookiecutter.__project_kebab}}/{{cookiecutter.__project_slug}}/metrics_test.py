@@ -0,0 +1,269 @@
+"""
+Tests for request metrics
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from prometheus_client import REGISTRY
+from starlette.responses import Response
+
+from .metrics import (
+    REQUESTS,
+    MetricsHandler,
+    MetricsSettings,
+    RequestMetrics,
+    _duration_family,
+    parse_buckets,
+    parse_route_buckets,
+)
+from .startup import free_port
+from .tracking import TrackingMiddleware
+
+logger = logging.getLogger(__name__)
+
+ITEM = "/items/{item_id}"
+
+
+def make_app(settings: MetricsSettings) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(TrackingMiddleware, metrics=RequestMetrics(settings))
+    app.add_route("/metrics", MetricsHandler().handle)
+
+    @app.get("/health")
+    async def health() -> Response:
+        return Response("OK")
+
+    @app.post(ITEM)
+    async def item(item_id: int) -> Response:
+        return Response("x" * 1000)
+
+    return app
+
+
+async def _request(
+    app: FastAPI, method: str, path: str, **kwargs: Any
+) -> httpx.Response:
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.request(method, path, **kwargs)
+
+
+# Metrics are global, every test uses its own app_name label
+
+
+@pytest.mark.asyncio
+async def test_request_metrics():
+    app_name = "test-request-metrics"
+    app = make_app(MetricsSettings(app_name=app_name))
+    for item_id in range(3):
+        await _request(app, "POST", f"/items/{item_id}", content=b"x" * 200)
+    await _request(app, "POST", "/items/not-a-number")
+    await _request(app, "GET", "/health")
+    await _request(app, "GET", "/not-found")
+
+    def sample(name: str, **labels: str) -> float | None:
+        return REGISTRY.get_sample_value(name, {"app_name": app_name, **labels})
+
+    item = {"method": "POST", "path": ITEM}
+    assert sample("starlette_requests_total", status_code="200", **item) == 3
+    assert sample("starlette_requests_total", status_code="422", **item) == 1
+    durations = sample(
+        "starlette_request_duration_seconds_count", status_code="200", **item
+    )
+    assert durations == 3
+    response_sizes = sample(
+        "starlette_response_size_bytes_bucket", status_code="200", le="1000.0", **item
+    )
+    assert response_sizes == 3
+    assert sample("starlette_request_size_bytes_sum", **item) == 600
+    assert sample("starlette_requests_in_progress", method="POST") == 0
+    assert sample("starlette_requests_in_progress", method="GET") == 0
+    # Skipped and unmatched paths are not recorded
+    for path in ["/health", "/not-found"]:
+        labels = {"method": "GET", "path": path, "status_code": "200"}
+        assert sample("starlette_requests_total", **labels) is None
+
+
+@pytest.mark.asyncio
+async def test_route_buckets():
+    app = make_app(
+        MetricsSettings(
+            app_name="test-route-buckets",
+            buckets=(0.1, 1.0),
+            route_buckets={ITEM: (0.001, 0.002, 0.005)},
+        )
+    )
+    await _request(app, "POST", "/items/1")
+    await _request(app, "POST", "/items/not-a-number")
+
+    def bounds(status_code: str) -> list[str]:
+        labels = {
+            "method": "POST",
+            "path": ITEM,
+            "status_code": status_code,
+            "app_name": "test-route-buckets",
+        }
+        return [
+            sample.labels["le"]
+            for metric in REGISTRY.collect()
+            for sample in metric.samples
+            if sample.name == "starlette_request_duration_seconds_bucket"
+            and labels.items() <= sample.labels.items()
+        ]
+
+    assert bounds("200") == bounds("422") == ["0.001", "0.002", "0.005", "+Inf"]
+
+
+@pytest.mark.asyncio
+async def test_exemplars():
+    app = make_app(MetricsSettings(app_name="test-exemplars"))
+    await _request(app, "POST", "/items/1", headers={"x-request-id": "req-1"})
+
+    response = await _request(
+        app, "GET", "/metrics", headers={"accept": "application/openmetrics-text"}
+    )
+    assert response.headers["content-type"].startswith("application/openmetrics-text")
+    assert 'app_name="test-exemplars"' in response.text
+    assert '# {request_id="req-1"}' in response.text
+
+    # Prometheus text format has no exemplars
+    response = await _request(app, "GET", "/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'app_name="test-exemplars"' in response.text
+    assert "req-1" not in response.text
+
+
+@pytest.mark.asyncio
+async def test_metrics_cache():
+    now = 0.0
+    app = make_app(MetricsSettings(app_name="test-metrics-cache"))
+    app.add_route("/cached", MetricsHandler(cache_ttl=5, clock=lambda: now).handle)
+
+    async def scrape() -> str:
+        response = await _request(app, "GET", "/cached")
+        return next(
+            line
+            for line in response.text.splitlines()
+            if line.startswith("starlette_requests_total")
+            and 'app_name="test-metrics-cache"' in line
+        )
+
+    await _request(app, "POST", "/items/1")
+    assert (await scrape()).endswith(" 1.0")
+
+    await _request(app, "POST", "/items/1")
+    now = 4.9
+    assert (await scrape()).endswith(" 1.0")
+    now = 5.0
+    assert (await scrape()).endswith(" 2.0")
+
+
+def test_multiprocess_metrics(tmp_path: Path):
+    """
+    Scrape of any worker shows requests served by all workers
+    """
+    package = __name__.rsplit(".", 1)[0]
+    port = free_port()
+    command = [
+        sys.executable,
+        "-c",
+        f"from {package}.cli import app; app()",
+        "run",
+        "--port",
+        str(port),
+        "--workers",
+        "2",
+    ]
+    env = {
+        **os.environ,
+        "PROMETHEUS_MULTIPROC_DIR": str(tmp_path),
+        "METRICS_CACHE_TTL": "0",
+        "LOG_HANDLER": "queue",
+    }
+    process = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    # New connection for every request, so they are spread between workers
+    limits = httpx.Limits(max_keepalive_connections=0)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", limits=limits) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    client.get("/health")
+                    break
+                except httpx.TransportError:
+                    assert time.monotonic() < deadline, "server did not start"
+                    time.sleep(0.05)
+
+            for _ in range(20):
+                client.get("/echo", params={"request": "hello"})
+
+            for _ in range(5):
+                response = client.get("/metrics")
+                (line,) = [
+                    line
+                    for line in response.text.splitlines()
+                    if line.startswith("starlette_requests_total{")
+                    and 'path="/echo"' in line
+                ]
+                assert line.endswith(" 20.0")
+                # Log queues of the workers
+                assert "\nlog_records_dropped_total 0.0\n" in response.text
+                assert "\nlog_queue_depth " in response.text
+    finally:
+        process.terminate()
+        process.wait(10)
+
+    # Gauges of stopped workers are removed
+    assert list(tmp_path.glob("gauge_livesum_*.db")) == []
+
+
+def test_parse_buckets():
+    assert parse_buckets("1,0.1,0.01,") == (0.01, 0.1, 1.0)
+    assert parse_route_buckets("/echo=0.001,0.01; /batch=1,10;") == {
+        "/echo": (0.001, 0.01),
+        "/batch": (1.0, 10.0),
+    }
+    with pytest.raises(ValueError):
+        parse_buckets("")
+    with pytest.raises(ValueError):
+        parse_route_buckets("/echo")
+
+
+def test_route_metrics_cached():
+    app_name = "test-route-metrics-cached"
+    metrics = RequestMetrics(
+        MetricsSettings(app_name=app_name, route_buckets={ITEM: (0.5,)})
+    )
+    for latency in (0.1, 0.2, 1.0):
+        metrics.started("GET")
+        metrics.finished("GET", ITEM, 200, latency, 100, 200, "abc")
+
+    # Children are looked up once per (method, route, status)
+    [(key, route)] = metrics._routes.items()
+    assert key == ("GET", ITEM, 200)
+    labelvalues = ("GET", ITEM, "200", app_name)
+    assert route.requests is REQUESTS.labels(*labelvalues)
+    assert route.duration is _duration_family((0.5,)).labels(*labelvalues)
+
+    def sample(name: str, **labels: str) -> float | None:
+        return REGISTRY.get_sample_value(name, {"app_name": app_name, **labels})
+
+    item = {"method": "GET", "path": ITEM, "status_code": "200"}
+    assert sample("starlette_requests_total", **item) == 3
+    assert sample("starlette_request_duration_seconds_bucket", le="0.5", **item) == 2
+    assert sample("starlette_request_duration_seconds_count", **item) == 3
+    assert sample("starlette_request_duration_seconds_sum", **item) == pytest.approx(
+        1.3
+    )
+    assert sample("starlette_request_size_bytes_sum", method="GET", path=ITEM) == 300
+    assert sample("starlette_response_size_bytes_sum", **item) == 600
+    assert sample("starlette_requests_in_progress", method="GET") == 0
@@ -0,0 +1,160 @@
+"""
+Lazy OpenAPI schema of the application
+
+Generating the schema walks every route and model, which slows down the startup,
+while /openapi.json and /docs are rarely requested in production.
+The schema is generated on first use (or loaded from a file prepared
+at image build time) and served as pre-encoded bytes, compressed once
+per encoding if compression is enabled.
+
+The schema depends on settings of the app, e.g. /batch is documented
+only if it is served. The file keeps the settings it was prepared with
+and is used only if the app runs with the same ones.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any
+
+import fastapi
+from fastapi import FastAPI, Request
+from fastapi.openapi.docs import (
+    get_redoc_html,
+    get_swagger_ui_html,
+    get_swagger_ui_oauth2_redirect_html,
+)
+from fastapi.openapi.utils import get_openapi
+from fastapi.responses import HTMLResponse
+
+from {{cookiecutter.__project_slug}}.compress import CompressionSettings, Precompressed
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LazyOpenApi"]
+
+# Key of the settings in the schema file, removed from the served schema
+CONFIG_KEY = "x-app-config"
+
+OPENAPI_URL = "/openapi.json"
+DOCS_URL = "/docs"
+OAUTH2_REDIRECT_URL = "/docs/oauth2-redirect"
+REDOC_URL = "/redoc"
+
+
+class LazyOpenApi:
+    """
+    Generates OpenAPI schema once, on first request to it.
+
+    FastAPI app must be created with `openapi_url=None`,
+    `install` adds the schema and documentation routes instead of default ones
+    """
+
+    def __init__(
+        self,
+        app: FastAPI,
+        path: Path | None = None,
+        compression: CompressionSettings | None = None,
+        config: dict[str, Any] | None = None,
+    ):
+        if path is not None and not path.is_file():
+            # Fail on startup rather than on the first request
+            raise FileNotFoundError(f"OpenAPI schema {path} does not exist")
+        self.app = app
+        # Schema prepared in advance, e.g. at image build time
+        self.path = path
+        # Sent uncompressed if None
+        self.compression = compression or CompressionSettings(encodings=())
+        # Settings the schema depends on, JSON-serializable
+        self.config = config or {}
+
+        self._schema: dict[str, Any] | None = None
+        self._body: Precompressed | None = None
+
+    def generate(self) -> dict[str, Any]:
+        return get_openapi(
+            title=self.app.title,
+            version=self.app.version,
+            description=self.app.description,
+            routes=self.app.routes,
+        )
+
+    def schema(self) -> dict[str, Any]:
+        schema = self._schema
+        if schema is None:
+            schema = self._load() if self.path is not None else None
+            if schema is None:
+                schema = self.generate()
+            schema["servers"] = [{"url": self.app.root_path}]
+            self._schema = schema
+        return schema
+
+    def _load(self) -> dict[str, Any] | None:
+        """
+        Schema from the file, None if it was prepared with other settings
+        """
+        assert self.path is not None
+        schema = json.loads(self.path.read_bytes())
+        config = schema.pop(CONFIG_KEY, None)
+        if config != self.config:
+            logger.warning(
+                "OpenAPI schema %s was prepared with %s, the app runs with %s, "
+                "generating the schema instead",
+                self.path,
+                config,
+                self.config,
+            )
+            return None
+        logger.info("Loading OpenAPI schema from %s", self.path)
+        return schema
+
+    def save(self, path: Path) -> None:
+        """
+        Save generated schema with the settings it depends on
+        """
+        schema = {**self.generate(), CONFIG_KEY: self.config}
+        path.write_text(json.dumps(schema, ensure_ascii=False))
+
+    def body(self) -> bytes:
+        return self._precompressed().body
+
+    def _precompressed(self) -> Precompressed:
+        if self._body is None:
+            body = json.dumps(
+                self.schema(), ensure_ascii=False, separators=(",", ":")
+            ).encode()
+            self._body = Precompressed(body, "application/json", self.compression)
+        return self._body
+
+    def install(self) -> None:
+        title = self.app.title
+
+        async def openapi(request: Request) -> fastapi.Response:
+            return self._precompressed().response(request)
+
+        async def swagger_ui_html(request: Request) -> HTMLResponse:
+            root_path = request.scope.get("root_path", "").rstrip("/")
+            return get_swagger_ui_html(
+                openapi_url=root_path + OPENAPI_URL,
+                title=f"{title} - Swagger UI",
+                oauth2_redirect_url=root_path + OAUTH2_REDIRECT_URL,
+            )
+
+        async def swagger_ui_redirect(request: Request) -> HTMLResponse:
+            return get_swagger_ui_oauth2_redirect_html()
+
+        async def redoc_html(request: Request) -> HTMLResponse:
+            root_path = request.scope.get("root_path", "").rstrip("/")
+            return get_redoc_html(
+                openapi_url=root_path + OPENAPI_URL, title=f"{title} - ReDoc"
+            )
+
+        self.app.openapi = self.schema  # type: ignore
+        # For `openapi` command saving the schema
+        self.app.state.openapi = self
+        self.app.add_route(OPENAPI_URL, openapi, include_in_schema=False)
+        self.app.add_route(DOCS_URL, swagger_ui_html, include_in_schema=False)
+        self.app.add_route(
+            OAUTH2_REDIRECT_URL, swagger_ui_redirect, include_in_schema=False
+        )
+        self.app.add_route(REDOC_URL, redoc_html, include_in_schema=False)
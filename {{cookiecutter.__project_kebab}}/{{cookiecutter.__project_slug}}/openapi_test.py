@@ -0,0 +1,103 @@
+"""
+Tests for lazy OpenAPI schema
+"""
+
+import json
+import logging
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.openapi.utils import get_openapi
+
+from .api.batch import BatchSettings
+from .main import make_app
+from .openapi import LazyOpenApi
+
+logger = logging.getLogger(__name__)
+
+
+def _client(app: FastAPI) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://test")
+
+
+@pytest.mark.asyncio
+async def test_openapi_schema():
+    app = make_app("/prefix")
+    expected = get_openapi(
+        title=app.title,
+        version=app.version,
+        description=app.description,
+        routes=app.routes,
+    )
+    expected["servers"] = [{"url": "/prefix"}]
+
+    async with _client(app) as client:
+        response = await client.get("/prefix/openapi.json")
+        docs = await client.get("/prefix/docs")
+        redoc = await client.get("/prefix/redoc")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == expected
+    assert app.openapi() == expected
+
+    assert docs.status_code == redoc.status_code == 200
+    assert "/prefix/openapi.json" in docs.text
+    assert "/prefix/openapi.json" in redoc.text
+
+
+def test_openapi_schema_is_lazy(monkeypatch: pytest.MonkeyPatch):
+    calls = []
+    generate = LazyOpenApi.generate
+
+    def counting_generate(self: LazyOpenApi):
+        calls.append(self)
+        return generate(self)
+
+    monkeypatch.setattr(LazyOpenApi, "generate", counting_generate)
+
+    app = make_app("")
+    assert calls == []
+
+    app.openapi()
+    app.openapi()
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_openapi_schema_from_file(tmp_path: Path):
+    path = tmp_path / "openapi.json"
+    make_app("").state.openapi.save(path)
+    # Not generated by the app
+    saved = json.loads(path.read_text())
+    saved["info"]["title"] = "Saved"
+    path.write_text(json.dumps(saved))
+
+    app = make_app("/prefix", openapi_path=path)
+    async with _client(app) as client:
+        response = await client.get("/prefix/openapi.json")
+
+    schema = response.json()
+    assert schema["info"]["title"] == "Saved"
+    assert schema["servers"] == [{"url": "/prefix"}]
+    assert schema["paths"] == make_app("").openapi()["paths"]
+    assert "x-app-config" not in schema
+
+    with pytest.raises(FileNotFoundError):
+        make_app("", openapi_path=tmp_path / "missing.json")
+
+
+def test_openapi_schema_file_of_other_settings(tmp_path: Path):
+    path = tmp_path / "openapi.json"
+    make_app("").state.openapi.save(path)
+
+    # Prepared without /batch, generated instead
+    schema = make_app("", openapi_path=path, batch=BatchSettings()).openapi()
+    assert "/batch" in schema["paths"]
+
+    make_app("", batch=BatchSettings(max_operations=10)).state.openapi.save(path)
+    schema = make_app("", openapi_path=path, batch=BatchSettings()).openapi()
+    batch_request = schema["components"]["schemas"]["BatchRequest"]
+    assert batch_request["properties"]["operations"]["maxItems"] == 50
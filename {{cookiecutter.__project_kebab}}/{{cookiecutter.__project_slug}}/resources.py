@@ -0,0 +1,245 @@
+"""
+Long-lived resources of the application
+
+Clients of other services are expensive to create: a client per request
+pays for DNS, TCP and TLS handshakes every time. Resources are declared
+once, opened on application startup and closed on shutdown,
+see `make_app(resources=...)`:
+
+resources = Resources()
+resources.add_http_client("backend", HttpClientSettings("http://backend:8000"))
+...
+response = await resources.http("backend").get("/items")
+
+HTTP clients keep connections alive and limit their number.
+Each client reports requests in flight, connections in use and opened,
+and the time requests wait for a free connection. They are measured
+with the trace extension of httpx requests: the pool of the transport
+is private, idle connections are not reported.
+
+Tests swap clients for local fakes, see `fake_http_transport`.
+
+Resources are pickled empty with Api instances for methods offloaded
+to processes, clients of the server process raise RuntimeError there.
+"""
+
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Coroutine
+
+import httpx
+from prometheus_client import Counter, Gauge, Histogram
+
+__all__ = [
+    "HttpClientSettings",
+    "MeteredTransport",
+    "Resources",
+    "fake_http_transport",
+]
+
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_client_requests_in_flight",
+    "Requests sent by HTTP client and waiting for response headers",
+    ["client"],
+    multiprocess_mode="livesum",
+)
+HTTP_CONNECTIONS_IN_USE = Gauge(
+    "http_client_connections_in_use",
+    "Connections of HTTP client pool sending requests or receiving responses",
+    ["client"],
+    multiprocess_mode="livesum",
+)
+HTTP_CONNECTIONS_OPENED = Counter(
+    "http_client_connections_opened",
+    "Connections opened by HTTP client, grows with every request "
+    "if connections are not kept alive",
+    ["client"],
+)
+HTTP_POOL_WAIT = Histogram(
+    "http_client_pool_wait_seconds",
+    "Time requests waited for a connection from the pool, in seconds",
+    ["client"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+@dataclass(frozen=True)
+class HttpClientSettings:
+    base_url: str = ""
+    # Timeout of connect, read, write and waiting for a connection, seconds
+    timeout: float = 10.0
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    # Idle connections are closed after this time, seconds
+    keepalive_expiry: float = 30.0
+
+
+class _MeteredStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """
+    Transport reporting metrics of the wrapped transport
+    """
+
+    def __init__(self, name: str, transport: httpx.AsyncBaseTransport):
+        self.name = name
+        self._transport = transport
+        self._in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(name)
+        self._in_use = HTTP_CONNECTIONS_IN_USE.labels(name)
+        self._opened = HTTP_CONNECTIONS_OPENED.labels(name)
+        self._pool_wait = HTTP_POOL_WAIT.labels(name)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.monotonic()
+        acquired = False
+        trace = request.extensions.get("trace")
+
+        async def trace_connection(event: str, info: dict[str, Any]) -> None:
+            nonlocal acquired
+            # The first event comes from the connection the request got,
+            # fakes without connections send none
+            if not acquired:
+                acquired = True
+                self._pool_wait.observe(time.monotonic() - started)
+                self._in_use.inc()
+            if event == "connection.connect_tcp.complete":
+                self._opened.inc()
+            if trace is not None:
+                await trace(event, info)
+
+        def release() -> None:
+            nonlocal acquired
+            if acquired:
+                acquired = False
+                self._in_use.dec()
+
+        request.extensions = {**request.extensions, "trace": trace_connection}
+
+        self._in_flight.inc()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        finally:
+            self._in_flight.dec()
+        # The connection is in use until the response body is read
+        stream = response.stream
+        assert isinstance(stream, httpx.AsyncByteStream)
+        response.stream = _MeteredStream(stream, release)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def fake_http_transport(
+    handler: Callable[[httpx.Request], httpx.Response]
+    | Callable[[httpx.Request], Coroutine[Any, Any, httpx.Response]],
+) -> httpx.AsyncBaseTransport:
+    """
+    Transport answering requests with the handler instead of the network
+    """
+    return httpx.MockTransport(handler)
+
+
+class Resources:
+    """
+    Registry of resources opened for the lifetime of the application
+    """
+
+    def __init__(self) -> None:
+        self._http_settings: dict[str, HttpClientSettings] = {}
+        self._http_transports: dict[str, httpx.AsyncBaseTransport] = {}
+        self._http: dict[str, httpx.AsyncClient] = {}
+        self._stack: AsyncExitStack | None = None
+        # Unpickled in a process running offloaded methods
+        self._unpickled = False
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__()
+        self._unpickled = True
+
+    def add_http_client(
+        self,
+        name: str,
+        settings: HttpClientSettings,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        """
+        Declare HTTP client, transport replaces the network in tests
+        """
+        if self._stack is not None:
+            raise RuntimeError(f"Cannot add {name} client to opened resources")
+        self._http_settings[name] = settings
+        if transport is not None:
+            self._http_transports[name] = transport
+
+    def http(self, name: str) -> httpx.AsyncClient:
+        try:
+            return self._http[name]
+        except KeyError:
+            if self._unpickled:
+                raise RuntimeError(
+                    f"{name} client is not available in methods offloaded "
+                    "to processes, offload them to threads"
+                ) from None
+            if self._stack is None:
+                raise RuntimeError("Resources are not opened") from None
+            raise
+
+    async def __aenter__(self) -> "Resources":
+        async with AsyncExitStack() as stack:
+            for name, settings in self._http_settings.items():
+                self._http[name] = await stack.enter_async_context(
+                    self._make_http_client(name, settings)
+                )
+            self._stack = stack.pop_all()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        stack, self._stack = self._stack, None
+        self._http.clear()
+        if stack is not None:
+            await stack.aclose()
+
+    @asynccontextmanager
+    async def lifespan(self, _app: Any) -> AsyncIterator[None]:
+        async with self:
+            yield
+
+    def _make_http_client(
+        self, name: str, settings: HttpClientSettings
+    ) -> httpx.AsyncClient:
+        transport = self._http_transports.get(name)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=settings.max_connections,
+                    max_keepalive_connections=settings.max_keepalive_connections,
+                    keepalive_expiry=settings.keepalive_expiry,
+                )
+            )
+        return httpx.AsyncClient(
+            base_url=settings.base_url,
+            timeout=settings.timeout,
+            transport=MeteredTransport(name, transport),
+        )
@@ -0,0 +1,107 @@
+"""
+Tests for application resources
+"""
+
+import asyncio
+import pickle
+from contextlib import suppress
+from typing import AsyncGenerator
+
+import httpx
+import pytest
+import pytest_asyncio
+from prometheus_client import REGISTRY
+
+from .api.api import DefaultApi
+from .main import make_app
+from .resources import HttpClientSettings, Resources, fake_http_transport
+
+
+def _metric(name: str, **labels: str) -> float | None:
+    return REGISTRY.get_sample_value(name, labels)
+
+
+@pytest.mark.asyncio
+async def test_fake_http_client():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"path": request.url.path})
+
+    resources = Resources()
+    resources.add_http_client(
+        "fake", HttpClientSettings("http://backend"), fake_http_transport(handler)
+    )
+    with pytest.raises(RuntimeError):
+        resources.http("fake")
+
+    # Opened and closed by the lifespan of the app
+    app = make_app("", resources=resources)
+    async with app.router.lifespan_context(app):
+        client = resources.http("fake")
+        response = await client.get("/items")
+        assert response.json() == {"path": "/items"}
+        with pytest.raises(RuntimeError):
+            resources.add_http_client("other", HttpClientSettings())
+
+    assert client.is_closed
+    assert _metric("http_client_requests_in_flight", client="fake") == 0
+
+
+# The server must run on the event loop of the test
+@pytest_asyncio.fixture(loop_scope="function")
+async def slow_server() -> AsyncGenerator[str, None]:
+    """
+    HTTP server answering every request after 50ms, with keep-alive
+    """
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            with suppress(asyncio.IncompleteReadError, ConnectionError):
+                while await reader.readuntil(b"\r\n\r\n"):
+                    await asyncio.sleep(0.05)
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()
+    async with server:
+        yield f"http://{host}:{port}"
+
+
+@pytest.mark.asyncio
+async def test_http_client_pool_metrics(slow_server: str):
+    resources = Resources()
+    resources.add_http_client(
+        "pool-test", HttpClientSettings(slow_server, max_connections=1)
+    )
+    waits_before = _metric("http_client_pool_wait_seconds_sum", client="pool-test")
+    opened_before = _metric("http_client_connections_opened_total", client="pool-test")
+
+    async with resources:
+        client = resources.http("pool-test")
+        responses = await asyncio.gather(*(client.get("/") for _ in range(3)))
+        assert [response.text for response in responses] == ["ok"] * 3
+
+        labels = {"client": "pool-test"}
+        assert _metric("http_client_requests_in_flight", **labels) == 0
+        assert _metric("http_client_connections_in_use", **labels) == 0
+        # The only connection is kept alive and reused
+        opened = _metric("http_client_connections_opened_total", **labels)
+        assert (opened or 0) - (opened_before or 0) == 1
+
+    # Requests waited for the previous ones to finish: 50 + 100ms
+    waits = _metric("http_client_pool_wait_seconds_sum", client="pool-test")
+    assert (waits or 0) - (waits_before or 0) >= 0.14
+
+
+@pytest.mark.asyncio
+async def test_resources_of_offloaded_methods():
+    resources = Resources()
+    resources.add_http_client("backend", HttpClientSettings("http://backend"))
+    async with resources:
+        # Pickled with the Api for methods offloaded to processes
+        api = pickle.loads(pickle.dumps(DefaultApi(resources)))
+
+    with pytest.raises(RuntimeError, match="offloaded to processes"):
+        api.resources.http("backend")
@@ -0,0 +1,297 @@
+"""
+Adaptive concurrency limiting and load shedding
+
+When a dependency slows down, accepting more requests than the service can
+finish only grows the latency of all of them. LoadSheddingMiddleware bounds
+the number of requests in flight by a limit adjusted with AIMD:
+- a request slower than `latency_threshold` decreases the limit by `backoff`,
+  at most once per round trip: requests started before the decrease
+  do not decrease it again
+- a fast request increases the limit by 1/limit, about +1 per round trip,
+  only while the limit is actually used
+
+Requests over the limit wait in a bounded queue, higher priority first.
+When the queue is full or the wait takes longer than `queue_timeout`,
+the request is rejected right away with 503 and Retry-After header.
+
+A request holds its slot until its response starts, the latency of the limit
+is the time to the first byte of the response. Sending the body to slow
+clients and long-lived streams (NDJSON, server-sent events) do not hold
+the slots of other requests and do not decrease the limit.
+
+The limit is per worker process. /health, /ready and /metrics are never limited,
+so probes and scrapes keep working under overload.
+"""
+
+import asyncio
+import bisect
+import itertools
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Mapping
+
+from prometheus_client import Counter, Gauge
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+__all__ = [
+    "LoadSheddingSettings",
+    "AimdLimit",
+    "ConcurrencyLimiter",
+    "LoadSheddingMiddleware",
+    "parse_priorities",
+]
+
+LIMIT = Gauge(
+    "load_shedding_concurrency_limit",
+    "Current limit of requests in flight",
+    multiprocess_mode="livesum",
+)
+REJECTED = Counter(
+    "load_shedding_rejected_requests_total",
+    "Requests rejected with 503 by load shedding",
+    ["reason"],
+)
+
+# UserError body, the same shape as errors of API endpoints
+_REJECTED_BODY = (
+    b'{"error":"ServiceOverloaded","detail":"Service is overloaded, retry later"}'
+)
+
+
+@dataclass(frozen=True)
+class LoadSheddingSettings:
+    initial_limit: int = 20
+    min_limit: int = 2
+    max_limit: int = 500
+    # Requests slower than this decrease the limit, seconds
+    latency_threshold: float = 1.0
+    # Multiplier of the limit on decrease
+    backoff: float = 0.9
+    # Requests waiting for a free slot, the rest is rejected
+    queue_size: int = 100
+    # Longest wait for a free slot, seconds
+    queue_timeout: float = 1.0
+    # Value of Retry-After header of rejected requests, seconds
+    retry_after: int = 1
+    # Priority by path prefix, e.g. {"/batch": -1}, higher is served first.
+    # Other paths have priority 0
+    priorities: Mapping[str, int] = field(default_factory=dict)
+    # Paths that are never limited
+    exempt_paths: tuple[str, ...] = ("/health", "/ready", "/metrics")
+
+
+def parse_priorities(value: str) -> dict[str, int]:
+    """
+    Parse priorities separated by semicolon: "/echo=1;/batch=-1"
+    """
+    priorities = {}
+    for item in value.split(";"):
+        if not item.strip():
+            continue
+        prefix, sep, priority = item.partition("=")
+        if not sep:
+            raise ValueError(f"Expected <path prefix>=<priority>, got {item!r}")
+        priorities[prefix.strip()] = int(priority)
+    return priorities
+
+
+class AimdLimit:
+    """
+    Additive increase, multiplicative decrease of the concurrency limit
+    """
+
+    def __init__(self, settings: LoadSheddingSettings):
+        self.settings = settings
+        self.limit = float(settings.initial_limit)
+        self._last_decrease = -math.inf
+
+    def update(self, started_at: float, latency: float, in_flight: int) -> None:
+        """
+        Adjust the limit by a finished request,
+        in_flight is the number of requests in flight when it started
+        """
+        settings = self.settings
+        if latency > settings.latency_threshold:
+            if started_at >= self._last_decrease:
+                self.limit = max(settings.min_limit, self.limit * settings.backoff)
+                self._last_decrease = started_at + latency
+        elif in_flight * 2 >= self.limit:
+            self.limit = min(settings.max_limit, self.limit + 1 / self.limit)
+
+
+@dataclass(order=True)
+class _Waiter:
+    # Sort key: higher priority first, then first come first served
+    key: tuple[int, int]
+    # Resolved with None when admitted, with reason when rejected
+    future: "asyncio.Future[str | None]" = field(compare=False)
+
+
+class ConcurrencyLimiter:
+    """
+    Admits requests up to the adaptive limit, queues the rest by priority
+    """
+
+    def __init__(
+        self,
+        settings: LoadSheddingSettings,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.settings = settings
+        self.clock = clock
+        self.limit = AimdLimit(settings)
+        self.in_flight = 0
+        # Sorted, the next admitted request first
+        self._queue: list[_Waiter] = []
+        self._counter = itertools.count()
+        self._exported_limit = settings.initial_limit
+        LIMIT.set(self._exported_limit)
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self, priority: int = 0) -> str | None:
+        """
+        Wait for a slot, returns reason of rejection if the request is rejected
+        """
+        if self.in_flight < self.limit.limit and not self._queue:
+            self.in_flight += 1
+            return None
+
+        waiter = _Waiter(
+            (-priority, next(self._counter)),
+            asyncio.get_running_loop().create_future(),
+        )
+        if len(self._queue) >= self.settings.queue_size:
+            # Lower priority request makes room, otherwise the new one is rejected
+            if not self._queue or waiter > self._queue[-1]:
+                return "queue_full"
+            evicted = self._queue.pop()
+            # Cancelled waiters stay in the queue until their task resumes
+            if not evicted.future.done():
+                evicted.future.set_result("queue_full")
+        bisect.insort(self._queue, waiter)
+
+        timer = asyncio.get_running_loop().call_later(
+            self.settings.queue_timeout, self._expire, waiter
+        )
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                # Admission and eviction skip and drop cancelled waiters
+                if waiter in self._queue:
+                    self._queue.remove(waiter)
+            elif waiter.future.result() is None:
+                # Admitted right before the cancellation
+                self.in_flight -= 1
+                self._admit()
+            raise
+        finally:
+            timer.cancel()
+
+    def release(self, started_at: float, in_flight: int) -> None:
+        """
+        Free the slot of a request started at started_at
+        with in_flight requests in flight
+        """
+        self.in_flight -= 1
+        self.limit.update(started_at, self.clock() - started_at, in_flight)
+
+        exported_limit = int(self.limit.limit)
+        if exported_limit != self._exported_limit:
+            LIMIT.set(exported_limit)
+            self._exported_limit = exported_limit
+
+        self._admit()
+
+    def _admit(self) -> None:
+        while self._queue and self.in_flight < self.limit.limit:
+            waiter = self._queue.pop(0)
+            if waiter.future.done():
+                # Cancelled, its task has not resumed yet
+                continue
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _expire(self, waiter: _Waiter) -> None:
+        if not waiter.future.done():
+            self._queue.remove(waiter)
+            waiter.future.set_result("queue_timeout")
+
+
+class LoadSheddingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        settings: LoadSheddingSettings,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.app = app
+        self.settings = settings
+        self.limiter = ConcurrencyLimiter(settings, clock)
+        self._exempt_paths = frozenset(settings.exempt_paths)
+        # Longest prefix first
+        self._priorities = sorted(
+            settings.priorities.items(), key=lambda item: -len(item[0])
+        )
+        self._rejected_headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(_REJECTED_BODY)).encode()),
+            (b"retry-after", str(settings.retry_after).encode()),
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        if path in self._exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiter
+        rejected = await limiter.acquire(self._priority(path))
+        if rejected is not None:
+            REJECTED.labels(rejected).inc()
+            await self._reject(send)
+            return
+
+        in_flight = limiter.in_flight
+        started_at = limiter.clock()
+        released = False
+
+        async def send_started(message: Message) -> None:
+            nonlocal released
+            if not released and message["type"] == "http.response.start":
+                released = True
+                limiter.release(started_at, in_flight)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_started)
+        finally:
+            if not released:
+                limiter.release(started_at, in_flight)
+
+    def _priority(self, path: str) -> int:
+        for prefix, priority in self._priorities:
+            if path.startswith(prefix):
+                return priority
+        return 0
+
+    async def _reject(self, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": self._rejected_headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": _REJECTED_BODY})
@@ -0,0 +1,268 @@
+"""
+Tests for adaptive concurrency limiting and load shedding
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from prometheus_client import REGISTRY
+from starlette.responses import Response, StreamingResponse
+
+from .bench import percentile
+from .shedding import (
+    AimdLimit,
+    ConcurrencyLimiter,
+    LoadSheddingMiddleware,
+    LoadSheddingSettings,
+    parse_priorities,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def test_aimd_limit():
+    limit = AimdLimit(
+        LoadSheddingSettings(
+            initial_limit=10, min_limit=5, max_limit=11, latency_threshold=1.0
+        )
+    )
+
+    # Slow request decreases the limit
+    limit.update(started_at=0.0, latency=2.0, in_flight=10)
+    assert limit.limit == 9
+    # Requests started before the decrease do not decrease it again
+    limit.update(started_at=1.0, latency=1.5, in_flight=10)
+    assert limit.limit == 9
+    limit.update(started_at=2.0, latency=1.5, in_flight=10)
+    assert limit.limit == pytest.approx(8.1)
+
+    # Fast request increases the limit only if the limit is used
+    limit.limit = 10
+    limit.update(started_at=4.0, latency=0.1, in_flight=2)
+    assert limit.limit == 10
+    limit.update(started_at=4.0, latency=0.1, in_flight=5)
+    assert limit.limit == 10.1
+
+    # Bounds
+    for _ in range(100):
+        limit.update(started_at=4.0, latency=0.1, in_flight=10)
+    assert limit.limit == 11
+    for started_at in range(5, 100):
+        limit.update(started_at=started_at, latency=2.0, in_flight=10)
+    assert limit.limit == 5
+
+
+def _limiter(**settings: Any) -> ConcurrencyLimiter:
+    # The limit stays at 1
+    return ConcurrencyLimiter(
+        LoadSheddingSettings(initial_limit=1, max_limit=1, **settings)
+    )
+
+
+@pytest.mark.asyncio
+async def test_limiter_priority():
+    limiter = _limiter(queue_size=2, queue_timeout=10)
+    assert await limiter.acquire() is None
+
+    normal = asyncio.ensure_future(limiter.acquire(0))
+    high = asyncio.ensure_future(limiter.acquire(1))
+    await asyncio.sleep(0)
+    assert limiter.queued == 2
+
+    # Queue is full of requests with higher priority
+    assert await limiter.acquire(-1) == "queue_full"
+    # Request with the lowest priority makes room for the more important one
+    highest = asyncio.ensure_future(limiter.acquire(2))
+    assert await normal == "queue_full"
+
+    # Higher priority first
+    limiter.release(limiter.clock(), 1)
+    assert await highest is None
+    assert not high.done()
+    limiter.release(limiter.clock(), 1)
+    assert await high is None
+    assert limiter.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_timeout_and_cancel():
+    limiter = _limiter(queue_size=10, queue_timeout=0.01)
+    assert await limiter.acquire() is None
+
+    assert await limiter.acquire() == "queue_timeout"
+
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert limiter.queued == 0
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_limiter_release_after_cancel():
+    limiter = _limiter(queue_size=10, queue_timeout=10)
+    assert await limiter.acquire() is None
+
+    cancelled = asyncio.ensure_future(limiter.acquire())
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.queued == 2
+
+    # Released before the cancelled task resumes, e.g. on shutdown
+    cancelled.cancel()
+    limiter.release(limiter.clock(), 1)
+
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    # The slot goes to the next waiter instead of being lost
+    assert await waiting is None
+    assert limiter.queued == 0
+    assert limiter.in_flight == 1
+    limiter.release(limiter.clock(), 1)
+    assert limiter.in_flight == 0
+
+    # A cancelled waiter can be evicted by a higher priority request
+    limiter = _limiter(queue_size=1, queue_timeout=10)
+    assert await limiter.acquire() is None
+    cancelled = asyncio.ensure_future(limiter.acquire(0))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    high = asyncio.ensure_future(limiter.acquire(1))
+    await asyncio.sleep(0)
+
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert limiter.queued == 1
+    limiter.release(limiter.clock(), 1)
+    assert await high is None
+    assert limiter.in_flight == 1
+
+
+def make_app(settings: LoadSheddingSettings, capacity: int = 1000) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(LoadSheddingMiddleware, settings=settings)
+    # Downstream that serves `capacity` requests at once
+    downstream = asyncio.Semaphore(capacity)
+
+    @app.get("/health")
+    async def health() -> Response:
+        return Response("OK")
+
+    @app.get("/work")
+    async def work(seconds: float = 0.0) -> Response:
+        async with downstream:
+            await asyncio.sleep(seconds)
+        return Response("done")
+
+    app.state.stream_done = asyncio.Event()
+
+    @app.get("/stream")
+    async def stream() -> StreamingResponse:
+        async def items():
+            yield b"first\n"
+            await app.state.stream_done.wait()
+            yield b"last\n"
+
+        return StreamingResponse(items())
+
+    return app
+
+
+@pytest.mark.asyncio
+async def test_middleware_rejects():
+    app = make_app(LoadSheddingSettings(initial_limit=1, max_limit=1, queue_size=0))
+    rejected_before = REGISTRY.get_sample_value(
+        "load_shedding_rejected_requests_total", {"reason": "queue_full"}
+    )
+
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        slow = asyncio.ensure_future(client.get("/work", params={"seconds": 0.1}))
+        await asyncio.sleep(0.02)
+
+        response = await client.get("/work")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+        assert response.json() == {
+            "error": "ServiceOverloaded",
+            "detail": "Service is overloaded, retry later",
+        }
+
+        # Health checks are not limited
+        assert (await client.get("/health")).status_code == 200
+        assert (await slow).status_code == 200
+
+    rejected_after = REGISTRY.get_sample_value(
+        "load_shedding_rejected_requests_total", {"reason": "queue_full"}
+    )
+    assert rejected_after == (rejected_before or 0) + 1
+
+
+@pytest.mark.asyncio
+async def test_middleware_streams():
+    settings = LoadSheddingSettings(initial_limit=1, max_limit=1, queue_size=0)
+    app = make_app(settings)
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        stream = asyncio.ensure_future(client.get("/stream"))
+        await asyncio.sleep(0.02)
+
+        # The slot is released once the response has started
+        assert (await client.get("/work")).status_code == 200
+        app.state.stream_done.set()
+        assert (await stream).text == "first\nlast\n"
+
+
+def test_parse_priorities():
+    assert parse_priorities("/echo=1; /batch=-1;") == {"/echo": 1, "/batch": -1}
+    with pytest.raises(ValueError):
+        parse_priorities("/echo")
+
+
+async def _overload(app: FastAPI, n_requests: int) -> tuple[list[float], int]:
+    """
+    Send all requests at once, returns latencies of served requests
+    and number of rejected ones
+    """
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+        async def request() -> tuple[float, int]:
+            start = time.perf_counter()
+            response = await client.get("/work", params={"seconds": 0.01})
+            return time.perf_counter() - start, response.status_code
+
+        results = await asyncio.gather(*(request() for _ in range(n_requests)))
+
+    served = [latency for latency, status in results if status == 200]
+    return served, n_requests - len(served)
+
+
+@pytest.mark.asyncio
+async def test_overload_latency():
+    """
+    Downstream serves 4 requests at once, 200 requests arrive together
+    """
+    unlimited, _ = await _overload(
+        make_app(LoadSheddingSettings(initial_limit=1000), capacity=4), 200
+    )
+    settings = LoadSheddingSettings(
+        initial_limit=20, latency_threshold=0.05, queue_size=20, queue_timeout=0.05
+    )
+    limited, rejected = await _overload(make_app(settings, capacity=4), 200)
+
+    logger.info(
+        "p99 latency: %.0fms with load shedding (%s rejected), %.0fms without",
+        percentile(limited, 99) * 1000,
+        rejected,
+        percentile(unlimited, 99) * 1000,
+    )
+    assert rejected > 0
+    assert percentile(limited, 99) < percentile(unlimited, 99) / 2
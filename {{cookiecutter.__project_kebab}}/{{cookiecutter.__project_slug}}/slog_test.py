@@ -3,16 +3,21 @@ tests for structured logging module (slog.py)
 """
 
 import asyncio
+import json
 import logging
+import random
 import time
 import uuid
+from datetime import datetime, timezone
+from typing import Any
 from unittest.mock import ANY
 
 import pytest
 
 from {{cookiecutter.__project_slug}}.conftest import JsonLogs
 
-from .slog import logging_context
+from . import slog
+from .slog import GcpStructuredFormatter, logging_context
 
 logger = logging.getLogger("test_logger")
 
@@ -181,3 +186,116 @@ def test_structured_info_http(structured_logs_capture: JsonLogs):
             "logging.googleapis.com/labels": {"logger": "test_logger"},
         }
     ]
+
+
+def _legacy_format_labels(record: logging.LogRecord) -> dict[str, Any]:
+    labels = {"logger": record.name}
+
+    if ctx_labels := slog.CONTEXT_LABELS.get():
+        for key, value in ctx_labels.merged().items():
+            if value is not None and key not in slog.RESERVED:
+                labels[key] = str(value)
+
+    for key, value in record.__dict__.items():
+        if value is not None and key not in slog.RESERVED:
+            labels[key] = str(value)
+
+    return labels
+
+
+def test_format_labels_order():
+    formatter = GcpStructuredFormatter()
+    record = logging.getLogger("test_logger").makeRecord(
+        "test_logger",
+        logging.INFO,
+        __file__,
+        1,
+        "message",
+        (),
+        None,
+        extra={"z": 1, "a": None, "m": "x", "name_": [1]},
+    )
+    # Set by other formatters after the record is created
+    record.message = "message"
+
+    with logging_context(c=1, b=None, a=2):
+        with logging_context(b=3, c=None, d=uuid.UUID(int=0)):
+            labels = formatter._format_labels(record)
+            assert list(labels.items()) == list(_legacy_format_labels(record).items())
+            assert labels == {
+                "logger": "test_logger",
+                "b": "3",
+                "a": "2",
+                "d": "00000000-0000-0000-0000-000000000000",
+                "z": "1",
+                "m": "x",
+                "name_": "[1]",
+                "message": "message",
+            }
+
+
+def test_logging_context_layers():
+    with logging_context(a=1, b=2):
+        parent = slog.CONTEXT_LABELS.get()
+        with logging_context(b=None, name="reserved"):
+            child = slog.CONTEXT_LABELS.get()
+
+            assert child is not None and child.parent is parent
+            # Child stores only its own labels
+            assert child.labels == {"b": None, "name": "reserved"}
+            assert child.visible() == {"a": "1"}
+            # Read like the dict of all labels
+            assert child == {"a": 1, "b": None, "name": "reserved"}
+            assert child["a"] == 1 and child.get("c") is None
+
+    assert slog.CONTEXT_LABELS.get() is None
+
+
+def test_local_timestamp_to_utc():
+    rnd = random.Random(42)
+    timestamps = [0.0, 0.9999995, 1689083906.744488, 1689083906.9999999]
+    timestamps += [rnd.uniform(0, 4_000_000_000) for _ in range(10000)]
+
+    for timestamp in timestamps:
+        expected = datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%S.%fZ"
+        )
+        assert slog._local_timestamp_to_utc(timestamp) == expected
+
+
+JSON_PAYLOADS: list[Any] = [
+    {
+        "severity": "INFO",
+        "message": 'quotes " \\ slashes / unicode é 😀 controls \x00\x1f\n\t',
+        "httpRequest": {"status": 200, "requestSize": None, "responseSize": 10},
+        "logging.googleapis.com/labels": {"logger": "test", "flag": True},
+    },
+    {"big": 2**70, "list": [1, "2", None, False]},
+]
+
+
+@pytest.mark.parametrize("payload", JSON_PAYLOADS)
+def test_json_dumps(payload: Any):
+    assert slog._json_dumps_stdlib(payload) == json.dumps(payload)
+    compact = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    assert slog._json_dumps_compact_stdlib(payload) == compact
+    assert slog._json_dumps_compact(payload) == compact
+
+
+@pytest.mark.parametrize("payload", JSON_PAYLOADS)
+def test_json_dumps_orjson(payload: Any):
+    pytest.importorskip("orjson")
+
+    assert slog._json_dumps_orjson(payload) == slog._json_dumps_compact_stdlib(payload)
+
+
+def test_compact_json():
+    record = logging.LogRecord(
+        "test_logger", logging.INFO, __file__, 1, "unicode é", (), None
+    )
+    default = GcpStructuredFormatter().format(record)
+    compact = GcpStructuredFormatter(compact_json=True).format(record)
+
+    assert '"message": "unicode \\u00e9"' in default
+    assert '"message":"unicode é"' in compact
+    assert json.loads(compact) == json.loads(default)
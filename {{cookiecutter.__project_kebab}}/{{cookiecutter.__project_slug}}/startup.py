@@ -0,0 +1,126 @@
+"""
+Startup profiling
+
+Cold start of a new pod delays scale-out, it consists of
+imports of the application modules and the time until the server
+accepts its first connection. Both are measured in a fresh interpreter,
+use `{{cookiecutter.__project_kebab}} profile-startup` to run it from the console.
+"""
+
+import re
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+
+__all__ = [
+    "ImportRecord",
+    "parse_importtime",
+    "profile_imports",
+    "format_import_tree",
+    "free_port",
+    "time_to_first_response",
+]
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+
+@dataclass
+class ImportRecord:
+    name: str
+    # Time spent in the module itself, microseconds
+    self_us: int
+    # Time including imported modules, microseconds
+    cumulative_us: int
+    children: list["ImportRecord"] = field(default_factory=list)
+
+
+def parse_importtime(output: str) -> list[ImportRecord]:
+    """
+    Build import tree from `python -X importtime` output.
+
+    Modules are printed after their imports, nesting is shown by indentation
+    """
+    pending: dict[int, list[ImportRecord]] = {}
+    for line in output.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = (len(indent) - 1) // 2
+        record = ImportRecord(
+            name, int(self_us), int(cumulative_us), pending.pop(depth + 1, [])
+        )
+        pending.setdefault(depth, []).append(record)
+    return pending.get(0, [])
+
+
+def profile_imports(module: str) -> list[ImportRecord]:
+    """
+    Import module in a fresh interpreter and return its import tree
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def format_import_tree(records: list[ImportRecord], min_ms: float = 5.0) -> str:
+    """
+    Format imports that took at least min_ms, slowest first
+    """
+    lines = [f"{'cumulative ms':>14}{'self ms':>10}  module"]
+
+    def visit(record: ImportRecord, depth: int) -> None:
+        if record.cumulative_us < min_ms * 1000:
+            return
+        lines.append(
+            f"{record.cumulative_us / 1000:>14.1f}{record.self_us / 1000:>10.1f}  "
+            f"{'  ' * depth}{record.name}"
+        )
+        for child in sorted(record.children, key=lambda r: -r.cumulative_us):
+            visit(child, depth + 1)
+
+    for record in sorted(records, key=lambda r: -r.cumulative_us):
+        visit(record, 0)
+    return "\n".join(lines)
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_response(
+    command: list[str],
+    host: str,
+    port: int,
+    path: str = "/health",
+    timeout: float = 30.0,
+) -> float:
+    """
+    Start server command and measure seconds until it responds to HTTP request
+    """
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                with socket.create_connection((host, port), timeout=timeout) as conn:
+                    conn.sendall(request)
+                    if conn.recv(1024).startswith(b"HTTP/"):
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+        raise TimeoutError(f"Server did not respond in {timeout} seconds")
+    finally:
+        process.terminate()
+        process.wait()
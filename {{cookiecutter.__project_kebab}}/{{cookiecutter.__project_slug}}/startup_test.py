@@ -0,0 +1,73 @@
+"""
+Tests for startup profiling
+"""
+
+import subprocess
+import sys
+
+from .startup import (
+    format_import_tree,
+    free_port,
+    parse_importtime,
+    profile_imports,
+    time_to_first_response,
+)
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   _io
+import time:      1000 |       1100 | _frozen_importlib_external
+import time:       200 |        200 |     c
+import time:       300 |        500 |   b
+import time:      2000 |       2000 |   d
+import time:      4000 |       6500 | a
+"""
+
+
+def test_parse_importtime():
+    first, second = parse_importtime(IMPORTTIME_OUTPUT)
+
+    assert (first.name, first.self_us, first.cumulative_us) == (
+        "_frozen_importlib_external",
+        1000,
+        1100,
+    )
+    assert [child.name for child in first.children] == ["_io"]
+
+    assert second.name == "a"
+    assert [child.name for child in second.children] == ["b", "d"]
+    assert [child.name for child in second.children[0].children] == ["c"]
+
+    assert format_import_tree([first, second], min_ms=0.5).splitlines()[1:] == [
+        "           6.5       4.0  a",
+        "           2.0       2.0    d",
+        "           0.5       0.3    b",
+        "           1.1       1.0  _frozen_importlib_external",
+    ]
+
+
+def test_profile_imports():
+    names = [record.name for record in profile_imports("json")]
+    assert "json" in names
+
+
+def test_lazy_imports():
+    """
+    Server and error reporting are not imported with the application
+    """
+    package = __name__.rsplit(".", 1)[0]
+    code = (
+        f"import sys, {package}.main, {package}.cli; "
+        "print(*sorted({'uvicorn', 'uvloop', 'sentry_sdk'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_time_to_first_response():
+    port = free_port()
+    command = [sys.executable, "-m", "http.server", str(port), "--bind", "127.0.0.1"]
+    seconds = time_to_first_response(command, "127.0.0.1", port, path="/")
+    assert 0 < seconds < 30
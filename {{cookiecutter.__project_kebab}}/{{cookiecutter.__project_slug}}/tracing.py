@@ -0,0 +1,143 @@
+"""
+Request tracing with Sentry
+
+TrackingMiddleware reports a request as a Sentry transaction when it is:
+- head-sampled: decided with `sample_rate` probability when the request starts.
+  The transaction is active while the request is processed, so spans
+  of Sentry integrations (HTTP clients, databases) are attached to it
+- tail-sampled: slower than `slow_threshold` or failed with 5xx status.
+  Decided after the response, the transaction is created afterwards
+  and contains timing of the request only
+
+Requests that are not sampled cost one random number and two comparisons.
+sentry_sdk is imported only when a request is reported, it is initialized
+by the CLI when SENTRY_DSN is set, see cli.py
+"""
+
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable
+
+from starlette.types import Scope
+
+if TYPE_CHECKING:
+    from sentry_sdk.tracing import Transaction
+
+__all__ = ["TracingPolicy", "RequestTracer", "traces_sampler"]
+
+_OP = "http.server"
+
+
+@dataclass(frozen=True)
+class TracingPolicy:
+    # Share of requests traced from the start, including spans of integrations
+    sample_rate: float = 0.0
+    # Requests slower than this are always reported, seconds
+    slow_threshold: float | None = None
+    # Requests failed with 5xx status are always reported
+    keep_errors: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.sample_rate > 0 or self.slow_threshold is not None or self.keep_errors
+        )
+
+
+def traces_sampler(sampling_context: dict[str, Any]) -> float:
+    """
+    `traces_sampler` for sentry_sdk.init when tracing is enabled.
+
+    RequestTracer marks its transactions as sampled explicitly, which bypasses
+    the sampler. Transactions started by Sentry integrations are dropped,
+    otherwise requests would be reported twice
+    """
+    return 0.0
+
+
+class RequestTracer:
+    def __init__(
+        self, policy: TracingPolicy, random: Callable[[], float] = random.random
+    ):
+        self.policy = policy
+        self.random = random
+
+    def head_sampled(self) -> bool:
+        """
+        Whether the request is traced from the start
+        """
+        return self.policy.sample_rate > 0 and self.random() < self.policy.sample_rate
+
+    def start(self, method: str, path: str, headers: dict[str, str]) -> "Transaction":
+        """
+        Start transaction of head-sampled request, continuing incoming trace
+        """
+        import sentry_sdk
+
+        transaction = sentry_sdk.continue_trace(
+            headers, op=_OP, name=f"{method} {path}", source="url"
+        )
+        transaction.sampled = True
+        return sentry_sdk.start_transaction(transaction)  # type: ignore
+
+    def finish(
+        self,
+        transaction: "Transaction | None",
+        scope: Scope,
+        status_code: int,
+        latency: float,
+        request_id: str | None,
+    ) -> None:
+        """
+        Describe head-sampled transaction, it is finished by exiting its context.
+        Report not sampled request if it is slow or failed
+        """
+        if transaction is not None:
+            self._describe(transaction, scope, status_code, request_id, "head")
+            return
+
+        if status_code >= 500 and self.policy.keep_errors:
+            reason = "error"
+        elif (
+            self.policy.slow_threshold is not None
+            and latency >= self.policy.slow_threshold
+        ):
+            reason = "slow"
+        else:
+            return
+
+        import sentry_sdk
+        from sentry_sdk.tracing import Transaction
+
+        end = datetime.now(timezone.utc)
+        reported = sentry_sdk.start_transaction(
+            op=_OP,
+            name=f"{scope['method']} {scope['path']}",
+            source="url",
+            sampled=True,
+            start_timestamp=end - timedelta(seconds=latency),
+        )
+        if not isinstance(reported, Transaction):
+            # No-op span, Sentry is set up with another instrumenter
+            return
+        self._describe(reported, scope, status_code, request_id, reason)
+        reported.finish(end_timestamp=end)
+
+    @staticmethod
+    def _describe(
+        transaction: "Transaction",
+        scope: Scope,
+        status_code: int,
+        request_id: str | None,
+        reason: str,
+    ) -> None:
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            # Group transactions by route template, not by actual path
+            transaction.name = f"{scope['method']} {route.path}"
+            transaction.source = "route"
+        transaction.set_http_status(status_code)
+        transaction.set_tag("sampling", reason)
+        if request_id is not None:
+            transaction.set_tag("request_id", request_id)
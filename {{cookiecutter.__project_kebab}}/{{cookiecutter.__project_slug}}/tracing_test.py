@@ -0,0 +1,123 @@
+"""
+Tests for Sentry request tracing
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Callable, Generator
+
+import httpx
+import pytest
+import sentry_sdk
+from fastapi import FastAPI
+from sentry_sdk.envelope import Envelope
+from sentry_sdk.transport import Transport
+from starlette.responses import Response
+
+from .tracing import RequestTracer, TracingPolicy, traces_sampler
+from .tracking import TrackingMiddleware
+
+logger = logging.getLogger(__name__)
+
+TRACE_ID = "771a43a4192642f0b136d5159a501700"
+
+
+class CapturingTransport(Transport):
+    def __init__(self) -> None:
+        super().__init__()
+        self.transactions: list[dict[str, Any]] = []
+
+    def capture_envelope(self, envelope: Envelope) -> None:
+        for item in envelope.items:
+            if item.type == "transaction" and item.payload.json is not None:
+                self.transactions.append(item.payload.json)
+
+
+@pytest.fixture()
+def sentry_transactions() -> Generator[list[dict[str, Any]], None, None]:
+    transport = CapturingTransport()
+    sentry_sdk.init(
+        dsn="http://public@localhost/1",
+        transport=transport,
+        traces_sampler=traces_sampler,
+        # Do not start monitoring thread, workers tests fork the process
+        enable_backpressure_handling=False,
+    )
+    try:
+        yield transport.transactions
+    finally:
+        sentry_sdk.init()
+
+
+def make_app(
+    policy: TracingPolicy, random: Callable[[], float] = lambda: 0.0
+) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(TrackingMiddleware, tracer=RequestTracer(policy, random))
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int, delay: float = 0, status: int = 200) -> Response:
+        with sentry_sdk.start_span(op="db.query", name="select item"):
+            await asyncio.sleep(delay)
+        return Response(str(item_id), status_code=status)
+
+    return app
+
+
+async def _get(app: FastAPI, path: str, **kwargs: Any) -> httpx.Response:
+    transport = httpx.ASGITransport(app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(path, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_head_sampled(sentry_transactions: list[dict[str, Any]]):
+    app = make_app(TracingPolicy(sample_rate=1.0))
+    await _get(
+        app,
+        "/items/1",
+        headers={"x-request-id": "abc", "sentry-trace": f"{TRACE_ID}-{'1' * 16}-1"},
+    )
+
+    (transaction,) = sentry_transactions
+    assert transaction["transaction"] == "GET /items/{item_id}"
+    assert transaction["transaction_info"] == {"source": "route"}
+    assert transaction["contexts"]["trace"]["trace_id"] == TRACE_ID
+    assert transaction["tags"]["request_id"] == "abc"
+    assert transaction["tags"]["sampling"] == "head"
+    assert transaction["tags"]["http.status_code"] == "200"
+    assert [span["op"] for span in transaction["spans"]] == ["db.query"]
+
+
+@pytest.mark.asyncio
+async def test_tail_sampled(sentry_transactions: list[dict[str, Any]]):
+    app = make_app(TracingPolicy(slow_threshold=0.05, keep_errors=True))
+    await _get(app, "/items/1")
+    await _get(app, "/items/2", params={"delay": 0.06})
+    await _get(app, "/items/3", params={"status": 503})
+    await _get(app, "/items/4", params={"status": 404})
+
+    slow, failed = sentry_transactions
+    assert slow["tags"]["sampling"] == "slow"
+    duration = datetime.fromisoformat(slow["timestamp"]) - datetime.fromisoformat(
+        slow["start_timestamp"]
+    )
+    assert duration.total_seconds() >= 0.06
+    assert failed["tags"]["sampling"] == "error"
+    assert failed["tags"]["http.status_code"] == "503"
+    assert failed["transaction"] == "GET /items/{item_id}"
+    # Spans of not sampled requests are not recorded
+    assert slow["spans"] == failed["spans"] == []
+
+
+@pytest.mark.asyncio
+async def test_not_sampled(sentry_transactions: list[dict[str, Any]]):
+    app = make_app(
+        TracingPolicy(sample_rate=0.5, slow_threshold=10, keep_errors=True),
+        random=lambda: 0.9,
+    )
+
+    await _get(app, "/items/1")
+    # Transactions started by Sentry integrations are dropped as well
+    assert sentry_transactions == []
@@ -1,110 +1,280 @@
 """
 Tracking middleware
+
+Implemented as a raw ASGI middleware: response status and size are captured
+by wrapping `send`, so the response body is never buffered and
+streaming responses pass through untouched.
+
+Which requests are logged is decided by AccessLog, see accesslog.py
 """
 
 import asyncio
 import logging
-from dataclasses import dataclass
-from functools import cached_property
+import urllib.parse
+from contextlib import nullcontext
+from typing import TYPE_CHECKING
 
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
-from uvicorn.protocols import utils as uviutils
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from {{cookiecutter.__project_slug}}.accesslog import AccessLog, AccessLogPolicy
+from {{cookiecutter.__project_slug}}.metrics import RequestMetrics
 from {{cookiecutter.__project_slug}}.slog import logging_context
+from {{cookiecutter.__project_slug}}.tracing import RequestTracer
+
+if TYPE_CHECKING:
+    from sentry_sdk.tracing import Transaction
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+def _path_with_query_string(scope: Scope) -> str:
+    # Same as uvicorn.protocols.utils.get_path_with_query_string,
+    # the app does not import uvicorn until it is served
+    path = urllib.parse.quote(scope["path"])
+    if scope["query_string"]:
+        return f"{path}?{scope['query_string'].decode('ascii')}"
+    return path
+
+
+# Protocol strings of the common HTTP versions, formatted once
+_HTTP_VERSIONS = {version: f"HTTP/{version}" for version in ("1.0", "1.1", "2", "3")}
+
+
+def _parse_content_length(value: bytes | None) -> int | None:
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
 class RequestView:
-    request: Request
+    """
+    Request attributes used by access logs, metrics and tracing.
+
+    The needed headers are taken in one pass over raw ASGI headers,
+    other values are derived on access: most requests are not logged
+    """
+
+    __slots__ = (
+        "scope",
+        "method",
+        "http_version",
+        "request_id",
+        "user_agent",
+        "content_length",
+    )
+
+    def __init__(self, scope: Scope) -> None:
+        self.scope = scope
+        self.method: str = scope["method"]
+        version = scope["http_version"]
+        self.http_version = _HTTP_VERSIONS.get(version) or f"HTTP/{version}"
+
+        request_id = user_agent = content_length = None
+        # ASGI header names are lowercase, the last value wins
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value
+            elif name == b"user-agent":
+                user_agent = value
+            elif name == b"content-length":
+                content_length = value
+        self.request_id = None if request_id is None else request_id.decode("latin-1")
+        self.user_agent = None if user_agent is None else user_agent.decode("latin-1")
+        self.content_length = _parse_content_length(content_length)
 
     @property
     def client_addr(self) -> str:
-        client = self.request.scope.get("client")
+        client = self.scope.get("client")
         if not client:
             return ""
         return f"{client[0]}:{client[1]}"
 
     @property
     def url_path(self) -> str:
-        return uviutils.get_path_with_query_string(self.request.scope)  # type: ignore
+        return _path_with_query_string(self.scope)
 
     @property
-    def method(self) -> str:
-        return self.request["method"]
+    def headers(self) -> dict[str, str]:
+        """
+        All headers, for the requests traced from the start only
+        """
+        return {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in self.scope["headers"]
+        }
 
-    @property
-    def http_version(self) -> str:
-        version = self.request["http_version"]
-        return f"HTTP/{version}"
 
-    @cached_property
-    def request_id(self) -> str | None:
-        return self.headers.get("x-request-id")
+class ResponseView:
+    __slots__ = ("status_code", "body_size", "_content_length")
+
+    def __init__(self) -> None:
+        # Until the application starts the response we assume it failed
+        self.status_code = 500
+        # Number of body bytes actually sent to the client
+        self.body_size = 0
+        self._content_length: int | None = None
+
+    def started(self, message: Message) -> None:
+        self.status_code = message["status"]
+        for name, value in message.get("headers", ()):
+            if name.lower() == b"content-length":
+                self._content_length = _parse_content_length(value)
+                break
 
     @property
     def content_length(self) -> int | None:
-        try:
-            content_length = self.headers["Content-Length"]
-            return int(content_length)
-        except KeyError:
-            return None
+        if self._content_length is not None:
+            return self._content_length
+        # Streaming responses do not have Content-Length header
+        return self.body_size if self.body_size else None
 
-    @property
-    def user_agent(self) -> str | None:
-        return self.headers.get("user-agent")
 
-    @cached_property
-    def headers(self) -> dict:
-        return dict(self.request.headers.items())
+class TrackingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        tracer: RequestTracer | None = None,
+        metrics: RequestMetrics | None = None,
+        access_log: AccessLog | None = None,
+    ) -> None:
+        self.app = app
+        # Reports sampled requests to Sentry, see tracing.py
+        self.tracer = tracer
+        # Prometheus metrics, see metrics.py
+        self.metrics = metrics
+        # Every request is logged by default
+        self.access_log = access_log or AccessLog(AccessLogPolicy())
 
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            if scope["type"] == "lifespan" and self.access_log.summaries:
+                receive = self._write_summaries(receive)
+            await self.app(scope, receive, send)
+            return
 
-@dataclass
-class ResponseView:
-    response: Response
+        request_view = RequestView(scope)
+        response_view = ResponseView()
 
-    @property
-    def content_length(self) -> int | None:
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                response_view.started(message)
+            elif message["type"] == "http.response.body":
+                response_view.body_size += len(message.get("body", b""))
+            await send(message)
+
+        transaction = self._start_transaction(request_view, scope)
+        metrics = self.metrics
+        in_progress = False
+
+        with (
+            logging_context(request_id=request_view.request_id),
+            transaction or nullcontext(),
+        ):
+            loop = asyncio.get_running_loop()
+            # measure request time
+            start_time = loop.time()
+            try:
+                if metrics is not None:
+                    metrics.started(request_view.method)
+                    in_progress = True
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                end_time = loop.time()
+                latency = end_time - start_time
+                status_code = response_view.status_code
+                route_path = getattr(scope.get("route"), "path", None)
+                access_log = self.access_log
+                if logger.isEnabledFor(logging.INFO) and access_log.should_log(
+                    status_code, latency
+                ):
+                    self._log_request(request_view, response_view, latency)
+                if access_log.summaries:
+                    access_log.record(
+                        request_view.method, route_path, status_code, latency
+                    )
+                if metrics is not None and in_progress:
+                    metrics.finished(
+                        request_view.method,
+                        route_path,
+                        status_code,
+                        latency,
+                        request_view.content_length,
+                        response_view.content_length,
+                        request_view.request_id,
+                    )
+                if self.tracer is not None:
+                    # After metrics: failed tracing must not skip them
+                    try:
+                        self.tracer.finish(
+                            transaction,
+                            scope,
+                            status_code,
+                            latency,
+                            request_view.request_id,
+                        )
+                    except Exception:
+                        logger.exception("Failed to report the trace of the request")
+
+    def _start_transaction(
+        self, request_view: RequestView, scope: Scope
+    ) -> "Transaction | None":
+        if self.tracer is None or not self.tracer.head_sampled():
+            return None
+        # Failed tracing must not fail the request
         try:
-            content_length = self.response.headers["Content-Length"]
-            return int(content_length)
-        except KeyError:
+            # Headers are copied for the traced requests only
+            return self.tracer.start(
+                request_view.method, scope["path"], request_view.headers
+            )
+        except Exception:
+            logger.exception("Failed to start tracing the request")
             return None
 
+    def _write_summaries(self, receive: Receive) -> Receive:
+        """
+        Write access log summaries periodically while the app is running,
+        and the rest on shutdown
+        """
+        timer: asyncio.Task | None = None
 
-class TrackingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint):
-        request_view = RequestView(request)
+        async def receive_wrapper() -> Message:
+            nonlocal timer
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                timer = asyncio.create_task(self.access_log.write_summaries())
+            elif message["type"] == "lifespan.shutdown":
+                if timer is not None:
+                    timer.cancel()
+                self.access_log.flush()
+            return message
 
-        with logging_context(request_id=request_view.request_id):
-            # measure request time
-            start_time = asyncio.get_event_loop().time()
-            response = await call_next(request)
-            end_time = asyncio.get_event_loop().time()
-
-            response_view = ResponseView(response)
-
-            logger.info(
-                "%s %s %s",
-                request_view.method,
-                request_view.url_path,
-                request_view.http_version,
-                extra={
-                    "httpRequest": {
-                        "requestMethod": request_view.method,
-                        "requestUrl": request_view.url_path,
-                        "remoteIp": request_view.client_addr,
-                        "protocol": request_view.http_version,
-                        "userAgent": request_view.user_agent,
-                        "requestSize": request_view.content_length,
-                        "responseSize": response_view.content_length,
-                        "latency": f"{round(end_time - start_time, 6)}s",
-                        "status": response.status_code,
-                    }
-                },
-            )
+        return receive_wrapper
 
-        return response
+    @staticmethod
+    def _log_request(
+        request_view: RequestView,
+        response_view: ResponseView,
+        latency: float,
+    ) -> None:
+        logger.info(
+            "%s %s %s",
+            request_view.method,
+            request_view.url_path,
+            request_view.http_version,
+            extra={
+                "httpRequest": {
+                    "requestMethod": request_view.method,
+                    "requestUrl": request_view.url_path,
+                    "remoteIp": request_view.client_addr,
+                    "protocol": request_view.http_version,
+                    "userAgent": request_view.user_agent,
+                    "requestSize": request_view.content_length,
+                    "responseSize": response_view.content_length,
+                    "latency": f"{round(latency, 6)}s",
+                    "status": response_view.status_code,
+                }
+            },
+        )
@@ -4,15 +4,24 @@ Context based tracking middleware tests
 
 import asyncio
 import logging
+import tracemalloc
+from typing import Any, AsyncIterator, Callable
 from unittest.mock import ANY
 
 import pytest
+from prometheus_client import REGISTRY
+from starlette.datastructures import Headers
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from starlette.types import Message, Receive, Scope, Send
 
 from {{cookiecutter.__project_slug}}.conftest import JsonLogs
 
+from . import slog
+from .metrics import MetricsSettings, RequestMetrics
 from .slog import logging_context
+from .tracing import RequestTracer, TracingPolicy
 from .tracking import RequestView, ResponseView, TrackingMiddleware
 
 logger = logging.getLogger(__name__)
@@ -28,7 +37,7 @@ def f_request() -> Request:
             "headers": [
                 (b"x-request-id", b"abc"),
                 (b"user-agent", b"agent"),
-                (b"Content-Length", b"10"),
+                (b"content-length", b"10"),
             ],
             "client": ("10.1.1.10", "10"),
             "path": "/v1/path",
@@ -43,7 +52,7 @@ def f_response() -> Response:
 
 
 def test_request_view(f_request: Request):
-    view = RequestView(f_request)
+    view = RequestView(f_request.scope)
     assert view.client_addr == "10.1.1.10:10"
     assert view.url_path == "/v1/path"
     assert view.method == "GET"
@@ -53,25 +62,68 @@ def test_request_view(f_request: Request):
     assert view.user_agent == "agent"
 
 
-def test_response_view(f_response: Response):
-    view = ResponseView(f_response)
+def test_request_view_headers():
+    view = RequestView(
+        {
+            "method": "POST",
+            "http_version": "2",
+            "headers": [(b"content-length", b"ten"), (b"x-custom", b"\xe9")],
+        }
+    )
+    assert view.http_version == "HTTP/2"
+    assert view.request_id is None
+    assert view.user_agent is None
+    assert view.content_length is None
+    assert view.headers == {"content-length": "ten", "x-custom": "é"}
+
+
+def test_response_view():
+    view = ResponseView()
+    view.started({"status": 200, "headers": [(b"content-length", b"10")]})
+    assert view.status_code == 200
     assert view.content_length == 10
 
 
+def test_response_view_streaming():
+    view = ResponseView()
+    view.started({"status": 200, "headers": []})
+    view.body_size = 42
+    assert view.content_length == 42
+
+
+async def _receive() -> Message:
+    return {"type": "http.disconnect"}
+
+
+class _SendCapture:
+    def __init__(self) -> None:
+        self.messages: list[Message] = []
+
+    async def __call__(self, message: Message) -> None:
+        self.messages.append(message)
+
+
 @pytest.mark.asyncio
 async def test_tracking_middleware(
     f_request: Request,
     f_response: Response,
     structured_logs_capture: JsonLogs,
 ):
-    async def api_call(request: Request):
+    async def api_call(scope: Scope, receive: Receive, send: Send):
         with logging_context(b=20):
             logger.info("slow api call")
             await asyncio.sleep(0.2)
-        return f_response
+        await f_response(scope, receive, send)
 
-    tracking = TrackingMiddleware(None)  # type: ignore
-    await tracking.dispatch(f_request, api_call)
+    send = _SendCapture()
+    tracking = TrackingMiddleware(api_call)
+    await tracking(f_request.scope, _receive, send)
+
+    # Response is passed through untouched
+    assert [message["type"] for message in send.messages] == [
+        "http.response.start",
+        "http.response.body",
+    ]
 
     assert structured_logs_capture.parse() == [
         {
@@ -109,3 +161,202 @@ async def test_tracking_middleware(
     # latency in string format as "0.123s"
     latency = float(structured_logs_capture.parse()[1]["httpRequest"]["latency"][:-1])
     assert 0.19 <= latency <= 0.21
+
+
+@pytest.mark.asyncio
+async def test_tracking_middleware_streaming(
+    f_request: Request,
+    structured_logs_capture: JsonLogs,
+):
+    async def chunks() -> AsyncIterator[bytes]:
+        for _ in range(3):
+            yield b"chunk"
+
+    send = _SendCapture()
+    tracking = TrackingMiddleware(StreamingResponse(chunks(), status_code=201))
+    await tracking(f_request.scope, _receive, send)
+
+    # Every chunk is sent separately, nothing is buffered
+    assert [message.get("body") for message in send.messages[1:]] == [
+        b"chunk",
+        b"chunk",
+        b"chunk",
+        b"",
+    ]
+
+    http_request = structured_logs_capture.parse()[0]["httpRequest"]
+    assert http_request["status"] == 201
+    assert http_request["responseSize"] == 15
+
+
+@pytest.mark.asyncio
+async def test_tracking_middleware_error(
+    f_request: Request,
+    structured_logs_capture: JsonLogs,
+):
+    async def failing_app(scope: Scope, receive: Receive, send: Send):
+        raise ValueError("boom")
+
+    tracking = TrackingMiddleware(failing_app)
+    with pytest.raises(ValueError):
+        await tracking(f_request.scope, _receive, _SendCapture())
+
+    http_request = structured_logs_capture.parse()[0]["httpRequest"]
+    assert http_request["status"] == 500
+    assert http_request["responseSize"] is None
+
+
+@pytest.mark.asyncio
+async def test_tracking_middleware_request(
+    f_request: Request,
+    structured_logs_capture: JsonLogs,
+):
+    """
+    Work the middleware does for every request, its throughput is compared
+    with BaseHTTPMiddleware by `{{cookiecutter.__project_kebab}} bench`
+    """
+    response = Response("OK", headers={"x-custom": "1"})
+
+    async def app(scope: Scope, receive: Receive, send: Send):
+        scope["route"] = Route("/v1/{name}", response)
+        logger.info("in app")
+        await response(scope, receive, send)
+
+    direct = _SendCapture()
+    await app(dict(f_request.scope), _receive, direct)
+
+    send = _SendCapture()
+    metrics = MetricsSettings(app_name="tracking-test")
+    tracking = TrackingMiddleware(app, metrics=RequestMetrics(metrics))
+    await tracking(dict(f_request.scope), _receive, send)
+
+    # Headers and body are passed through untouched
+    assert send.messages == direct.messages
+    # The request id labels logs of the request only
+    [outside, in_app, access_log] = structured_logs_capture.parse()
+    assert "request_id" not in outside["logging.googleapis.com/labels"]
+    assert in_app["logging.googleapis.com/labels"]["request_id"] == "abc"
+    assert access_log["logging.googleapis.com/labels"]["request_id"] == "abc"
+    assert slog.CONTEXT_LABELS.get() is None
+    # Recorded by the route template
+    labels = {"app_name": "tracking-test", "method": "GET"}
+    requests = REGISTRY.get_sample_value(
+        "starlette_requests_total",
+        {**labels, "path": "/v1/{name}", "status_code": "200"},
+    )
+    assert requests == 1
+    assert REGISTRY.get_sample_value("starlette_requests_in_progress", labels) == 0
+
+
+class _FailingTracer(RequestTracer):
+    def __init__(self) -> None:
+        super().__init__(TracingPolicy(sample_rate=1.0), random=lambda: 0.0)
+
+    def start(self, method: str, path: str, headers: dict[str, str]) -> Any:
+        raise RuntimeError("start failed")
+
+    def finish(
+        self,
+        transaction: Any,
+        scope: Scope,
+        status_code: int,
+        latency: float,
+        request_id: str | None,
+    ) -> None:
+        raise RuntimeError("finish failed")
+
+
+@pytest.mark.asyncio
+async def test_tracking_middleware_tracer_error(
+    f_request: Request,
+    structured_logs_capture: JsonLogs,
+):
+    response = Response("OK")
+
+    async def app(scope: Scope, receive: Receive, send: Send):
+        scope["route"] = Route("/v1/{name}", response)
+        await response(scope, receive, send)
+
+    send = _SendCapture()
+    metrics = MetricsSettings(app_name="tracking-tracer-error")
+    tracking = TrackingMiddleware(app, _FailingTracer(), RequestMetrics(metrics))
+    await tracking(dict(f_request.scope), _receive, send)
+
+    # Failed tracing is logged, the request is served and recorded
+    assert send.messages[0]["status"] == 200
+    messages = [log["message"] for log in structured_logs_capture.parse()]
+    assert messages == [
+        "Failed to start tracing the request",
+        "GET /v1/path HTTP/1.1",
+        "Failed to report the trace of the request",
+    ]
+    labels = {"app_name": "tracking-tracer-error", "method": "GET"}
+    requests = REGISTRY.get_sample_value(
+        "starlette_requests_total",
+        {**labels, "path": "/v1/{name}", "status_code": "200"},
+    )
+    assert requests == 1
+    assert REGISTRY.get_sample_value("starlette_requests_in_progress", labels) == 0
+
+
+_RESPONSE_START: Message = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [(b"content-type", b"text/plain"), (b"content-length", b"2")],
+}
+
+
+def _views(scope: Scope) -> Any:
+    request_view = RequestView(scope)
+    response_view = ResponseView()
+    response_view.started(_RESPONSE_START)
+    return request_view, response_view
+
+
+def _legacy_views(scope: Scope) -> Any:
+    # Previous views kept a Request, a dict of all request headers
+    # and Headers of the response
+    request = Request(scope)
+    headers = dict(request.headers.items())
+    return request, headers, Headers(raw=_RESPONSE_START["headers"])
+
+
+def _allocated_per_request(
+    make_views: Callable[[Scope], Any], scope: Scope, n_requests: int
+) -> float:
+    views = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(n_requests):
+            # Keep the views alive to count everything they allocated
+            views.append(make_views(dict(scope)))
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / n_requests
+
+
+def test_views_allocations(f_request: Request):
+    """
+    Compare memory allocated per request by the views and the previous views
+    """
+    scope = {
+        **f_request.scope,
+        "headers": [
+            *f_request.scope["headers"],
+            (b"host", b"example.com"),
+            (b"accept", b"application/json"),
+            (b"accept-encoding", b"gzip, br"),
+            (b"x-forwarded-for", b"10.0.0.1, 10.0.0.2"),
+        ],
+    }
+    allocated = _allocated_per_request(_views, scope, 1000)
+    legacy_allocated = _allocated_per_request(_legacy_views, scope, 1000)
+
+    logger.info(
+        "Views allocate %.0f bytes per request (previous: %.0f bytes)",
+        allocated,
+        legacy_allocated,
+    )
+    assert allocated < legacy_allocated / 2
@@ -0,0 +1,254 @@
+"""
+Pre-fork worker supervisor
+
+The supervisor binds the listening socket once and forks worker processes
+that all accept connections from this shared socket.
+Workers that exit are restarted, crashed ones after a delay if they crash
+right after the start. SIGTERM/SIGINT are fanned out to the workers
+so each of them can shut down gracefully.
+
+Usage:
+
+sock = bind_socket("0.0.0.0", 8000)
+Supervisor(serve, sock, workers=resolve_workers("auto")).run()
+
+Each worker has its own Prometheus metrics, so they are written to files
+in a shared directory and merged on scrape, see `prepare_metrics_dir`
+"""
+
+import heapq
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover - not available on macOS
+        return os.cpu_count() or 1
+
+
+def cpu_quota(cgroup_root: Path = CGROUP_ROOT) -> float | None:
+    """
+    Number of CPUs the container is allowed to use according to cgroup limits.
+    Returns None if no CPU limit is set
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = cgroup_root / "cpu.max"
+    if cpu_max.is_file():
+        quota, period = cpu_max.read_text().split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+
+    # cgroup v1: quota is -1 when not limited
+    for cpu_dir in ("cpu", "cpu,cpuacct"):
+        quota_file = cgroup_root / cpu_dir / "cpu.cfs_quota_us"
+        period_file = cgroup_root / cpu_dir / "cpu.cfs_period_us"
+        if quota_file.is_file() and period_file.is_file():
+            quota = int(quota_file.read_text())
+            if quota <= 0:
+                return None
+            return quota / int(period_file.read_text())
+
+    return None
+
+
+def resolve_workers(value: str, cgroup_root: Path = CGROUP_ROOT) -> int:
+    """
+    Parse number of workers.
+    'auto' selects number of workers based on the cgroup CPU quota,
+    falling back to the number of available CPUs
+    """
+    if value != "auto":
+        try:
+            workers = int(value)
+        except ValueError:
+            raise ValueError(
+                f"Number of workers must be an integer or 'auto', got {value!r}"
+            ) from None
+        if workers < 1:
+            raise ValueError(f"Number of workers must be positive, got {workers}")
+        return workers
+
+    cpus = _available_cpus()
+    quota = cpu_quota(cgroup_root)
+    if quota is None:
+        return cpus
+
+    return max(1, min(cpus, math.ceil(quota)))
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Bind listening socket to be shared by all the workers
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    # asyncio sets TCP_NODELAY only on accepted sockets with explicit IPPROTO_TCP,
+    # without it small responses are delayed by ~40ms waiting for delayed ACK
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Allows new pod/process to bind the port while the old one is draining
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def prepare_metrics_dir(path: Path | None = None) -> Path:
+    """
+    Set up PROMETHEUS_MULTIPROC_DIR for metrics of the worker processes.
+    Uses a new temporary directory if path is None,
+    metric files left by the previous run are removed.
+
+    prometheus_client chooses file-backed metric values when it is imported,
+    so this must be called before importing it
+    """
+    if "prometheus_client" in sys.modules:
+        raise RuntimeError("prometheus_client is imported before setting up metrics")
+
+    if path is None:
+        path = Path(tempfile.mkdtemp(prefix="prometheus-"))
+    path.mkdir(parents=True, exist_ok=True)
+    for stale in path.glob("*.db"):
+        stale.unlink()
+
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = str(path)
+    return path
+
+
+class Supervisor:
+    """
+    Forks worker processes and keeps them running until SIGTERM/SIGINT
+    """
+
+    def __init__(
+        self,
+        target: Callable[[socket.socket], None],
+        sock: socket.socket,
+        workers: int,
+        restart_delay: float = 1.0,
+        shutdown_timeout: float = 30.0,
+        on_worker_exit: Callable[[int], None] | None = None,
+    ):
+        self.target = target
+        self.sock = sock
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        # Called with pid of every exited worker, e.g. to clean up its metrics
+        self.on_worker_exit = on_worker_exit
+
+        # pid -> start time of the worker
+        self._processes: dict[int, float] = {}
+        # Heap of monotonic times when crashed workers are due to be restarted
+        self._restarts: list[float] = []
+        self._should_exit = threading.Event()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        signal.signal(signal.SIGINT, self._handle_exit)
+
+        logger.info("Starting %s workers, supervisor pid %s", self.workers, os.getpid())
+
+        for _ in range(self.workers):
+            self._spawn()
+
+        while not self._should_exit.wait(0.1):
+            now = time.monotonic()
+            for pid, exit_code, started_at in self._reap():
+                if exit_code == 0:
+                    # Stopped on its own, e.g. SIGTERM sent to the worker only:
+                    # the supervisor keeps the number of workers until it stops
+                    logger.info("Worker %s exited, restarting", pid)
+                    heapq.heappush(self._restarts, now)
+                    continue
+                logger.error("Worker %s died with exit code %s", pid, exit_code)
+                # Do not spin if worker crashes right after the start,
+                # other workers are still reaped while it waits
+                if now - started_at < self.restart_delay:
+                    heapq.heappush(self._restarts, now + self.restart_delay)
+                else:
+                    heapq.heappush(self._restarts, now)
+            while self._restarts and self._restarts[0] <= now:
+                heapq.heappop(self._restarts)
+                self._spawn()
+
+        self._shutdown()
+
+    def _handle_exit(self, sig: int, _frame: object) -> None:
+        self._should_exit.set()
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover - runs in the child process
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.target(self.sock)
+            except BaseException:
+                logger.exception("Worker %s failed", os.getpid())
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+
+        logger.info("Started worker %s", pid)
+        self._processes[pid] = time.monotonic()
+
+    def _reap(self) -> list[tuple[int, int, float]]:
+        """
+        Collect exited workers: (pid, exit code, start time)
+        """
+        reaped = []
+        while self._processes:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if started_at := self._processes.pop(pid, None):
+                reaped.append((pid, os.waitstatus_to_exitcode(status), started_at))
+                self._worker_exited(pid)
+        return reaped
+
+    def _worker_exited(self, pid: int) -> None:
+        if self.on_worker_exit is None:
+            return
+        try:
+            self.on_worker_exit(pid)
+        except Exception:
+            logger.exception("Failed to clean up after worker %s", pid)
+
+    def _shutdown(self) -> None:
+        logger.info("Stopping %s workers", len(self._processes))
+
+        for pid in self._processes:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self._processes and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for pid in self._processes:
+            logger.error("Worker %s did not stop in time, killing", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self._worker_exited(pid)
+
+        self._processes.clear()
+        self.sock.close()
@@ -0,0 +1,197 @@
+"""
+Tests for pre-fork worker supervisor
+"""
+
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from .workers import (
+    Supervisor,
+    bind_socket,
+    cpu_quota,
+    prepare_metrics_dir,
+    resolve_workers,
+)
+
+
+@pytest.fixture()
+def cgroup_v2(tmp_path: Path) -> Path:
+    (tmp_path / "cpu.max").write_text("250000 100000\n")
+    return tmp_path
+
+
+@pytest.fixture()
+def cgroup_v1(tmp_path: Path) -> Path:
+    (tmp_path / "cpu,cpuacct").mkdir()
+    (tmp_path / "cpu,cpuacct" / "cpu.cfs_quota_us").write_text("150000\n")
+    (tmp_path / "cpu,cpuacct" / "cpu.cfs_period_us").write_text("100000\n")
+    return tmp_path
+
+
+def test_cpu_quota_v2(cgroup_v2: Path):
+    assert cpu_quota(cgroup_v2) == 2.5
+
+
+def test_cpu_quota_v2_unlimited(tmp_path: Path):
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert cpu_quota(tmp_path) is None
+
+
+def test_cpu_quota_v1(cgroup_v1: Path):
+    assert cpu_quota(cgroup_v1) == 1.5
+
+
+def test_cpu_quota_missing(tmp_path: Path):
+    assert cpu_quota(tmp_path) is None
+
+
+def test_resolve_workers(cgroup_v2: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda _: set(range(16)))
+
+    assert resolve_workers("4", cgroup_v2) == 4
+    assert resolve_workers("auto", cgroup_v2) == 3
+
+    # Quota cannot give more workers than there are CPUs
+    monkeypatch.setattr(os, "sched_getaffinity", lambda _: {0, 1})
+    assert resolve_workers("auto", cgroup_v2) == 2
+
+    with pytest.raises(ValueError, match="positive"):
+        resolve_workers("0", cgroup_v2)
+    with pytest.raises(ValueError, match="'abc'"):
+        resolve_workers("abc", cgroup_v2)
+
+
+def _crash_once_worker(pids_file: Path, sock: socket.socket) -> None:
+    with pids_file.open("a") as f:
+        f.write(f"{os.getpid()}\n")
+
+    if len(pids_file.read_text().splitlines()) == 1:
+        os._exit(1)
+
+    # Serve until the supervisor asks us to stop
+    signal.pause()
+
+
+def _run_supervisor(pids_file: Path, exited_file: Path) -> None:
+    def on_worker_exit(pid: int) -> None:
+        with exited_file.open("a") as f:
+            f.write(f"{pid}\n")
+
+    sock = bind_socket("127.0.0.1", 0)
+    Supervisor(
+        lambda s: _crash_once_worker(pids_file, s),
+        sock,
+        workers=1,
+        restart_delay=0.1,
+        shutdown_timeout=5,
+        on_worker_exit=on_worker_exit,
+    ).run()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_supervisor_restarts_and_stops_workers(tmp_path: Path):
+    pids_file = tmp_path / "pids"
+    pids_file.touch()
+    exited_file = tmp_path / "exited"
+    exited_file.touch()
+
+    supervisor = multiprocessing.get_context("fork").Process(
+        target=_run_supervisor, args=(pids_file, exited_file)
+    )
+    supervisor.start()
+
+    deadline = time.monotonic() + 10
+    while len(pids_file.read_text().splitlines()) < 2:
+        assert time.monotonic() < deadline, "worker was not restarted"
+        time.sleep(0.05)
+
+    supervisor.terminate()
+    supervisor.join(10)
+
+    assert supervisor.exitcode == 0
+    assert not any(_pid_alive(int(pid)) for pid in pids_file.read_text().split())
+    # Both the crashed and the stopped worker are cleaned up
+    assert exited_file.read_text().split() == pids_file.read_text().split()
+
+
+def test_supervisor_schedules_restarts(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+):
+    monkeypatch.setattr(signal, "signal", lambda *_: None)
+    sock = socket.socket()
+    supervisor = Supervisor(lambda _: None, sock, workers=3, restart_delay=60)
+    spawned: list[float] = []
+    reaps = 0
+
+    def reap() -> list[tuple[int, int, float]]:
+        nonlocal reaps
+        reaps += 1
+        if reaps == 3:
+            supervisor._should_exit.set()
+        if reaps == 1:
+            # Two workers crash right after the start, one stops cleanly
+            started_at = time.monotonic()
+            return [(1, 1, started_at), (2, 1, started_at), (3, 0, started_at)]
+        return []
+
+    monkeypatch.setattr(supervisor, "_spawn", lambda: spawned.append(time.monotonic()))
+    monkeypatch.setattr(supervisor, "_reap", reap)
+    monkeypatch.setattr(supervisor, "_shutdown", sock.close)
+    supervisor.run()
+
+    # Reaping goes on while the restarts of crashed workers wait for their delay,
+    # the cleanly stopped one is restarted right away
+    assert reaps == 3
+    assert len(spawned) == 4
+    assert len(supervisor._restarts) == 2
+    levels = {
+        record.getMessage(): record.levelname
+        for record in caplog.records
+        if record.getMessage().startswith("Worker")
+    }
+    assert levels == {
+        "Worker 1 died with exit code 1": "ERROR",
+        "Worker 2 died with exit code 1": "ERROR",
+        "Worker 3 exited, restarting": "INFO",
+    }
+
+
+def test_bind_socket_tcp_protocol():
+    sock = bind_socket("127.0.0.1", 0)
+    sock.listen()
+    with sock, socket.create_connection(sock.getsockname()):
+        conn, _ = sock.accept()
+        with conn:
+            # Required by asyncio to enable TCP_NODELAY on the connection
+            assert conn.proto == socket.IPPROTO_TCP
+
+
+def test_prepare_metrics_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    (tmp_path / "counter_1.db").touch()
+    monkeypatch.delitem(sys.modules, "prometheus_client", raising=False)
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+
+    assert prepare_metrics_dir(tmp_path) == tmp_path
+    assert os.environ["PROMETHEUS_MULTIPROC_DIR"] == str(tmp_path)
+    # Metrics of the previous run are removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_prepare_metrics_dir_after_import(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(sys.modules, "prometheus_client", object())
+    with pytest.raises(RuntimeError):
+        prepare_metrics_dir()